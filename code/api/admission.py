@@ -0,0 +1,148 @@
+import asyncio
+import fcntl
+import os
+from hashlib import sha256
+from threading import Condition
+from time import monotonic
+
+from api.errors import TooManyRequestsError
+from api.metrics import metrics
+
+# Maximum time (in seconds) to wait before checking again whether the slots
+# freed by the other processes can be taken (the ones freed by the current
+# process are taken right away).
+POLL_INTERVAL = 0.01
+
+
+def digest(key):
+    """Identify a tenant by its API key without keeping the key itself."""
+    return sha256(key.encode()).hexdigest()[:16]
+
+
+class Slots:
+    """
+    Slots shared by all the processes using the same directory. A slot is
+    taken by holding an exclusive lock on its file, so the slots of a process
+    are freed by the OS even if the process dies without freeing them.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def take(self, name, limit):
+        """Take any free slot out of `limit` ones or return `None`."""
+        for index in range(limit):
+            fd = os.open(os.path.join(self.directory, f'{name}.{index}'),
+                         os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+            else:
+                return fd
+
+    @staticmethod
+    def free(fd):
+        # Closing the file releases the lock.
+        os.close(fd)
+
+
+class AdmissionController:
+    """
+    Limit the number of requests being served concurrently by all the worker
+    processes (both per tenant and in total), letting any extra requests wait
+    for a while and shedding them if no capacity gets freed in time.
+    """
+
+    def __init__(self, tenant_limit, total_limit, timeout, directory,
+                 tenant_buckets):
+        self.tenant_limit = tenant_limit
+        self.total_limit = total_limit
+        self.timeout = timeout
+        self.tenant_buckets = tenant_buckets
+
+        self._slots = Slots(directory)
+        self._condition = Condition()
+
+    def _admit(self, tenant):
+        """Take the slots for a request or return `None` if there are none."""
+        slots = []
+
+        if tenant is not None:
+            # Tenants aren't authenticated yet, so don't let them create any
+            # number of slot files, but share a fixed number of buckets.
+            bucket = int(digest(tenant), 16) % self.tenant_buckets
+            slots.append(self._slots.take(f'tenant-{bucket}',
+                                          self.tenant_limit))
+
+        if slots and slots[0] is None:
+            return None
+
+        slots.append(self._slots.take('total', self.total_limit))
+
+        if slots[-1] is None:
+            for fd in slots[:-1]:
+                self._slots.free(fd)
+            return None
+
+        return slots
+
+    def acquire(self, tenant=None):
+        """
+        Wait until a request of the given tenant can be admitted and return
+        the ticket to release later or raise `TooManyRequestsError` if the
+        wait takes too long.
+        """
+        start = monotonic()
+
+        with self._condition:
+            ticket = self._admit(tenant)
+
+            while ticket is None:
+                remaining = start + self.timeout - monotonic()
+                if remaining <= 0:
+                    break
+
+                self._condition.wait(min(remaining, POLL_INTERVAL))
+                ticket = self._admit(tenant)
+
+        return self._admitted(start, ticket)
+
+    async def acquire_async(self, tenant=None):
+        """
+        The same as `acquire`, but for the ASGI app (which must not block the
+        event loop while waiting).
+        """
+        start = monotonic()
+
+        ticket = self._admit(tenant)
+
+        while ticket is None:
+            remaining = start + self.timeout - monotonic()
+            if remaining <= 0:
+                break
+
+            await asyncio.sleep(min(remaining, POLL_INTERVAL))
+            ticket = self._admit(tenant)
+
+        return self._admitted(start, ticket)
+
+    @staticmethod
+    def _admitted(start, ticket):
+        metrics.observe('admission.queue_time', monotonic() - start)
+
+        if ticket is None:
+            metrics.increment('admission.shed')
+            raise TooManyRequestsError(
+                'Too many concurrent requests, please try again later'
+            )
+
+        return ticket
+
+    def release(self, ticket):
+        with self._condition:
+            for fd in ticket:
+                self._slots.free(fd)
+
+            self._condition.notify_all()
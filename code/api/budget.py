@@ -0,0 +1,63 @@
+from collections import namedtuple
+from math import ceil
+
+# The maximum number of events to return for a particular observable (share),
+# and the maximum number of detection-backed events among them (detected).
+# The latter may exceed the former, but only with detection-backed events.
+Allocation = namedtuple('Allocation', ['share', 'detected'])
+
+
+class Budget:
+    """
+    Request-level budget of entities shared by all the requested observables.
+
+    Observables are served one by one, and each of them gets its fair share of
+    the budget still remaining, so whatever is left unused by sparse
+    observables is automatically redistributed among the next ones.
+    """
+
+    ROUND_ROBIN = 'round-robin'
+    WEIGHTED = 'weighted'
+
+    # Maximum number of fair shares detection-backed events may take (so
+    # that whichever observable comes first can't take nearly everything).
+    DETECTED_WEIGHT = 2
+
+    def __init__(self, total, observables, limit, strategy=ROUND_ROBIN):
+        if strategy not in (self.ROUND_ROBIN, self.WEIGHTED):
+            raise ValueError(f'Unknown budget strategy: {strategy}.')
+
+        self.remaining = total
+        self.observables = observables
+        self.limit = limit
+        self.strategy = strategy
+
+    @property
+    def exhausted(self):
+        return self.remaining <= 0
+
+    def allocate(self):
+        """Allocate a part of the remaining budget to the next observable."""
+        if self.exhausted or not self.observables:
+            return Allocation(0, 0)
+
+        share = min(self.limit, ceil(self.remaining / self.observables))
+        detected = share
+
+        if self.strategy == self.WEIGHTED:
+            # Let detection-backed events take even more than the fair share
+            # while still leaving at least something to the next observables.
+            detected = min(
+                self.limit,
+                max(share, min(
+                    share * self.DETECTED_WEIGHT,
+                    self.remaining - (self.observables - 1),
+                )),
+            )
+
+        return Allocation(share, detected)
+
+    def spend(self, count):
+        """Account for the events actually returned for an observable."""
+        self.remaining -= count
+        self.observables -= 1
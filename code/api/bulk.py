@@ -0,0 +1,269 @@
+"""
+Bulk enrichment: observables are read as NDJSON (one per line), and a bundle
+is sent back per observable as NDJSON as well, as soon as it's ready.
+
+Lines come out in the same order as they come in, each one with the number
+of the corresponding input line, so an interrupted run can be resumed from
+the line following the last received one. Any errors (e.g. invalid input or
+failed calls to the GTI API) are reported on their own lines without
+interrupting the rest of the stream.
+"""
+
+import asyncio
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from flask import Blueprint, current_app, request, stream_with_context
+
+from api import offload
+from api.enrich import (
+    admit_request,
+    bundle_events,
+    get_budget,
+    get_bundle,
+    get_warnings,
+    release_request,
+)
+from api.errors import RelayError
+from api.jsonlib import dumps, loads
+from api.schemas import parse_observables
+from api.utils import format_error, get_context, invalid_payload
+from api.workflow import (
+    get_events_for_observable,
+    get_events_for_observable_async,
+)
+
+bulk_api = Blueprint('bulk', __name__)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# The whole stream takes up a single slot, but (unlike the other enrichment
+# endpoints) isn't compressed, so that each line is sent right away.
+bulk_api.before_request(admit_request)
+bulk_api.teardown_request(release_request)
+
+
+def read_observables():
+    """
+    Yield the numbers of non-blank lines of the request body along with the
+    (canonicalized) observables and either `None`, if the events for them
+    must be looked up, or the results to use instead, i.e. `(events, error)`
+    (e.g. errors for invalid lines, or no events for unsupported types).
+    """
+    observable_types = current_app.config['GTI_OBSERVABLE_TYPES']
+
+    for number, line in enumerate(request.stream, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            data = loads(line)
+        except ValueError:
+            # The same way as the other endpoints treat invalid JSON.
+            data = None
+
+        observables, error = parse_observables([data], observable_types)
+
+        if error:
+            yield number, None, (None, invalid_payload(error[0]))
+        elif observables:
+            yield number, observables[0], None
+        else:
+            yield number, data, ([], None)
+
+
+def failed_lookup(exception):
+    """
+    Turn an exception (being handled) raised while looking up the events for
+    an observable into the results for its line only, so that the rest of
+    the stream goes on.
+    """
+    if isinstance(exception, RelayError):
+        return None, exception.json()
+
+    # The same way as `app.handle_error` treats unexpected exceptions.
+    current_app.logger.error(traceback.format_exc())
+    return None, RelayError().json()
+
+
+def get_result(future):
+    try:
+        return future.result()
+    except Exception as exception:
+        return failed_lookup(exception)
+
+
+async def get_result_async(future):
+    try:
+        return await future
+    except Exception as exception:
+        return failed_lookup(exception)
+
+
+def format_line(context, number, observable, result, indicator_by_rule_uuid):
+    """Map the events for an observable into a bundle and encode the line."""
+    line = {'line': number}
+
+    if observable is not None:
+        line['observable'] = observable
+
+    events, error = result
+
+    if error:
+        line['errors'] = [format_error(error)]
+        current_app.logger.error(line)
+    else:
+        bundle = get_bundle()
+        bundle_events(bundle, context, events, indicator_by_rule_uuid)
+
+        line['data'] = bundle.json()
+
+        warnings = get_warnings(bundle)
+        if warnings:
+            line['errors'] = warnings
+
+    config = current_app.config
+
+    return (dumps(
+        line,
+        sort_keys=config['JSON_SORT_KEYS'],
+        ensure_ascii=config['JSON_AS_ASCII'],
+    ) + '\n').encode()
+
+
+async def format_line_async(context, number, observable, result,
+                            indicator_by_rule_uuid):
+    """
+    The same as `format_line`, but for the ASGI app (which must not block the
+    event loop while waiting for the events mapped in the pool).
+    """
+    events, error = result
+
+    if not error and offload.applies(current_app.config, len(events)):
+        return await asyncio.to_thread(
+            format_line, context, number, observable, result,
+            indicator_by_rule_uuid,
+        )
+
+    return format_line(
+        context, number, observable, result, indicator_by_rule_uuid
+    )
+
+
+def respond_with_lines(lines):
+    return current_app.response_class(lines, mimetype=NDJSON_MIMETYPE)
+
+
+@bulk_api.route('/observe/observables/bulk', methods=['POST'])
+def observe_observables_bulk():
+    context = get_context()
+
+    concurrency = current_app.config['CTR_BULK_CONCURRENCY']
+
+    def generate():
+        # Different observables may share the same rules.
+        indicator_by_rule_uuid = {}
+
+        # Lookups in the input order (at most `concurrency` at a time).
+        pending = deque()
+
+        def ready():
+            # Wait for the oldest lookup only once no more can be started.
+            return pending and (
+                len(pending) >= concurrency or pending[0][2].done()
+            )
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            for number, observable, result in read_observables():
+                if result is None:
+                    future = executor.submit(
+                        get_events_for_observable,
+                        context,
+                        observable,
+                        get_budget(context, [observable]).allocate(),
+                    )
+                else:
+                    future = Future()
+                    future.set_result(result)
+
+                pending.append((number, observable, future))
+
+                while ready():
+                    number, observable, future = pending.popleft()
+                    yield format_line(
+                        context, number, observable, get_result(future),
+                        indicator_by_rule_uuid,
+                    )
+
+            while pending:
+                number, observable, future = pending.popleft()
+                yield format_line(
+                    context, number, observable, get_result(future),
+                    indicator_by_rule_uuid,
+                )
+
+    return respond_with_lines(stream_with_context(generate()))
+
+
+async def observe_observables_bulk_async():
+    """
+    The same as `observe_observables_bulk`, but for the ASGI app (which
+    sends the lines from the asynchronous generator as they are ready).
+    """
+    context = await asyncio.to_thread(get_context)
+
+    concurrency = current_app.config['CTR_BULK_CONCURRENCY']
+
+    async def generate():
+        indicator_by_rule_uuid = {}
+
+        pending = deque()
+
+        def ready():
+            return pending and (
+                len(pending) >= concurrency or pending[0][2].done()
+            )
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            for number, observable, result in read_observables():
+                if result is None:
+                    future = asyncio.ensure_future(
+                        get_events_for_observable_async(
+                            context,
+                            observable,
+                            get_budget(context, [observable]).allocate(),
+                        )
+                    )
+                else:
+                    future = loop.create_future()
+                    future.set_result(result)
+
+                pending.append((number, observable, future))
+
+                # Let the lookups started so far make some progress.
+                await asyncio.sleep(0)
+
+                while ready():
+                    number, observable, future = pending.popleft()
+                    yield await format_line_async(
+                        context, number, observable,
+                        await get_result_async(future),
+                        indicator_by_rule_uuid,
+                    )
+
+            while pending:
+                number, observable, future = pending.popleft()
+                yield await format_line_async(
+                    context, number, observable,
+                    await get_result_async(future),
+                    indicator_by_rule_uuid,
+                )
+        finally:
+            # E.g. the client has gone away.
+            for _, _, future in pending:
+                future.cancel()
+
+    return respond_with_lines(generate())
@@ -1,15 +1,204 @@
 from collections import defaultdict
+from heapq import heappop, heappush
+from itertools import count
+
+from api.jsonlib import dumps
+from api.mappings import EncodedSighting, SightingRecord
 
 
 class Bundle:
+    """
+    Unique CTIM entities grouped by their types (sightings are added as
+    `SightingRecord`s or `EncodedSighting`s, while all the other entities as
+    CTIM dicts).
+
+    If the maximum (approximate) size of the encoded bundle is given, the
+    bundle keeps the most important sightings (i.e. detected ones first, then
+    the most recent ones) fitting into it and drops the rest along with any
+    relationships to them (and indicators left without relationships).
+
+    Measuring the entities takes encoding them with the given compact `dumps`,
+    so they are kept encoded and passed through as is by `stream` (with the
+    same `dumps`) instead of being encoded once again.
+    """
+
+    def __init__(self, max_size=None, dumps=dumps):
+        self.max_size = max_size
+        self.dumps = dumps
+
+        # Number of sightings dropped to fit into the maximum size.
+        self.truncated = 0
+
+        self._entities_by_type = defaultdict(dict)
+        self._entity_by_key = {}
+
+        self._size = 0
+        self._encoded_by_key = {}
+        # Retained sightings (the least important one coming first).
+        self._sightings = []
+        self._order = count()
+        # ID of a sighting or an indicator -> its key, keys of relationships.
+        self._key_by_id = {}
+        self._relationships_by_ref = defaultdict(set)
+
+    @staticmethod
+    def _key(entity):
+        # Sightings are identified by the UUIDs of the leading event and the
+        # rule (if detected, i.e. if there is a severity), but not of the
+        # sample of other aggregated events (which may differ by observable),
+        # relationships - by their endpoints, all the other entities - by IDs.
+        if entity['type'] == 'sighting':
+            external_ids = entity['external_ids']
+            return (
+                entity['type'],
+                external_ids[0],
+                external_ids[-1] if entity.severity is not None else None,
+            )
+        if entity['type'] == 'relationship':
+            return (
+                entity['type'],
+                entity['relationship_type'],
+                entity['source_ref'],
+                entity['target_ref'],
+            )
+        return entity['type'], entity['id']
+
+    @staticmethod
+    def _merge(entity, duplicate):
+        # The same event may match several observables from one request, so
+        # make the already added sighting carry all the matched observables
+        # along with any additional relations instead of duplicating it.
+        if entity['type'] == 'sighting':
+            entity.merge(duplicate)
+
+    @staticmethod
+    def _priority(sighting):
+        # Only sightings of detected events have severities.
+        return sighting.severity is not None, sighting.end_time
+
+    @staticmethod
+    def _render(entity):
+        # Sightings are kept as compact records until serialized.
+        if isinstance(entity, (SightingRecord, EncodedSighting)):
+            return entity.json()
+        return entity
+
+    @classmethod
+    def _encode(cls, entity, dumps):
+        # Sightings may have already been encoded (e.g. in the offload pool).
+        encoded = getattr(entity, 'encoded', None)
+        if encoded is not None:
+            return encoded
+        return dumps(cls._render(entity))
+
+    @staticmethod
+    def _measure(encoded):
+        # Along with the separator from the next entity of the same type.
+        return len(encoded) + 1
+
+    def _resize(self, key, encoded):
+        previous = self._encoded_by_key.get(key)
+        if previous is not None:
+            self._size -= self._measure(previous)
+
+        self._size += self._measure(encoded)
+        self._encoded_by_key[key] = encoded
+
+    def _remove(self, key):
+        entity = self._entity_by_key.pop(key, None)
+        if entity is None:
+            return
+
+        entity_type = entity['type'] + 's'
+        del self._entities_by_type[entity_type][key]
+        if not self._entities_by_type[entity_type]:
+            del self._entities_by_type[entity_type]
+
+        self._size -= self._measure(self._encoded_by_key.pop(key))
 
-    def __init__(self):
-        self._entities_by_type = defaultdict(list)
+        if entity['type'] == 'relationship':
+            for ref in [entity['source_ref'], entity['target_ref']]:
+                relationships = self._relationships_by_ref.get(ref)
+                if relationships is not None:
+                    relationships.discard(key)
+                    if not relationships:
+                        del self._relationships_by_ref[ref]
+
+            # Drop the indicator along with its last relationship.
+            if entity['target_ref'] not in self._relationships_by_ref:
+                self._remove(self._key_by_id.get(entity['target_ref']))
+        else:
+            del self._key_by_id[entity['id']]
+            for relationship_key in self._relationships_by_ref.pop(
+                entity['id'], ()
+            ):
+                self._remove(relationship_key)
+
+    def _fits(self, key, entity, size):
+        """Make room for an entity unless it's less important than others."""
+        if entity['type'] == 'relationship':
+            # Relationships of dropped entities must be dropped too.
+            return (
+                entity['source_ref'] in self._key_by_id and
+                entity['target_ref'] in self._key_by_id
+            )
+
+        if entity['type'] != 'sighting':
+            return True
+
+        priority = self._priority(entity)
+
+        while (
+            self._size + size > self.max_size and
+            self._sightings and
+            self._sightings[0][0] < priority
+        ):
+            self._remove(heappop(self._sightings)[2])
+            self.truncated += 1
+
+        if self._size + size > self.max_size:
+            self.truncated += 1
+            return False
+
+        heappush(self._sightings, (priority, next(self._order), key))
+        return True
 
     def add(self, entity):
+        """
+        Add an entity to the bundle unless an equivalent one is already there.
+
+        Return the entity actually stored in the bundle, so that any further
+        references (e.g. from relationships) point to the right entity, or
+        `None` if the entity doesn't fit into the bundle.
+        """
+        key = self._key(entity)
+
+        existing = self._entity_by_key.get(key)
+        if existing is not None:
+            self._merge(existing, entity)
+            if self.max_size is not None and existing['type'] == 'sighting':
+                self._resize(key, self._encode(existing, self.dumps))
+            return existing
+
+        if self.max_size is not None:
+            encoded = self._encode(entity, self.dumps)
+            if not self._fits(key, entity, self._measure(encoded)):
+                return None
+            self._resize(key, encoded)
+
+        self._entity_by_key[key] = entity
+
         # Pluralize the type of an entity to make TR accept it.
         entity_type = entity['type'] + 's'
-        self._entities_by_type[entity_type].append(entity)
+        self._entities_by_type[entity_type][key] = entity
+
+        if entity['type'] == 'relationship':
+            for ref in [entity['source_ref'], entity['target_ref']]:
+                self._relationships_by_ref[ref].add(key)
+        else:
+            self._key_by_id[entity['id']] = key
+
+        return entity
 
     @staticmethod
     def _format_docs(docs):
@@ -17,6 +206,54 @@ class Bundle:
 
     def json(self):
         return {
-            entity_type: self._format_docs(entities)
+            entity_type: self._format_docs(
+                [self._render(entity) for entity in entities.values()]
+            )
             for entity_type, entities in self._entities_by_type.items()
         }
+
+    def stream(self, dumps, sort_keys=True):
+        """
+        Encode the same document as `json` piece by piece (one entity at a
+        time) with the given compact `dumps`, releasing each entity as soon as
+        it is encoded, so the whole document is never held in memory at once.
+        Any already encoded entities are passed through as is.
+
+        The bundle is left empty afterwards.
+        """
+        # The entities are kept encoded the same way (if measured at all).
+        encoded_by_key = self._encoded_by_key if dumps is self.dumps else {}
+        self._encoded_by_key = {}
+
+        self._entity_by_key.clear()
+        self._sightings.clear()
+        self._key_by_id.clear()
+        self._relationships_by_ref.clear()
+
+        entity_types = list(self._entities_by_type)
+        if sort_keys:
+            entity_types.sort()
+
+        yield '{'
+
+        for index, entity_type in enumerate(entity_types):
+            entities = list(self._entities_by_type.pop(entity_type).items())
+
+            if index:
+                yield ','
+            yield f'{dumps(entity_type)}:{{"count":{len(entities)},"docs":['
+
+            # Pop the entities from the end to release them one by one.
+            entities.reverse()
+            separator = ''
+            while entities:
+                key, entity = entities.pop()
+                encoded = encoded_by_key.pop(key, None)
+                if encoded is None:
+                    encoded = self._encode(entity, dumps)
+                yield separator + encoded
+                separator = ','
+
+            yield ']}'
+
+        yield '}'
@@ -0,0 +1,134 @@
+"""
+Compression of responses (negotiated by `Accept-Encoding`) with either
+`brotli` (if installed) or `gzip` (i.e. `zlib`).
+"""
+
+import zlib
+from time import thread_time
+
+from flask import current_app, request
+
+from api.metrics import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _gzip_compressor(level):
+    # Add the gzip header and trailer (rather than the zlib ones).
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def _brotli_compressor(level):
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.finish
+
+
+def _compressors():
+    # In the order of preference.
+    if brotli is not None:
+        yield 'br', _brotli_compressor
+    yield 'gzip', _gzip_compressor
+
+
+def negotiate():
+    """Return the best encoding accepted by the client (if any)."""
+    compressors = dict(_compressors())
+
+    encoding = request.accept_encodings.best_match(list(compressors))
+    if encoding is None:
+        return None, None
+
+    return encoding, compressors[encoding]
+
+
+class _Stats:
+    """Sizes of the data before and after compression and the CPU time."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.original = 0
+        self.compressed = 0
+        self.time = 0
+
+    def report(self):
+        metrics.increment('compression.responses', encoding=self.encoding)
+        metrics.observe(
+            'compression.ratio',
+            self.compressed / self.original if self.original else 1,
+            encoding=self.encoding,
+        )
+        metrics.observe('compression.time', self.time, encoding=self.encoding)
+
+
+def _compress(chunks, compressor, stats):
+    compress, flush = compressor
+
+    for chunk in chunks:
+        start = thread_time()
+        data = compress(chunk)
+        stats.time += thread_time() - start
+
+        stats.original += len(chunk)
+        stats.compressed += len(data)
+
+        # Don't send empty chunks while the compressor is buffering.
+        if data:
+            yield data
+
+    start = thread_time()
+    data = flush()
+    stats.time += thread_time() - start
+
+    stats.compressed += len(data)
+
+    stats.report()
+
+    yield data
+
+
+def compress_response(response):
+    """
+    Compress a successful response if the client accepts any encoding.
+
+    Responses with a known length are only compressed if not too short,
+    streamed ones are compressed chunk by chunk as they are being sent.
+    """
+    config = current_app.config
+
+    if (
+        not config['CTR_COMPRESSION'] or
+        response.status_code != 200 or
+        response.direct_passthrough or
+        'Content-Encoding' in response.headers
+    ):
+        return response
+
+    # The response depends on the header even if it isn't compressed.
+    response.vary.add('Accept-Encoding')
+
+    encoding, factory = negotiate()
+    if encoding is None:
+        return response
+
+    compressor = factory(config['CTR_COMPRESSION_LEVELS'][encoding])
+    stats = _Stats(encoding)
+
+    if response.is_streamed:
+        response.response = _compress(
+            response.iter_encoded(), compressor, stats
+        )
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['CTR_COMPRESSION_THRESHOLD']:
+            return response
+
+        response.set_data(b''.join(_compress([data], compressor, stats)))
+
+    response.headers['Content-Encoding'] = encoding
+
+    return response
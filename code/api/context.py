@@ -0,0 +1,25 @@
+from collections import namedtuple
+
+from api.admission import digest
+
+
+class Context(namedtuple('Context', [
+    'key',
+    'config',
+    'entities_limit',
+    'allow_test_accounts',
+    'aggregate_sightings',
+    'excluded_event_types',
+], defaults=[False, False, ()])):
+    """
+    Request-scoped settings (restored from the JWT) along with the app config.
+
+    The context is passed explicitly to everything serving a request instead
+    of writing any per-request settings into the app config shared by all the
+    concurrent requests, so it is also safe to use in separate worker threads
+    (i.e. without pushing the app context).
+    """
+
+    @property
+    def tenant(self):
+        return digest(self.key or '')
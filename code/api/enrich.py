@@ -1,77 +1,296 @@
-from functools import partial
+import asyncio
 
-from flask import Blueprint, current_app
+from flask import Blueprint, current_app, g, request
 
+from api import offload
+from api.budget import Budget
 from api.bundle import Bundle
+from api.compression import compress_response
+from api.errors import TruncatedResponseWarning
+from api.jsonlib import encoder
 from api.mappings import Sighting, Indicator, Relationship
-from api.schemas import ObservableSchema
-from api.utils import get_json, jsonify_data, jsonify_errors, get_key
-from api.workflow import get_events_for_observable
+from api.utils import (
+    get_observables,
+    jsonify_data,
+    jsonify_errors,
+    get_context,
+    stream_data,
+    get_tenant,
+)
+from api.workflow import (
+    explain_query,
+    get_events_for_observable,
+    get_events_for_observable_async,
+)
 
 enrich_api = Blueprint('enrich', __name__)
 
 
-get_observables = partial(get_json, schema=ObservableSchema(many=True))
+@enrich_api.before_request
+def admit_request():
+    # Make sure that no single tenant can occupy all the workers, so let the
+    # request wait for a while or just shed it if the relay is too busy.
+    if 'admission_ticket' not in g:
+        g.admission_ticket = current_app.extensions['admission'].acquire(
+            get_tenant()
+        )
+
+
+async def admit_request_async():
+    """
+    The same as `admit_request`, but for the ASGI app (which admits requests
+    before running the hooks, so that the waiting doesn't block anything).
+    """
+    controller = current_app.extensions['admission']
+    g.admission_ticket = await controller.acquire_async(get_tenant())
+
+
+@enrich_api.teardown_request
+def release_request(_):
+    if 'admission_ticket' in g:
+        current_app.extensions['admission'].release(g.pop('admission_ticket'))
+
+
+enrich_api.after_request(compress_response)
+
+
+def group_events(events):
+    """
+    Group similar events (i.e. of the same type between the same endpoints
+    detected by the same rule on the same sensor) preserving their order.
+    """
+    events_by_key = {}
+
+    for event in events:
+        key = (
+            event['event_type'],
+            event.get('src', {}).get('ip'),
+            event.get('dst', {}).get('ip'),
+            event['detection']['rule']['uuid']
+            if 'detection' in event else None,
+            event['sensor_id'],
+        )
+        events_by_key.setdefault(key, []).append(event)
+
+    return list(events_by_key.values())
+
+
+def get_supported_observables():
+    return get_observables(current_app.config['GTI_OBSERVABLE_TYPES'])
+
+
+def get_budget(context, observables):
+    return Budget(
+        current_app.config['CTR_ENTITIES_BUDGET'],
+        len(observables),
+        context.entities_limit,
+        strategy=current_app.config['CTR_ENTITIES_BUDGET_STRATEGY'],
+    )
+
+
+def bundle_events(bundle, context, events, indicator_by_rule_uuid):
+    if context.aggregate_sightings:
+        groups = group_events(events)
+    else:
+        groups = [[event] for event in events]
+
+    config = current_app.config
+
+    # Map lots of events in the pool, so they don't hold the GIL.
+    if offload.applies(config, len(events)):
+        records = offload.map_sightings(config, groups)
+    else:
+        records = map(Sighting.record, groups)
+
+    for group, record in zip(groups, records):
+        event = group[0]
+
+        # The bundle may already contain a sighting for the same event
+        # matched by another observable, so use the one actually stored.
+        sighting = bundle.add(record)
+
+        # The bundle is already full of more important sightings.
+        if sighting is None:
+            continue
+
+        if 'detection' in event:
+            rule = event['detection']['rule']
+
+            indicator = indicator_by_rule_uuid.get(rule['uuid'])
+            if indicator is None:
+                indicator = Indicator.map(rule)
+                indicator_by_rule_uuid[rule['uuid']] = indicator
+
+            # The indicator may have been dropped from the full bundle along
+            # with all its sightings, so make sure it's (still) there.
+            indicator = bundle.add(indicator)
+
+            relationship = Relationship.map(sighting, indicator)
+            bundle.add(relationship)
+
+
+async def bundle_events_async(bundle, context, events, indicator_by_rule_uuid):
+    """
+    The same as `bundle_events`, but for the ASGI app (which must not block
+    the event loop while waiting for the events mapped in the pool).
+    """
+    if offload.applies(current_app.config, len(events)):
+        return await asyncio.to_thread(
+            bundle_events, bundle, context, events, indicator_by_rule_uuid
+        )
+
+    return bundle_events(bundle, context, events, indicator_by_rule_uuid)
+
+
+def get_bundle():
+    config = current_app.config
+
+    # Encode the entities the same way as the response (see `stream_data`).
+    return Bundle(
+        max_size=config['CTR_RESPONSE_SIZE_LIMIT'],
+        dumps=encoder(config['JSON_SORT_KEYS'], config['JSON_AS_ASCII']),
+    )
+
+
+def get_warnings(bundle):
+    warnings = []
+
+    if bundle.truncated:
+        warning = TruncatedResponseWarning(
+            f'{bundle.truncated} sightings omitted'
+        )
+        current_app.logger.warning(warning.message)
+        warnings.append(warning.json())
+
+    return warnings
+
+
+def respond_with(bundle):
+    warnings = get_warnings(bundle)
+
+    if current_app.config['CTR_STREAMING_RESPONSE']:
+        return stream_data(bundle, warnings=warnings)
+
+    # Reuse any entities already encoded (e.g. while measuring them).
+    return stream_data(bundle, warnings=warnings, streamed=False)
+
+
+def explain_requested():
+    return (
+        current_app.config['GTI_QUERY_PLAN_EXPLAIN'] and
+        'explain' in request.args
+    )
+
+
+def explain_observables(context, observables):
+    budget = get_budget(context, observables)
+
+    plans = []
+
+    for observable in observables:
+        if budget.exhausted:
+            break
+
+        allocation = budget.allocate()
+
+        plans.append(explain_query(context, observable, allocation))
+
+        # Assume that each observable takes up its whole share.
+        budget.spend(allocation.share)
+
+    return plans
 
 
 @enrich_api.route('/observe/observables', methods=['POST'])
 def observe_observables():
-    observables, error = get_observables()
+    observables, error = get_supported_observables()
 
     if error:
         return jsonify_errors(error)
 
-    observable_types = current_app.config['GTI_OBSERVABLE_TYPES']
+    context = get_context()
 
-    observables = [
-        observable
-        for observable in observables
-        if observable['type'] in observable_types
-    ]
+    if explain_requested():
+        plans = explain_observables(context, observables)
+        return jsonify_data({'plans': plans})
+
+    budget = get_budget(context, observables)
 
-    key = get_key()
+    bundle = get_bundle()
 
-    bundle = Bundle()
+    # Different observables may share the same rules (as well as events), so
+    # make sure to map each rule only once across the whole request.
+    indicator_by_rule_uuid = {}
 
     for observable in observables:
-        events, error = get_events_for_observable(key, observable)
+        # Don't query the GTI API any further once the whole budget is spent.
+        if budget.exhausted:
+            break
+
+        events, error = get_events_for_observable(
+            context, observable, budget.allocate()
+        )
 
         if error:
             # Make sure not to lose any data processed so far.
             return jsonify_errors(error, data=bundle.json())
 
-        indicator_by_rule_uuid = {}
+        budget.spend(len(events))
 
-        for event in events:
-            sighting = Sighting.map(event)
-            bundle.add(sighting)
+        bundle_events(bundle, context, events, indicator_by_rule_uuid)
 
-            if 'detection' in event:
-                rule = event['detection']['rule']
+    return respond_with(bundle)
 
-                indicator = indicator_by_rule_uuid.get(rule['uuid'])
-                if indicator is None:
-                    indicator = Indicator.map(rule)
-                    indicator_by_rule_uuid[rule['uuid']] = indicator
-                    bundle.add(indicator)
 
-                relationship = Relationship.map(sighting, indicator)
-                bundle.add(relationship)
+async def observe_observables_async():
+    """The same as `observe_observables`, but for the ASGI app."""
+    observables, error = get_supported_observables()
 
-    data = bundle.json()
+    if error:
+        return jsonify_errors(error)
 
-    return jsonify_data(data)
+    # Validating the JWT may require fetching the public key.
+    context = await asyncio.to_thread(get_context)
+
+    if explain_requested():
+        plans = explain_observables(context, observables)
+        return jsonify_data({'plans': plans})
+
+    budget = get_budget(context, observables)
+
+    bundle = get_bundle()
+
+    indicator_by_rule_uuid = {}
+
+    for observable in observables:
+        if budget.exhausted:
+            break
+
+        events, error = await get_events_for_observable_async(
+            context, observable, budget.allocate()
+        )
+
+        if error:
+            return jsonify_errors(error, data=bundle.json())
+
+        budget.spend(len(events))
+
+        await bundle_events_async(
+            bundle, context, events, indicator_by_rule_uuid
+        )
+
+    return respond_with(bundle)
 
 
 @enrich_api.route('/refer/observables', methods=['POST'])
 def refer_observables():
-    observables, error = get_observables()
+    observable_types = current_app.config['GTI_OBSERVABLE_TYPES']
+
+    observables, error = get_observables(observable_types)
 
     if error:
         return jsonify_errors(error)
 
-    observable_types = current_app.config['GTI_OBSERVABLE_TYPES']
-
     def type_of(observable):
         return observable_types[observable['type']]
 
@@ -89,7 +308,11 @@ def refer_observables():
             'categories': ['Search', 'Gigamon ThreatINSIGHT'],
         }
         for observable in observables
-        if observable['type'] in observable_types
     ]
 
     return jsonify_data(data)
+
+
+async def refer_observables_async():
+    """The same as `refer_observables` (which doesn't do any I/O at all)."""
+    return refer_observables()
@@ -32,3 +32,14 @@ class AuthenticationRequiredError(RelayError):
 class WatchdogError(RelayError):
     CODE = 'health check failed'
     MESSAGE = 'Invalid Health Check'
+
+
+class TooManyRequestsError(RelayError):
+    CODE = 'too many requests'
+    MESSAGE = 'The relay is busy'
+
+
+class TruncatedResponseWarning(RelayError):
+    CODE = 'response truncated'
+    MESSAGE = 'The response exceeded the size limit'
+    TYPE = 'warning'
@@ -1,18 +1,35 @@
+import asyncio
+
 from flask import Blueprint, current_app
 
+from api import integration_async
 from api.integration import get_events
-from api.utils import get_key, jsonify_errors, jsonify_data
+from api.utils import get_context, jsonify_errors, jsonify_data
 
 health_api = Blueprint('health', __name__)
 
 
 @health_api.route('/health', methods=['POST'])
 def health():
-    key = get_key()
+    context = get_context()
 
     # Use some supported entity just to check that the GTI API key is valid.
     observable = current_app.config['GTI_TEST_ENTITY']
-    _, error = get_events(key, observable)
+    _, error = get_events(context, observable)
+
+    if error:
+        return jsonify_errors(error)
+    else:
+        return jsonify_data({'status': 'ok'})
+
+
+async def health_async():
+    """The same as `health`, but for the ASGI app."""
+    # Validating the JWT may require fetching the public key.
+    context = await asyncio.to_thread(get_context)
+
+    observable = current_app.config['GTI_TEST_ENTITY']
+    _, error = await integration_async.get_events(context, observable)
 
     if error:
         return jsonify_errors(error)
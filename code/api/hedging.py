@@ -0,0 +1,217 @@
+"""
+Hedged requests for the idempotent calls to the GTI API.
+
+If a call takes longer than the recent 95th percentile of the latencies of
+its endpoint, an identical call is sent and whichever finishes first wins.
+Hedging is limited by a global budget, so it never amplifies the load much
+(e.g. when the GTI API is slow across the board).
+"""
+
+import asyncio
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures,
+)
+from math import ceil
+from threading import Event, Lock
+from time import monotonic
+
+from api.metrics import metrics
+
+
+class LatencyTracker:
+    """Rolling window of the latest latencies of calls to one endpoint."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+
+        self._lock = Lock()
+        self._latencies = deque(maxlen=window)
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percent):
+        """Return `None` until there are enough samples to rely on."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+
+        return latencies[ceil(len(latencies) * percent / 100) - 1]
+
+
+class HedgeBudget:
+    """
+    Token bucket which every call adds a fraction of a token to and every
+    hedge takes a whole token from, so hedges can make at most that fraction
+    of all the calls (plus a small burst capped by the bucket size).
+    """
+
+    def __init__(self, ratio, capacity=10):
+        self.ratio = ratio
+        self.capacity = capacity
+
+        self._lock = Lock()
+        self._tokens = 0
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Hedger:
+    """Latencies of the endpoints along with the budget shared by them."""
+
+    def __init__(self, ratio, percent=95, workers=None):
+        self.percent = percent
+        self.budget = HedgeBudget(ratio)
+
+        # Enough threads for the attempts of all the concurrent calls (and
+        # their hedges), so that hedging never caps the upstream concurrency.
+        self.workers = workers
+
+        self._lock = Lock()
+        self._trackers = {}
+        self._executor = None
+
+    def _tracker(self, endpoint):
+        with self._lock:
+            tracker = self._trackers.get(endpoint)
+            if tracker is None:
+                tracker = self._trackers[endpoint] = LatencyTracker()
+            return tracker
+
+    def _delay(self, endpoint):
+        self.budget.deposit()
+        return self._tracker(endpoint).percentile(self.percent)
+
+    def _hedge(self, endpoint):
+        if not self.budget.withdraw():
+            metrics.increment('hedging.exhausted', endpoint=endpoint)
+            return False
+
+        metrics.increment('hedging.hedged', endpoint=endpoint)
+        return True
+
+    @staticmethod
+    def _winner(results):
+        # Prefer any successful result, i.e. `(data, error)` with no error.
+        for result in results:
+            if not result[1]:
+                return result
+        return result
+
+    def _timed(self, endpoint, function, *args, **kwargs):
+        start = monotonic()
+        result = function(*args, **kwargs)
+        self._tracker(endpoint).record(monotonic() - start)
+        return result
+
+    def call(self, endpoint, function, *args, **kwargs):
+        """Call a function returning `(data, error)` hedging it if slow."""
+        delay = self._delay(endpoint)
+        if delay is None:
+            return self._timed(endpoint, function, *args, **kwargs)
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='gti-hedging'
+                )
+
+        started = Event()
+
+        def first_attempt():
+            started.set()
+            return self._timed(endpoint, function, *args, **kwargs)
+
+        attempts = [self._executor.submit(first_attempt)]
+
+        # Only the time actually spent on the call counts towards the delay
+        # (i.e. not any time spent waiting for a free thread).
+        started.wait()
+
+        done, _ = wait_futures(attempts, timeout=delay)
+        if not done and self._hedge(endpoint):
+            attempts.append(self._executor.submit(
+                self._timed, endpoint, function, *args, **kwargs
+            ))
+
+        # The loser can't be cancelled, so just let it finish in background.
+        pending = set(attempts)
+        results = []
+        while pending:
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            results.extend(future.result() for future in done)
+            if not self._winner(results)[1]:
+                break
+
+        return self._winner(results)
+
+    async def _timed_async(self, endpoint, function, *args, **kwargs):
+        start = monotonic()
+        result = await function(*args, **kwargs)
+        self._tracker(endpoint).record(monotonic() - start)
+        return result
+
+    async def call_async(self, endpoint, function, *args, **kwargs):
+        """Asynchronous counterpart of `call` (awaiting the function)."""
+        delay = self._delay(endpoint)
+        if delay is None:
+            return await self._timed_async(endpoint, function, *args, **kwargs)
+
+        attempts = {asyncio.create_task(
+            self._timed_async(endpoint, function, *args, **kwargs)
+        )}
+
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if not done and self._hedge(endpoint):
+            attempts.add(asyncio.create_task(
+                self._timed_async(endpoint, function, *args, **kwargs)
+            ))
+
+        pending = attempts
+        results = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                results.extend(task.result() for task in done)
+                if not self._winner(results)[1]:
+                    break
+        finally:
+            # Unlike threads, the loser can be simply cancelled.
+            for task in pending:
+                task.cancel()
+
+        return self._winner(results)
+
+
+_hedger = None
+_hedger_lock = Lock()
+
+
+def get_hedger(config):
+    """Get the hedger shared by all the requests in the current process."""
+    global _hedger
+
+    with _hedger_lock:
+        if _hedger is None:
+            _hedger = Hedger(
+                config['GTI_HEDGING_BUDGET'],
+                # The calls are made by the upstream workers (plus a hedge
+                # per each of them at most).
+                workers=config['GTI_UPSTREAM_WORKERS'] * 2,
+            )
+
+    return _hedger
@@ -1,93 +1,147 @@
 from collections import defaultdict
+from contextlib import closing
 from http import HTTPStatus
+from itertools import islice
 from ssl import SSLCertVerificationError
 import datetime
 
 import requests
 from requests.exceptions import SSLError
-from flask import current_app
 from urllib.parse import urljoin
 
+from api.hedging import get_hedger
+from api.jsonlib import loads
+from api.mappings import EVENT_FIELDS
+from api.streaming import ArrayItemsParser
 
-def _url(family, route):
-    return urljoin(current_app.config['GTI_API_FAMILY_URLS'][family], route)
+# Mimic the GTI API error response payload.
+INVALID_AUTHENTICATION_ERROR = {
+    'code': 'client.invalid_authentication',
+    'message': 'Authentication is invalid.',
+}
 
+INVALID_AUTHORIZATION_HEADER_ERROR = {
+    'code': 'client.invalid_authentication',
+    'message': 'Authorization failed: Invalid Authorization header',
+}
 
-def _headers(key):
+# Size of chunks of response payloads to parse at a time when streaming.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _url(context, family, route):
+    return urljoin(context.config['GTI_API_FAMILY_URLS'][family], route)
+
+
+def _headers(context):
     return {
-        'Authorization': f'IBToken {key}',
-        'User-Agent': current_app.config['CTR_USER_AGENT'],
+        'Authorization': f'IBToken {context.key}',
+        'User-Agent': context.config['CTR_USER_AGENT'],
     }
 
 
-def _request(method, url, **kwargs):
-    key = kwargs.pop('key', None)
+def _ssl_error(error):
+    # Assume that a certificate could not be verified.
+    assert isinstance(error, SSLCertVerificationError)
+    reason = getattr(error, 'verify_message', error.args[0]).capitalize()
+    return {
+        'code': 'ssl certificate verification failed',
+        'message': f'Unable to verify SSL certificate: {reason}.',
+    }
 
-    if key is None:
-        # Mimic the GTI API error response payload.
-        error = {
-            'code': 'client.invalid_authentication',
-            'message': 'Authentication is invalid.',
-        }
-        return None, error
 
-    kwargs['headers'] = _headers(key)
+def _response_error(status_code, payload):
+    error = payload['error']
+    # The GTI API error response payload is already well formatted,
+    # so just leave only the fields of interest and discard the rest.
+    if status_code in (HTTPStatus.UNAUTHORIZED, HTTPStatus.FORBIDDEN):
+        message = f'Authorization failed: {error["message"]}'
+    else:
+        message = error['message']
+
+    return {
+        'code': error['code'],
+        'message': message,
+    }
+
+
+def _response(context, method, url, **kwargs):
+    if context.key is None:
+        return None, dict(INVALID_AUTHENTICATION_ERROR)
+
+    kwargs['headers'] = _headers(context)
 
     try:
         response = requests.request(method, url, **kwargs)
     except SSLError as error:
         # Go through a few layers of wrapped exceptions.
-        error = error.args[0].reason.args[0]
-        # Assume that a certificate could not be verified.
-        assert isinstance(error, SSLCertVerificationError)
-        reason = getattr(error, 'verify_message', error.args[0]).capitalize()
-        error = {
-            'code': 'ssl certificate verification failed',
-            'message': f'Unable to verify SSL certificate: {reason}.',
-        }
-        return None, error
+        return None, _ssl_error(error.args[0].reason.args[0])
 
     except UnicodeEncodeError:
-        error = {
-            'code': 'client.invalid_authentication',
-            'message': 'Authorization failed: Invalid Authorization header',
-        }
-        return None, error
+        return None, dict(INVALID_AUTHORIZATION_HEADER_ERROR)
 
     if response.ok:
-        return response.json(), None
+        return response, None
 
     else:
-        error = response.json()['error']
-        # The GTI API error response payload is already well formatted,
-        # so just leave only the fields of interest and discard the rest.
-        if response.status_code in (HTTPStatus.UNAUTHORIZED,
-                                    HTTPStatus.FORBIDDEN):
-            message = f'Authorization failed: {error["message"]}'
-        else:
-            message = error['message']
-
-        error = {
-            'code': error['code'],
-            'message': message,
-        }
+        return None, _response_error(
+            response.status_code, loads(response.content)
+        )
+
+
+def _request(context, method, url, **kwargs):
+    response, error = _response(context, method, url, **kwargs)
+
+    if error:
         return None, error
 
+    return loads(response.content), None
 
-def get_detections_for_entity(key, entity):
-    url = _url('detection', 'detections')
 
-    params = {
+def _items(response, key):
+    parser = ArrayItemsParser(key)
+
+    # Closing the generator early (e.g. once enough items are taken) also
+    # closes the connection without downloading the rest of the payload.
+    with closing(response):
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+            yield from parser.feed(chunk)
+
+        yield from parser.close()
+
+
+def _request_items(context, method, url, key, **kwargs):
+    """
+    The same as `_request`, but parse the response payload incrementally
+    yielding the items of its array under the given key one at a time.
+    """
+    response, error = _response(context, method, url, stream=True, **kwargs)
+
+    if error:
+        return None, error
+
+    return _items(response, key), None
+
+
+def _get(context, endpoint, url, params):
+    # Only idempotent calls are safe to hedge.
+    if context.config['GTI_HEDGING']:
+        return get_hedger(context.config).call(
+            endpoint, _request, context, 'GET', url, params=params
+        )
+
+    return _request(context, 'GET', url, params=params)
+
+
+def _detections_params(entity):
+    return {
         'indicator_value': entity,
         'status': 'active',
         'include': ['indicators', 'rules'],
     }
 
-    data, error = _request('GET', url, key=key, params=params)
-
-    if error:
-        return None, error
 
+def _detections(data):
     detections = data['detections']
 
     for detection in detections:
@@ -99,86 +153,174 @@ def get_detections_for_entity(key, entity):
             if rule['uuid'] == rule_uuid
         )
 
-    return detections, None
+    return detections
+
 
+def get_detections_for_entity(context, entity):
+    url = _url(context, 'detection', 'detections')
 
-def get_events_for_detection(key, detection_uuid):
-    url = _url('detection', 'events')
+    params = _detections_params(entity)
 
+    data, error = _get(context, 'detections', url, params)
+
+    if error:
+        return None, error
+
+    return _detections(data), None
+
+
+def _events_for_detection_params(context, detection_uuid,
+                                 indicator_value=None, limit=None):
     params = {
         'detection_uuid': detection_uuid,
     }
 
-    data, error = _request('GET', url, key=key, params=params)
+    # Let the GTI API filter out (and truncate) the events of detections with
+    # large histories instead of transferring and parsing all of them. The
+    # events still get matched against the indicator value client-side.
+    if context.config['GTI_DETECTION_EVENTS_PUSH_DOWN']:
+        if indicator_value is not None:
+            params['indicator_value'] = indicator_value
+
+        if limit is not None:
+            params['limit'] = limit
+
+        start_date = datetime.datetime.now() - datetime.timedelta(
+            days=context.config['DAY_RANGE']
+        )
+        params['start_date'] = mil_time(start_date.isoformat())
+
+    return params
+
+
+def _events_for_detection(data):
+    return [event['event'] for event in data['events']]
+
+
+def get_events_for_detection(context, detection_uuid,
+                             indicator_value=None, limit=None):
+    url = _url(context, 'detection', 'events')
+
+    params = _events_for_detection_params(
+        context, detection_uuid, indicator_value, limit
+    )
+
+    data, error = _get(context, 'events', url, params)
 
     if error:
         return None, error
 
-    events = [event['event'] for event in data['events']]
-
-    return events, None
+    return _events_for_detection(data), None
 
 
 def mil_time(date):
     return str(date)[:-3]+'Z'
 
 
-def get_events(key, observable, event_uuids=None):
-    if not event_uuids:
-        event_uuids = set()
-    url = _url('event', 'query')
+def _events_queries(context, observable, day_range=None):
+    """
+    Yield one events query per day going back in time from now on (for the
+    given number of days or the configured one).
+
+    The GTI API is queried for one day at a time in order to be able to stop
+    as soon as enough events are collected.
+    """
+    query = f"{observable['type']} = '{observable['value']}'"
+    for event_type in context.excluded_event_types:
+        query += f" AND event_type != '{event_type}'"
 
-    limit = current_app.config['CTR_ENTITIES_LIMIT'] - len(event_uuids)
-    events = []
     now = datetime.datetime.now()
     end_date = now.isoformat()
     start_date = (now - datetime.timedelta(days=1)).isoformat()
-    day_range = current_app.config['DAY_RANGE']
-    while day_range and len(events) < limit:
+    if day_range is None:
+        day_range = context.config['DAY_RANGE']
+    while day_range:
         json = {
-            'query': f"{observable['type']} = '{observable['value']}'",
+            'query': query,
             'start_date': mil_time(start_date),
             'end_date': mil_time(end_date)
         }
-        data, error = _request('POST', url, key=key, json=json)
-        if error:
-            return None, error
+        if context.config['GTI_EVENTS_QUERY_PROJECTION']:
+            json['fields'] = list(EVENT_FIELDS)
+        yield json
         end_date, start_date = start_date, (
             datetime.datetime.fromisoformat(start_date) -
             datetime.timedelta(days=1)
         ).isoformat()
-        events.extend(event for event in data['events'] if
-                      event['uuid'] not in event_uuids and is_allowed(
-                          event['customer_id'])
-                      )
         day_range -= 1
 
-    return events, None
 
+def _event_filter(context, event_uuids):
+    """
+    Build a predicate telling apart the events not seen yet (by their UUIDs)
+    coming from allowed accounts, with everything it needs looked up once.
+    """
+    excluded_accounts = _excluded_accounts(context)
+
+    def wanted(event):
+        return (
+            event['uuid'] not in event_uuids and
+            event['customer_id'] not in excluded_accounts
+        )
+
+    return wanted
+
+
+def _events(context, events, event_uuids):
+    return filter(_event_filter(context, event_uuids), events)
+
+
+def _events_query(context, url, json):
+    # Either parse events one by one as they come, or all of them at once.
+    if context.config['GTI_STREAMING_PARSE']:
+        return _request_items(context, 'POST', url, 'events', json=json)
+
+    data, error = _request(context, 'POST', url, json=json)
+
+    if error:
+        return None, error
+
+    return (event for event in data['events']), None
+
+
+def get_events(context, observable, event_uuids=None, limit=None,
+               day_range=None):
+    if not event_uuids:
+        event_uuids = set()
+    url = _url(context, 'event', 'query')
+
+    if limit is None:
+        limit = context.entities_limit - len(event_uuids)
+    events = []
+    for json in _events_queries(context, observable, day_range):
+        if len(events) >= limit:
+            break
+        items, error = _events_query(context, url, json)
+        if error:
+            return None, error
+        with closing(items):
+            events.extend(islice(
+                _events(context, items, event_uuids), limit - len(events)
+            ))
+
+    return events, None
 
-def get_dhcp_records_by_ip(key, event_time_by_ip):
-    url = _url('entity', 'entity/tracking/bulk/get/ip')
 
+def _dhcp_records_json(event_time_by_ip):
     entities = [
         {'ip': ip, 'event_time': event_time}
         for ip, event_time in event_time_by_ip.items()
     ]
 
     if not entities:
-        # Let's immediately return an empty dict here to simplify further
-        # processing. Even if we make a real request to the GTI API instead,
-        # it will fail with a message like 'No entities specified.' anyway.
-        return {}, None
+        return None
 
-    json = {
+    return {
         'entities': entities,
     }
 
-    data, error = _request('POST', url, key=key, json=json)
-
-    if error:
-        return None, error
 
+def _dhcp_records_by_ip(data):
     dhcp_records = data['entity_tracking_bulk_response']['dhcp']
 
     dhcp_records_by_ip = defaultdict(list)
@@ -186,11 +328,33 @@ def get_dhcp_records_by_ip(key, event_time_by_ip):
     for record in dhcp_records:
         dhcp_records_by_ip[record['ip']].append(record)
 
-    return dhcp_records_by_ip, None
+    return dhcp_records_by_ip
 
 
-def is_allowed(account: str) -> bool:
-    return (
-        current_app.config['GTI_ALLOW_TEST_ACCOUNTS'] or
-        account not in current_app.config['GTI_TEST_ACCOUNTS']
-    )
+def get_dhcp_records_by_ip(context, event_time_by_ip):
+    url = _url(context, 'entity', 'entity/tracking/bulk/get/ip')
+
+    json = _dhcp_records_json(event_time_by_ip)
+
+    if json is None:
+        # Let's immediately return an empty dict here to simplify further
+        # processing. Even if we make a real request to the GTI API instead,
+        # it will fail with a message like 'No entities specified.' anyway.
+        return {}, None
+
+    data, error = _request(context, 'POST', url, json=json)
+
+    if error:
+        return None, error
+
+    return _dhcp_records_by_ip(data), None
+
+
+def _excluded_accounts(context):
+    if context.allow_test_accounts:
+        return frozenset()
+    return context.config['GTI_TEST_ACCOUNTS']
+
+
+def is_allowed(context, account: str) -> bool:
+    return account not in _excluded_accounts(context)
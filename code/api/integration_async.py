@@ -0,0 +1,300 @@
+"""
+Asynchronous counterparts of the functions from `api.integration`.
+
+All the functions have the same signatures and `(data, error)` contracts as
+their synchronous counterparts, but multiplex any number of concurrent calls
+to the GTI API on one event loop per worker (instead of one thread per call).
+"""
+
+import asyncio
+from threading import Lock, Thread
+
+import aiohttp
+
+from api.hedging import get_hedger
+from api.jsonlib import loads
+from api.streaming import ArrayItemsParser
+from api.integration import (
+    INVALID_AUTHENTICATION_ERROR,
+    INVALID_AUTHORIZATION_HEADER_ERROR,
+    STREAM_CHUNK_SIZE,
+    _url,
+    _headers,
+    _ssl_error,
+    _response_error,
+    _detections_params,
+    _detections,
+    _events_for_detection_params,
+    _events_for_detection,
+    _events_queries,
+    _event_filter,
+    _dhcp_records_json,
+    _dhcp_records_by_ip,
+)
+
+_loop = None
+_loop_lock = Lock()
+
+# Sessions can't be shared by different event loops (e.g. the one started
+# here for the synchronous code and the one of an ASGI server).
+_session_by_loop = {}
+
+
+def _event_loop():
+    global _loop
+
+    # The loop is started lazily (i.e. only in a worker already forked from
+    # the master process) and keeps running in a separate daemon thread.
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            Thread(
+                target=_loop.run_forever, name='gti-event-loop', daemon=True
+            ).start()
+
+    return _loop
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine on the event loop of the current worker and wait for it.
+
+    This is a thin bridge allowing to call the asynchronous functions from
+    the synchronous code (e.g. Flask views) running in any other thread.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop()).result()
+
+
+class _Response:
+    """The bare minimum of `requests.Response` used by `_request`."""
+
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.payload = payload
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.payload
+
+
+def _params(params):
+    # Unlike `requests`, `aiohttp` doesn't expand lists into repeated params.
+    return [
+        (name, item)
+        for name, value in params.items()
+        for item in (value if isinstance(value, list) else [value])
+    ]
+
+
+def _session(context):
+    # The session (along with its pool of connections) is shared by all the
+    # requests made on the event loop of the current worker.
+    loop = asyncio.get_running_loop()
+
+    session = _session_by_loop.get(loop)
+    if session is None:
+        session = _session_by_loop[loop] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=context.config['GTI_ASYNC_CONNECTIONS_LIMIT'],
+            ),
+        )
+
+    return session
+
+
+async def close_session():
+    """Close the session used on the current event loop (if any)."""
+    session = _session_by_loop.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def _send(context, method, url, **kwargs):
+    if 'params' in kwargs:
+        kwargs['params'] = _params(kwargs['params'])
+
+    async with _session(context).request(method, url, **kwargs) as response:
+        return _Response(response.status, await response.json(
+            content_type=None, loads=loads
+        ))
+
+
+async def _open(context, method, url, **kwargs):
+    # Unlike `_send`, leave the payload of the response to read by the caller.
+    if 'params' in kwargs:
+        kwargs['params'] = _params(kwargs['params'])
+
+    return await _session(context).request(method, url, **kwargs)
+
+
+async def _response(context, method, url, send, **kwargs):
+    if context.key is None:
+        return None, dict(INVALID_AUTHENTICATION_ERROR)
+
+    kwargs['headers'] = _headers(context)
+
+    try:
+        # Unlike `requests`, `aiohttp` doesn't reject headers which can't be
+        # encoded with Latin-1, so let's check that explicitly.
+        for value in kwargs['headers'].values():
+            value.encode('latin-1')
+
+        response = await send(context, method, url, **kwargs)
+    except aiohttp.ClientConnectorCertificateError as error:
+        return None, _ssl_error(error.certificate_error)
+
+    except UnicodeEncodeError:
+        return None, dict(INVALID_AUTHORIZATION_HEADER_ERROR)
+
+    return response, None
+
+
+async def _request(context, method, url, **kwargs):
+    response, error = await _response(context, method, url, _send, **kwargs)
+
+    if error:
+        return None, error
+
+    if response.ok:
+        return response.json(), None
+
+    else:
+        return None, _response_error(response.status_code, response.json())
+
+
+async def _items(response, key):
+    parser = ArrayItemsParser(key)
+
+    try:
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            for item in parser.feed(chunk):
+                yield item
+
+        for item in parser.close():
+            yield item
+    finally:
+        if parser.done:
+            response.release()
+        else:
+            # Don't download the rest of the payload (if closed early).
+            response.close()
+
+
+async def _request_items(context, method, url, key, **kwargs):
+    """The same as `api.integration._request_items`, but asynchronous."""
+    response, error = await _response(context, method, url, _open, **kwargs)
+
+    if error:
+        return None, error
+
+    if response.status >= 400:
+        try:
+            payload = await response.json(content_type=None, loads=loads)
+        finally:
+            response.release()
+
+        return None, _response_error(response.status, payload)
+
+    return _items(response, key), None
+
+
+async def _get(context, endpoint, url, params):
+    if context.config['GTI_HEDGING']:
+        return await get_hedger(context.config).call_async(
+            endpoint, _request, context, 'GET', url, params=params
+        )
+
+    return await _request(context, 'GET', url, params=params)
+
+
+async def get_detections_for_entity(context, entity):
+    url = _url(context, 'detection', 'detections')
+
+    params = _detections_params(entity)
+
+    data, error = await _get(context, 'detections', url, params)
+
+    if error:
+        return None, error
+
+    return _detections(data), None
+
+
+async def get_events_for_detection(context, detection_uuid,
+                                   indicator_value=None, limit=None):
+    url = _url(context, 'detection', 'events')
+
+    params = _events_for_detection_params(
+        context, detection_uuid, indicator_value, limit
+    )
+
+    data, error = await _get(context, 'events', url, params)
+
+    if error:
+        return None, error
+
+    return _events_for_detection(data), None
+
+
+async def _iterate(items):
+    for item in items:
+        yield item
+
+
+async def _events_query(context, url, json):
+    if context.config['GTI_STREAMING_PARSE']:
+        return await _request_items(context, 'POST', url, 'events', json=json)
+
+    data, error = await _request(context, 'POST', url, json=json)
+
+    if error:
+        return None, error
+
+    return _iterate(data['events']), None
+
+
+async def get_events(context, observable, event_uuids=None, limit=None,
+                     day_range=None):
+    if not event_uuids:
+        event_uuids = set()
+    url = _url(context, 'event', 'query')
+
+    if limit is None:
+        limit = context.entities_limit - len(event_uuids)
+    wanted = _event_filter(context, event_uuids)
+    events = []
+    for json in _events_queries(context, observable, day_range):
+        if len(events) >= limit:
+            break
+        items, error = await _events_query(context, url, json)
+        if error:
+            return None, error
+        try:
+            async for event in items:
+                if wanted(event):
+                    events.append(event)
+                    if len(events) >= limit:
+                        break
+        finally:
+            await items.aclose()
+
+    return events, None
+
+
+async def get_dhcp_records_by_ip(context, event_time_by_ip):
+    url = _url(context, 'entity', 'entity/tracking/bulk/get/ip')
+
+    json = _dhcp_records_json(event_time_by_ip)
+
+    if json is None:
+        return {}, None
+
+    data, error = await _request(context, 'POST', url, json=json)
+
+    if error:
+        return None, error
+
+    return _dhcp_records_by_ip(data), None
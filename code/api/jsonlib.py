@@ -0,0 +1,233 @@
+"""
+Fast JSON encoding/decoding with `orjson` (if available) falling back to the
+standard `json` module otherwise.
+
+The output is exactly the same as the one of the standard `json` module (with
+the same options), since `orjson` is only used when that's guaranteed and any
+other cases are just left to the standard `json` module.
+"""
+
+import codecs
+import json
+import math
+import re
+from functools import lru_cache, partial
+
+from flask import current_app
+from flask.json import JSONDecoder as FlaskJSONDecoder
+from flask.json import JSONEncoder as FlaskJSONEncoder
+from flask.json import jsonify as flask_jsonify
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Let the default hooks of the standard `json` module handle these types.
+_ORJSON_OPTIONS = (
+    orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    if orjson is not None else 0
+)
+
+# Floats formatted differently by `orjson` and the standard `json` module,
+# i.e. either in the exponent notation (which is followed by a separator,
+# so things like hashes don't match), or too small ones (e.g. 0.00001).
+# Some strings may still match, which only results in a fallback though.
+_EXPONENT_FLOAT = re.compile(rb'e-?[0-9]+[,\]}]')
+_SMALL_FLOAT = b'0.0000'
+
+# `orjson` encodes NaN and (-)Infinity as null (unlike the standard `json`
+# module), so look for them only if there are any nulls in the output.
+_NULL = b'null'
+
+
+# `orjson` silently turns integers exceeding 64 bits into floats (unlike the
+# standard `json` module), so leave any long enough numbers to the latter.
+_LONG_NUMBER = re.compile(r'(?:^|[:,\[])\s*-?[0-9]{19}')
+_LONG_NUMBER_BYTES = re.compile(rb'(?:^|[:,\[])\s*-?[0-9]{19}')
+
+
+def _escape(code):
+    if code < 0x10000:
+        return f'\\u{code:04x}'
+
+    # Use surrogate pairs just like the standard `json` module does.
+    code -= 0x10000
+    high = 0xd800 | (code >> 10)
+    low = 0xdc00 | (code & 0x3ff)
+    return f'\\u{high:04x}\\u{low:04x}'
+
+
+def _escape_error(error):
+    chars = error.object[error.start:error.end]
+    return ''.join(_escape(ord(char)) for char in chars), error.end
+
+
+# Escape any non-ASCII characters while encoding into ASCII (which is way
+# faster than substituting them with a regex, since most of them are ASCII).
+codecs.register_error('jsonlib.escape', _escape_error)
+
+
+def _non_finite(obj):
+    """Tell whether there are any NaN or (-)Infinity floats in an object."""
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(map(_non_finite, obj.values()))
+    if isinstance(obj, (list, tuple)):
+        return any(map(_non_finite, obj))
+    return False
+
+
+def _orjson_dumps(obj, default, sort_keys, ensure_ascii):
+    """
+    Return the output as bytes, or `None` if it may differ from the standard
+    one (in which case the standard `json` module should be used instead).
+    """
+    if isinstance(obj, float):
+        return None
+
+    options = _ORJSON_OPTIONS
+    if sort_keys:
+        options |= orjson.OPT_SORT_KEYS
+
+    try:
+        data = orjson.dumps(obj, default=default, option=options)
+    except (orjson.JSONEncodeError, TypeError):
+        # E.g. non-string keys or integers exceeding 64 bits.
+        return None
+
+    if _SMALL_FLOAT in data or _EXPONENT_FLOAT.search(data):
+        return None
+
+    if _NULL in data and _non_finite(obj):
+        return None
+
+    if ensure_ascii:
+        if not data.isascii():
+            data = data.decode().encode('ascii', 'jsonlib.escape')
+
+        # Note that DEL is also escaped by the standard `json` module.
+        if b'\x7f' in data:
+            data = data.replace(b'\x7f', b'\\u007f')
+
+    return data
+
+
+def dumps(obj, sort_keys=True, ensure_ascii=True):
+    """The same as `json.dumps` with compact separators, but faster."""
+    if orjson is not None:
+        data = _orjson_dumps(obj, None, sort_keys, ensure_ascii)
+        if data is not None:
+            return data.decode()
+
+    return json.dumps(
+        obj,
+        sort_keys=sort_keys,
+        ensure_ascii=ensure_ascii,
+        separators=(',', ':'),
+    )
+
+
+@lru_cache(maxsize=None)
+def encoder(sort_keys=True, ensure_ascii=True):
+    """
+    Return `dumps` with the given options (always the same function for the
+    same options, so it can be told whether things were encoded the same way).
+    """
+    return partial(dumps, sort_keys=sort_keys, ensure_ascii=ensure_ascii)
+
+
+_FALLBACK = object()
+
+
+def _orjson_loads(data):
+    """Return `_FALLBACK` if the result may differ from the standard one."""
+    if isinstance(data, str):
+        if _LONG_NUMBER.search(data):
+            return _FALLBACK
+    elif _LONG_NUMBER_BYTES.search(data):
+        return _FALLBACK
+
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # E.g. NaN, so just let the standard `json` module either parse it or
+        # raise its own error.
+        return _FALLBACK
+
+
+def loads(data):
+    """The same as `json.loads`, but faster."""
+    if orjson is not None:
+        obj = _orjson_loads(data)
+        if obj is not _FALLBACK:
+            return obj
+
+    return json.loads(data)
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    """Flask JSON encoder switching to `orjson` for compact output."""
+
+    def encode(self, o):
+        if (
+            orjson is not None and
+            self.indent is None and
+            self.item_separator == ',' and
+            self.key_separator == ':' and
+            not self.skipkeys and
+            self.check_circular
+        ):
+            data = _orjson_dumps(
+                o, self.default, self.sort_keys, self.ensure_ascii
+            )
+            if data is not None:
+                return data.decode()
+
+        return super().encode(o)
+
+
+class JSONDecoder(FlaskJSONDecoder):
+    """Flask JSON decoder switching to `orjson` when possible."""
+
+    def decode(self, s, *args, **kwargs):
+        if (
+            orjson is not None and
+            not args and not kwargs and
+            self.object_hook is None and
+            self.object_pairs_hook is None and
+            self.parse_float is float and
+            self.parse_int is int
+        ):
+            obj = _orjson_loads(s)
+            if obj is not _FALLBACK:
+                return obj
+
+        return super().decode(s, *args, **kwargs)
+
+
+def jsonify(obj):
+    """
+    The same as `flask.jsonify` (for a single object), but skips the round
+    trip through a string when the app uses the fast JSON encoder.
+    """
+    app = current_app
+
+    if (
+        orjson is not None and
+        issubclass(app.json_encoder, JSONEncoder) and
+        not (app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug)
+    ):
+        data = _orjson_dumps(
+            obj,
+            app.json_encoder().default,
+            app.config['JSON_SORT_KEYS'],
+            app.config['JSON_AS_ASCII'],
+        )
+        if data is not None:
+            return app.response_class(
+                data + b'\n', mimetype=app.config['JSONIFY_MIMETYPE']
+            )
+
+    return flask_jsonify(obj)
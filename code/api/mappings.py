@@ -1,11 +1,14 @@
 from abc import ABC, abstractmethod
 from collections import namedtuple
-from typing import Dict, Any, Optional, List
+from functools import lru_cache
+from typing import Dict, Any, Optional, List, Tuple
 from urllib.parse import quote_plus, urlparse
-from uuid import uuid4
+from uuid import UUID, uuid4, uuid5
 
 from flask import current_app
 
+from api.jsonlib import loads
+
 
 JSON = Dict[str, Any]
 
@@ -23,15 +26,304 @@ CTIM_DEFAULTS = {
 }
 
 
+# Fixed namespace for deriving deterministic UUIDs (must never be changed,
+# otherwise all the previously derived IDs will be invalidated).
+TRANSIENT_ID_NAMESPACE = UUID('5b0c8f3e-4a3c-4f0e-9d6b-1d4f6c2e7a91')
+
+
 def transient_id(entity, uuid=None):
     if uuid is None:
         uuid = uuid4()
     return f"transient:{entity['type']}-{uuid}"
 
 
+def deterministic_transient_id(entity, *parts):
+    """
+    Build a transient ID for an entity based on a namespaced hash (UUIDv5) of
+    the given parts, so that the same input always results in the same ID.
+    """
+    name = '|'.join(str(part) for part in (entity['type'],) + parts)
+    return transient_id(entity, uuid=uuid5(TRANSIENT_ID_NAMESPACE, name))
+
+
 Observable = namedtuple('Observable', ['type', 'value'])
 
 
+# Top-level fields of GTI events read by the mappings below and the workflow
+# (i.e. the projection requested from the GTI API when querying events).
+EVENT_FIELDS = (
+    'uuid',
+    'timestamp',
+    'event_type',
+    'customer_id',
+    'sensor_id',
+    'src',
+    'dst',
+    # flow
+    'flow_state',
+    'proto',
+    'service',
+    'total_pkts',
+    # dns
+    'query',
+    'answers',
+    'qtype',
+    'qtype_name',
+    'rcode',
+    'rcode_name',
+    'rejected',
+    # http
+    'method',
+    'status_code',
+    'status_msg',
+    'files',
+    'user_agent',
+    'host',
+    'uri',
+    # ssh
+    'direction',
+    'client',
+    'server',
+    # suricata
+    'sig_name',
+    'sig_category',
+    'sig_id',
+    'sig_rev',
+)
+
+
+class Reference(namedtuple('Reference', [
+    'source_name',
+    'description',
+    'external_id',
+    'url',
+])):
+    """External reference of a sighting (see `SightingRecord`)."""
+
+    __slots__ = ()
+
+    def json(self) -> JSON:
+        return self._asdict()
+
+
+class Relation(namedtuple('Relation', [
+    'origin',
+    'related',
+    'relation',
+    'source',
+])):
+    """Relation of observables of a sighting (see `SightingRecord`)."""
+
+    __slots__ = ()
+
+    def json(self) -> JSON:
+        return {
+            'origin': self.origin,
+            'related': self.related._asdict(),
+            'relation': self.relation,
+            'source': self.source._asdict(),
+        }
+
+
+class SightingRecord:
+    """
+    Compact internal representation of a sighting rendered into a CTIM dict
+    only when serialized. The constant fields aren't stored at all, and the
+    columns of the details are shared by all the sightings of the same kind,
+    so they must never be modified.
+
+    The fields stored as is can also be read just like the ones of the
+    rendered dict (e.g. `sighting['id']`).
+    """
+
+    __slots__ = (
+        'id',
+        'count',
+        'start_time',
+        'end_time',
+        'columns',
+        'row',
+        'description',
+        'external_ids',
+        'external_references',
+        'observables',
+        'relations',
+        'omitted_relations',
+        'sensor',
+        'severity',
+        'source_uri',
+        'target_observables',
+    )
+
+    type = 'sighting'
+
+    def __init__(self, id, timestamp, description, external_ids,
+                 external_references, observables, sensor, source_uri):
+        self.id = id
+        self.count = 1
+        self.start_time = timestamp
+        self.end_time = timestamp
+        self.columns = None
+        self.row = None
+        self.description = description
+        self.external_ids = external_ids
+        self.external_references = external_references
+        self.observables = observables
+        self.relations = None
+        self.omitted_relations = 0
+        self.sensor = sensor
+        self.severity = None
+        self.source_uri = source_uri
+        self.target_observables = None
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def merge(self, other):
+        """
+        Add any observables and relations (within the same limit as while
+        mapping, just counting the rest) of an equivalent sighting.
+        """
+        for observable in other.observables:
+            if observable not in self.observables:
+                self.observables.append(observable)
+
+        limit = current_app.config['CTR_SIGHTING_RELATIONS_LIMIT']
+
+        # The relations omitted from both sightings may be the same ones.
+        omitted = max(self.omitted_relations, other.omitted_relations)
+
+        for relation in other.relations or []:
+            if self.relations is None:
+                self.relations = []
+            if relation in self.relations:
+                continue
+
+            if limit is not None and len(self.relations) >= limit:
+                omitted += 1
+            else:
+                self.relations.append(relation)
+
+        self.omitted_relations = omitted
+
+    def json(self) -> JSON:
+        sighting: JSON = Sighting.DEFAULTS.copy()
+
+        sighting['count'] = self.count
+
+        sighting['id'] = self.id
+
+        # The same observed time is also shared by the targets (if any).
+        observed_time = {
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+        }
+        sighting['observed_time'] = observed_time
+
+        if self.columns is not None:
+            sighting['data'] = {
+                'columns': list(self.columns),
+                'rows': [self.row],
+            }
+
+        sighting['description'] = self.description
+        if self.omitted_relations:
+            sighting['description'] += '\n' + (
+                f"- Omitted Relations: `{self.omitted_relations}`"
+            )
+
+        sighting['external_ids'] = list(self.external_ids)
+
+        sighting['external_references'] = [
+            reference.json() for reference in self.external_references
+        ]
+
+        sighting['observables'] = list(self.observables)
+
+        if self.relations:
+            sighting['relations'] = [
+                relation.json() for relation in self.relations
+            ]
+
+        sighting['sensor'] = self.sensor
+
+        if self.severity is not None:
+            sighting['severity'] = self.severity
+
+        sighting['source_uri'] = self.source_uri
+
+        if self.target_observables is not None:
+            sighting['targets'] = [{
+                'observables': list(self.target_observables),
+                'observed_time': observed_time,
+                'type': 'endpoint',
+            }]
+
+        return sighting
+
+
+class EncodedSighting:
+    """
+    Sighting already encoded into JSON elsewhere (e.g. in `api.offload`) with
+    just the fields needed to bundle it, so it is only mapped again from its
+    events into a `SightingRecord` if merged with an equivalent sighting.
+    """
+
+    __slots__ = (
+        'id',
+        'end_time',
+        'external_ids',
+        'severity',
+        'encoded',
+        'events',
+        'record',
+    )
+
+    type = 'sighting'
+
+    def __init__(self, id, end_time, external_ids, severity, encoded,
+                 events):
+        self.id = id
+        self.end_time = end_time
+        self.external_ids = external_ids
+        self.severity = severity
+        self.encoded = encoded
+        self.events = events
+        self.record = None
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def _materialize(self):
+        if self.record is None:
+            self.record = Sighting.record(self.events)
+            # Keep the (possibly random) ID, since it may be referenced.
+            self.record.id = self.id
+            self.encoded = None
+        return self.record
+
+    @property
+    def observables(self):
+        return self._materialize().observables
+
+    @property
+    def relations(self):
+        return self._materialize().relations
+
+    @property
+    def omitted_relations(self):
+        return self._materialize().omitted_relations
+
+    def merge(self, other):
+        """The same as `SightingRecord.merge`."""
+        self._materialize().merge(other)
+
+    def json(self) -> JSON:
+        if self.record is not None:
+            return self.record.json()
+        return loads(self.encoded)
+
+
 class Sighting(Mapping):
     DEFAULTS = {
         'type': 'sighting',
@@ -48,99 +340,209 @@ class Sighting(Mapping):
         'low': 'Low',
     }
 
+    # Columns of the event-specific details by the types of events.
+    DETAILS_COLUMNS = {
+        'flow': [
+            {'name': 'flow_state', 'type': 'string'},
+            {'name': 'proto', 'type': 'string'},
+            {'name': 'service', 'type': 'string'},
+            {'name': 'total_pkts', 'type': 'integer'},
+        ],
+        'dns': [
+            {'name': 'qtype', 'type': 'integer'},
+            {'name': 'qtype_name', 'type': 'string'},
+            {'name': 'rcode', 'type': 'integer'},
+            {'name': 'rcode_name', 'type': 'string'},
+            # Use 'string' instead of 'boolean' (not supported yet).
+            {'name': 'rejected', 'type': 'string'},
+        ],
+        'http': [
+            {'name': 'method', 'type': 'string'},
+            {'name': 'status_code', 'type': 'integer'},
+            {'name': 'status_msg', 'type': 'string'},
+            {'name': 'files', 'type': 'integer'},
+        ],
+        'ssh': [
+            {'name': 'direction', 'type': 'string'},
+            {'name': 'client', 'type': 'string'},
+            {'name': 'server', 'type': 'string'},
+        ],
+        'suricata': [
+            {'name': 'sig_name', 'type': 'string'},
+            {'name': 'sig_category', 'type': 'string'},
+            {'name': 'sig_id', 'type': 'integer'},
+            {'name': 'sig_rev', 'type': 'number'},
+        ],
+    }
+
+    EVENT_REFERENCE_DESCRIPTION = '\n'.join([
+        '- Represents the UUID of the given event.',
+        '- Links to a UI search page querying for that particular '
+        'event by its UUID.',
+    ])
+
+    RULE_REFERENCE_DESCRIPTION = '\n'.join([
+        '- Represents the UUID of a rule matching the given event.',
+        '- Links to a UI page describing that specific rule along '
+        'with providing some summary over its history.',
+        '- Includes the UUID of an account associated with that '
+        'particular detection.',
+    ])
+
     @classmethod
     def map(cls, event: JSON) -> JSON:
-        sighting: JSON = cls.DEFAULTS.copy()
+        return cls.record([event]).json()
 
-        sighting['id'] = transient_id(sighting)
-
-        sighting['observed_time'] = {
-            'start_time': event['timestamp']
-        }
-        sighting['observed_time']['end_time'] = (
-            sighting['observed_time']['start_time']
-        )
+    @classmethod
+    def aggregate(cls, events: List[JSON]) -> JSON:
+        """
+        Map a group of similar events (the most recent one coming first) into
+        a single sighting counting all of them.
+        """
+        return cls.record(events).json()
 
-        details = cls._details(event)
-        if details:
-            sighting['data'] = details
+    @classmethod
+    def record(cls, events: List[JSON]) -> SightingRecord:
+        """
+        The same as `aggregate`, but return the compact record of the sighting
+        (i.e. render it into a CTIM dict only when actually needed).
+        """
+        event = events[0]
+
+        source = cls.DEFAULTS['source']
+
+        if current_app.config['CTIM_DETERMINISTIC_IDS']:
+            id_ = deterministic_transient_id(
+                cls.DEFAULTS,
+                event['uuid'],
+                event['observable']['type'],
+                event['observable']['value'],
+                event['detection']['rule']['uuid']
+                if 'detection' in event else '',
+            )
+        else:
+            id_ = transient_id(cls.DEFAULTS)
 
-        sighting['description'] = f"- Event: `{event['event_type'].upper()}`"
+        description = f"- Event: `{event['event_type'].upper()}`"
         if 'detection' in event:
-            sighting['description'] += '\n' + (
+            description += '\n' + (
                 f"- Rule: `{event['detection']['rule']['name']}`"
             )
 
-        sighting['external_ids'] = [event['uuid']]
+        external_ids = [event['uuid']]
         if 'detection' in event:
-            sighting['external_ids'].append(
-                event['detection']['rule']['uuid']
-            )
+            external_ids.append(event['detection']['rule']['uuid'])
 
-        sighting['external_references'] = [{
-            'source_name': sighting['source'],
-            'description': '\n'.join([
-                '- Represents the UUID of the given event.',
-                '- Links to a UI search page querying for that particular '
-                'event by its UUID.',
-            ]),
-            'external_id': event['uuid'],
-            'url': current_app.config['GTI_UI_SEARCH_URL'].format(
-                query=quote_plus(f"uuid = '{event['uuid']}'"),
-            ),
-        }]
+        external_references = [cls._event_reference(source, event)]
         if 'detection' in event:
-            sighting['external_references'].append({
-                'source_name': sighting['source'],
-                'description': '\n'.join([
-                    '- Represents the UUID of a rule matching the given '
-                    'event.',
-                    '- Links to a UI page describing that specific rule along '
-                    'with providing some summary over its history.',
-                    '- Includes the UUID of an account associated with that '
-                    'particular detection.',
-                ]),
-                'external_id': event['detection']['rule']['uuid'],
-                'url': current_app.config['GTI_UI_RULE_ACCOUNT_URL'].format(
+            external_references.append(Reference(
+                source,
+                cls.RULE_REFERENCE_DESCRIPTION,
+                event['detection']['rule']['uuid'],
+                current_app.config['GTI_UI_RULE_ACCOUNT_URL'].format(
                     rule_uuid=event['detection']['rule']['uuid'],
                     account_uuid=event['detection']['account_uuid'],
                 ),
-            })
-
-        sighting['observables'] = [event['observable']]
+            ))
+
+        sighting = SightingRecord(
+            id_,
+            event['timestamp'],
+            description,
+            external_ids,
+            external_references,
+            [event['observable']],
+            event['sensor_id'],
+            external_references[-1].url,
+        )
 
-        relations = cls._relations(sighting['source'], event)
-        if relations:
-            sighting['relations'] = relations
+        sighting.columns = cls._columns(
+            event['event_type'], 'detection' in event
+        )
+        if sighting.columns is not None:
+            sighting.row = cls._row(event)
 
-        sighting['sensor'] = event['sensor_id']
+        relations, omitted = cls._relations(
+            source,
+            event,
+            limit=current_app.config['CTR_SIGHTING_RELATIONS_LIMIT'],
+        )
+        sighting.relations = relations
+        sighting.omitted_relations = omitted
 
         if 'detection' in event:
-            sighting['severity'] = (
+            sighting.severity = (
                 cls.SEVERITY_MAPPING[event['detection']['rule']['severity']]
             )
 
-        sighting['source_uri'] = sighting['external_references'][-1]['url']
+        sighting.target_observables = cls._target_observables(event)
 
-        targets = cls._targets(sighting['observed_time'], event)
-        if targets:
-            sighting['targets'] = targets
+        if len(events) == 1:
+            return sighting
+
+        sighting.count = len(events)
+
+        timestamps = [event['timestamp'] for event in events]
+        sighting.start_time = min(timestamps)
+        sighting.end_time = max(timestamps)
+
+        # Keep only a sample of references to the other events in the group
+        # right after the reference to the most recent one.
+        sample = events[1:current_app.config['CTR_AGGREGATED_EVENTS_SAMPLE']]
+
+        sighting.external_ids[1:1] = [event['uuid'] for event in sample]
+        sighting.external_references[1:1] = [
+            cls._event_reference(source, event) for event in sample
+        ]
 
         return sighting
 
+    @classmethod
+    def _event_reference(cls, source, event) -> Reference:
+        return Reference(
+            source,
+            cls.EVENT_REFERENCE_DESCRIPTION,
+            event['uuid'],
+            current_app.config['GTI_UI_SEARCH_URL'].format(
+                query=quote_plus(f"uuid = '{event['uuid']}'"),
+            ),
+        )
+
     @staticmethod
-    def _details(event) -> Optional[JSON]:
-        columns = []
-        rows = []
+    @lru_cache(maxsize=None)
+    def _columns(event_type, detected) -> Optional[List[JSON]]:
+        """Build the columns of the details shared by similar sightings."""
+        columns = [
+            # Add a bullet before each column (i.e. field) name for better
+            # appearance on the UI.
+            {'name': '•' + ' ' + column['name'], 'type': column['type']}
+            for column in Sighting.DETAILS_COLUMNS.get(event_type, [])
+        ]
+
+        if columns:
+            # Add some "header" column for the event-specific details.
+            columns.insert(0, {'name': 'Event Summary', 'type': 'string'})
+
+        if detected:
+            # Make the detection-specific details come before the
+            # event-specific ones to visually highlight the former from the
+            # latter on the UI.
+            # Add some "header" column for the detection-specific details.
+            columns[0:0] = [
+                {'name': 'Detection Summary', 'type': 'string'},
+                {'name': 'Impacted Devices', 'type': 'integer'},
+                {'name': 'Indicator Values', 'type': 'integer'},
+            ]
+
+        return columns or None
+
+    @staticmethod
+    def _row(event) -> List[Any]:
+        """Build the only row of the details (matching `_columns`)."""
+        row = []
 
         if event['event_type'] == 'flow':
-            columns.extend([
-                {'name': 'flow_state', 'type': 'string'},
-                {'name': 'proto', 'type': 'string'},
-                {'name': 'service', 'type': 'string'},
-                {'name': 'total_pkts', 'type': 'integer'},
-            ])
-            rows.append([
+            row.extend([
                 event['flow_state'],
                 event['proto'],
                 event['service'],
@@ -148,15 +550,7 @@ class Sighting(Mapping):
             ])
 
         if event['event_type'] == 'dns':
-            columns.extend([
-                {'name': 'qtype', 'type': 'integer'},
-                {'name': 'qtype_name', 'type': 'string'},
-                {'name': 'rcode', 'type': 'integer'},
-                {'name': 'rcode_name', 'type': 'string'},
-                # Use 'string' instead of 'boolean' (not supported yet).
-                {'name': 'rejected', 'type': 'string'},
-            ])
-            rows.append([
+            row.extend([
                 event['qtype'],
                 event['qtype_name'],
                 event['rcode'],
@@ -166,13 +560,7 @@ class Sighting(Mapping):
             ])
 
         if event['event_type'] == 'http':
-            columns.extend([
-                {'name': 'method', 'type': 'string'},
-                {'name': 'status_code', 'type': 'integer'},
-                {'name': 'status_msg', 'type': 'string'},
-                {'name': 'files', 'type': 'integer'},
-            ])
-            rows.append([
+            row.extend([
                 event['method'],
                 event['status_code'],
                 event['status_msg'],
@@ -180,95 +568,63 @@ class Sighting(Mapping):
             ])
 
         if event['event_type'] == 'ssh':
-            columns.extend([
-                {'name': 'direction', 'type': 'string'},
-                {'name': 'client', 'type': 'string'},
-                {'name': 'server', 'type': 'string'},
-            ])
-            rows.append([
+            row.extend([
                 event['direction'],
                 event['client'],
                 event['server'],
             ])
 
         if event['event_type'] == 'suricata':
-            columns.extend([
-                {'name': 'sig_name', 'type': 'string'},
-                {'name': 'sig_category', 'type': 'string'},
-                {'name': 'sig_id', 'type': 'integer'},
-                {'name': 'sig_rev', 'type': 'number'},
-            ])
-            rows.append([
+            row.extend([
                 event['sig_name'],
                 event['sig_category'],
                 event['sig_id'],
                 event['sig_rev'],
             ])
 
-        if columns:
-            # Add a bullet before each column (i.e. field) name for better
-            # appearance on the UI.
-            for column in columns:
-                column['name'] = '•' + ' ' + column['name']
-
-            # Add some "header" column for the event-specific details.
-            columns.insert(0, {'name': 'Event Summary', 'type': 'string'})
-            rows[0].insert(0, ' ')
+        if row:
+            row.insert(0, ' ')
 
         if 'detection' in event:
-            # Make the detection-specific details come before the
-            # event-specific ones to visually highlight the former from the
-            # latter on the UI.
-            # Add some "header" column for the detection-specific details.
-            extra_columns = [
-                {'name': 'Detection Summary', 'type': 'string'},
-                {'name': 'Impacted Devices', 'type': 'integer'},
-                {'name': 'Indicator Values', 'type': 'integer'},
-            ]
-            extra_row = [
+            row[0:0] = [
                 ' ',
                 event['detection']['summary']['impacted_devices'],
                 event['detection']['summary']['indicator_values'],
             ]
 
-            columns = extra_columns + columns
-            if rows:
-                for index, row in enumerate(rows):
-                    rows[index] = extra_row + row
-            else:
-                rows.append(extra_row)
-
-        details = None
-
-        if columns and rows:
-            details = {
-                'columns': columns,
-                'rows': rows,
-            }
-
-        return details
+        return row
 
     @staticmethod
-    def _relations(origin, event) -> Optional[List[JSON]]:
+    def _relations(
+        origin,
+        event,
+        limit=None,
+    ) -> Tuple[Optional[List[Relation]], int]:
         relations = []
 
+        # Events may easily contain the same relations multiple times (e.g.
+        # repeated DNS answers or files), so keep track of the already added
+        # ones along with the number of unique relations exceeding the limit.
+        seen = set()
+        omitted = 0
+
         def append_relation(
             source: Observable,
             relation: str,
             related: Observable,
         ) -> None:
-            relations.append({
-                'origin': origin,
-                'related': {
-                    'type': related.type,
-                    'value': related.value,
-                },
-                'relation': relation,
-                'source': {
-                    'type': source.type,
-                    'value': source.value,
-                },
-            })
+            nonlocal omitted
+
+            key = source, relation, related
+            if key in seen:
+                return
+            seen.add(key)
+
+            if limit is not None and len(relations) >= limit:
+                omitted += 1
+                return
+
+            relations.append(Relation(origin, related, relation, source))
 
         if 'src' in event and 'dst' in event:
             append_relation(
@@ -371,10 +727,10 @@ class Sighting(Mapping):
                     Observable('ip', event['dst']['ip']),
                 )
 
-        return relations or None
+        return relations or None, omitted
 
     @staticmethod
-    def _targets(observed_time, event) -> Optional[List[JSON]]:
+    def _target_observables(event) -> Optional[List[JSON]]:
         device = None
 
         for loc in ['src', 'dst']:
@@ -400,11 +756,7 @@ class Sighting(Mapping):
                         )
                     break
 
-        return [{
-            'observables': observables,
-            'observed_time': observed_time,
-            'type': 'endpoint',
-        }]
+        return observables
 
 
 class Indicator(Mapping):
@@ -478,7 +830,12 @@ class Relationship(Mapping):
     def map(cls, sighting: JSON, indicator: JSON) -> JSON:
         relationship: JSON = cls.DEFAULTS.copy()
 
-        relationship['id'] = transient_id(relationship)
+        if current_app.config['CTIM_DETERMINISTIC_IDS']:
+            relationship['id'] = deterministic_transient_id(
+                relationship, sighting['id'], indicator['id'],
+            )
+        else:
+            relationship['id'] = transient_id(relationship)
 
         relationship['source_ref'] = sighting['id']
 
@@ -0,0 +1,102 @@
+import os
+from collections import defaultdict
+from threading import Lock
+
+from flask import Blueprint, jsonify
+
+
+class Metrics:
+    """
+    Thread-safe in-process registry of counters and observed values (e.g.
+    durations or ratios) optionally labeled with some additional dimensions.
+    """
+
+    # Maximum number of differently labeled series of a single metric (any
+    # others are accounted for together as a single series labeled `other`),
+    # so that the memory usage doesn't keep growing with the label values.
+    MAX_SERIES = 100
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = defaultdict(int)
+        self._observations = {}
+        self._series_by_name = defaultdict(int)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def _bounded_key(self, name, labels):
+        # Must be called with the lock held.
+        key = self._key(name, labels)
+
+        if key in self._counters or key in self._observations:
+            return key
+
+        if self._series_by_name[name] >= self.MAX_SERIES:
+            return self._key(name, {'other': True})
+
+        self._series_by_name[name] += 1
+        return key
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[self._bounded_key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            key = self._bounded_key(name, labels)
+            summary = self._observations.get(key)
+            if summary is None:
+                summary = self._observations[key] = {
+                    'count': 0, 'sum': 0, 'max': value,
+                }
+            summary['count'] += 1
+            summary['sum'] += value
+            summary['max'] = max(summary['max'], value)
+
+    def snapshot(self):
+        """Return a copy of all the metrics collected so far."""
+        with self._lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in self._counters.items()
+                ],
+                'observations': [
+                    {'name': name, 'labels': dict(labels), **summary}
+                    for (name, labels), summary in self._observations.items()
+                ],
+            }
+
+    def get(self, name, **labels):
+        """Return either the value of a counter or the summary of values."""
+        key = self._key(name, labels)
+
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            if key in self._observations:
+                return dict(self._observations[key])
+            return None
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._observations.clear()
+            self._series_by_name.clear()
+
+
+metrics = Metrics()
+
+metrics_api = Blueprint('metrics', __name__)
+
+
+@metrics_api.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Each worker process has its own metrics, so tell them apart.
+    return jsonify({'pid': os.getpid(), **metrics.snapshot()})
+
+
+async def get_metrics_async():
+    return get_metrics()
@@ -0,0 +1,174 @@
+"""
+Pool of processes taking over the CPU-heavy part of serving large requests
+(i.e. mapping events into sightings and encoding these into JSON), so that
+it doesn't hold the GIL shared with the other requests being served by the
+same worker process.
+
+Events are sent to the pool (pickled) and come back as encoded sightings
+(see `api.mappings.EncodedSighting`) rather than as whole records, since
+unpickling these would take about as long as mapping them in place.
+"""
+
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+from flask import Flask, current_app
+
+from api.jsonlib import dumps
+from api.mappings import EncodedSighting, Sighting
+
+# Settings read by the mappings and the encoding, which are passed along
+# with each task, so the pool always uses the current ones.
+SETTINGS = (
+    'CTIM_DETERMINISTIC_IDS',
+    'CTR_AGGREGATED_EVENTS_SAMPLE',
+    'CTR_SIGHTING_RELATIONS_LIMIT',
+    'GTI_UI_RULE_ACCOUNT_URL',
+    'GTI_UI_RULE_URL',
+    'GTI_UI_SEARCH_URL',
+    'JSON_AS_ASCII',
+    'JSON_SORT_KEYS',
+)
+
+# Number of event groups per task.
+CHUNK_SIZE = 100
+
+_app = None
+
+
+def _worker_app(settings):
+    # The mappings need just the settings from the app config.
+    global _app
+
+    if _app is None:
+        _app = Flask(__name__)
+
+    _app.config.update(settings)
+
+    return _app
+
+
+def _map(settings, groups):
+    """Return the fields of `EncodedSighting`s (except for the events)."""
+    with _worker_app(settings).app_context():
+        fields = []
+
+        for group in groups:
+            record = Sighting.record(group)
+            encoded = dumps(
+                record.json(),
+                sort_keys=settings['JSON_SORT_KEYS'],
+                ensure_ascii=settings['JSON_AS_ASCII'],
+            )
+            fields.append((
+                record.id,
+                record.end_time,
+                record.external_ids,
+                record.severity,
+                encoded,
+            ))
+
+        return fields
+
+
+def get_executable(config):
+    """
+    Get the Python interpreter to start the processes of the pool with, since
+    `sys.executable` may be a program embedding Python instead (e.g. uWSGI).
+    """
+    if config['CTR_OFFLOAD_EXECUTABLE']:
+        return config['CTR_OFFLOAD_EXECUTABLE']
+
+    try:
+        import uwsgi  # noqa: F401 (only available within uWSGI)
+    except ImportError:
+        return sys.executable
+
+    # The interpreter of the same installation as the embedded one.
+    return os.path.join(
+        sys.exec_prefix, 'bin', 'python%d.%d' % sys.version_info[:2]
+    )
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool(config):
+    """Get the pool shared by all the requests in the current process."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # Forking a process running several threads isn't safe.
+            context = multiprocessing.get_context('spawn')
+            context.set_executable(get_executable(config))
+
+            _pool = ProcessPoolExecutor(
+                config['CTR_OFFLOAD_PROCESSES'], mp_context=context
+            )
+
+    return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+    current_app.logger.warning('The offload pool is broken, so discarded')
+
+
+def applies(config, count):
+    """Tell whether a number of events is worth offloading."""
+    return bool(
+        config['CTR_OFFLOAD_PROCESSES'] and
+        count >= config['CTR_OFFLOAD_THRESHOLD']
+    )
+
+
+def map_sightings(config, groups):
+    """
+    The same as `[Sighting.record(group) for group in groups]`, but in the
+    pool (and encoded right away).
+
+    If the pool breaks (e.g. a process gets killed for running out of
+    memory), the rest of the groups are mapped in the current process.
+    """
+    settings = {name: config[name] for name in SETTINGS}
+
+    chunks = [
+        groups[start:start + CHUNK_SIZE]
+        for start in range(0, len(groups), CHUNK_SIZE)
+    ]
+
+    pool = get_pool(config)
+    try:
+        futures = [pool.submit(_map, settings, chunk) for chunk in chunks]
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        futures = None
+
+    sightings = []
+
+    for index, chunk in enumerate(chunks):
+        if futures is not None:
+            try:
+                sightings.extend(
+                    EncodedSighting(*fields, events=group)
+                    for fields, group in zip(futures[index].result(), chunk)
+                )
+                continue
+            except BrokenProcessPool:
+                _discard_pool(pool)
+                futures = None
+
+        sightings.extend(Sighting.record(group) for group in chunk)
+
+    return sightings
@@ -0,0 +1,229 @@
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+from api.metrics import metrics
+
+
+class WeightedQueues:
+    """
+    Calls queued separately per tenant and per request, and taken in a
+    weighted round-robin manner: each tenant gets up to its weight of calls
+    per round, taking turns between its own requests.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+
+        # tenant -> request -> calls.
+        self._queues = OrderedDict()
+        self._credits = {}
+
+    def _weight(self, tenant):
+        return self.weights.get(tenant, 1)
+
+    def _push(self, tenant, request, call):
+        calls = self._queues.setdefault(tenant, OrderedDict()).setdefault(
+            request, deque()
+        )
+        calls.append(call)
+
+    def _next(self):
+        # The first tenant in the queue is the one currently taking its turn.
+        tenant, requests = next(iter(self._queues.items()))
+
+        request, calls = next(iter(requests.items()))
+        call = calls.popleft()
+
+        # Let the next request of the same tenant go first next time.
+        del requests[request]
+        if calls:
+            requests[request] = calls
+
+        credits = self._credits.get(tenant, self._weight(tenant)) - 1
+
+        if not requests:
+            del self._queues[tenant]
+            self._credits.pop(tenant, None)
+        elif credits <= 0:
+            # The tenant has used up its turn, so let the next one go.
+            self._queues.move_to_end(tenant)
+            self._credits.pop(tenant, None)
+        else:
+            self._credits[tenant] = credits
+
+        return tenant, call
+
+
+class Scheduler(WeightedQueues):
+    """
+    Pool of worker threads making upstream calls on behalf of all requests.
+
+    Calls are dispatched from the weighted queues (see `WeightedQueues`), so
+    small lookups don't have to wait behind large ones (which may fan out to
+    hundreds of calls).
+    """
+
+    def __init__(self, workers, weights=None):
+        super().__init__(weights)
+
+        self.workers = workers
+
+        self._condition = Condition()
+        self._threads = []
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = Thread(
+                target=self._work, name='gti-upstream', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, tenant, request, function, *args, **kwargs):
+        future = Future()
+
+        with self._condition:
+            # Workers are started lazily (i.e. only in a worker process
+            # already forked from the master one).
+            self._start()
+
+            self._push(
+                tenant, request, (future, monotonic(), function, args, kwargs)
+            )
+
+            self._condition.notify()
+
+        return future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queues)
+                _, call = self._next()
+
+            future, queued, function, args, kwargs = call
+
+            # Not labeled by tenant, since the metrics are exposed as is.
+            metrics.observe('scheduler.queue_time', monotonic() - queued)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class AsyncScheduler(WeightedQueues):
+    """
+    The same as `Scheduler`, but for an event loop: the calls are coroutine
+    functions awaited by a bounded number of tasks instead of threads.
+    """
+
+    def __init__(self, workers, weights=None):
+        super().__init__(weights)
+
+        self.workers = workers
+
+        self._queued = asyncio.Event()
+        self._tasks = []
+
+    def _start(self):
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.ensure_future(self._work()))
+
+    def submit(self, tenant, request, function, *args, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+
+        self._start()
+
+        self._push(
+            tenant, request, (future, monotonic(), function, args, kwargs)
+        )
+
+        self._queued.set()
+
+        return future
+
+    async def _work(self):
+        while True:
+            while not self._queues:
+                self._queued.clear()
+                await self._queued.wait()
+
+            _, call = self._next()
+
+            future, queued, function, args, kwargs = call
+
+            metrics.observe('scheduler.queue_time', monotonic() - queued)
+
+            # E.g. the request has already failed or its client has gone.
+            if future.cancelled():
+                continue
+
+            try:
+                result = await function(*args, **kwargs)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler(config):
+    """Get the scheduler shared by all the requests in the current process."""
+    global _scheduler
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(
+                config['GTI_UPSTREAM_WORKERS'],
+                weights=config['GTI_UPSTREAM_TENANT_WEIGHTS'],
+            )
+
+    return _scheduler
+
+
+# Tasks can't be shared by different event loops (e.g. the one started for
+# the synchronous code and the one of an ASGI server).
+_async_scheduler_by_loop = {}
+
+
+def get_async_scheduler(config):
+    """
+    Get the scheduler shared by all the requests on the current event loop,
+    running as many calls at once as there may be connections to the GTI API.
+    """
+    loop = asyncio.get_running_loop()
+
+    scheduler = _async_scheduler_by_loop.get(loop)
+    if scheduler is None:
+        scheduler = _async_scheduler_by_loop[loop] = AsyncScheduler(
+            config['GTI_ASYNC_CONNECTIONS_LIMIT'],
+            weights=config['GTI_UPSTREAM_TENANT_WEIGHTS'],
+        )
+
+    return scheduler
+
+
+async def close_async_scheduler():
+    """Stop the scheduler used on the current event loop (if any)."""
+    scheduler = _async_scheduler_by_loop.pop(asyncio.get_running_loop(), None)
+    if scheduler is not None:
+        for task in scheduler._tasks:
+            task.cancel()
+        await asyncio.gather(*scheduler._tasks, return_exceptions=True)
@@ -15,3 +15,54 @@ class ObservableSchema(Schema):
         validate=validate_string,
         required=True,
     )
+
+
+# Observable types with case-insensitive values.
+CASE_INSENSITIVE_TYPES = {'domain', 'md5', 'sha1', 'sha256'}
+
+_observables_schema = ObservableSchema(many=True)
+
+
+def _is_simple(observable):
+    # Exactly the shape accepted by `ObservableSchema` (coming from JSON).
+    return (
+        type(observable) is dict and
+        len(observable) == 2 and
+        type(observable.get('type')) is str and
+        type(observable.get('value')) is str and
+        observable['type'] != '' and
+        observable['value'] != ''
+    )
+
+
+def parse_observables(data, types=None):
+    """
+    Validate observables just like `ObservableSchema(many=True)` does (with
+    the same errors), but only fall back to it for anything not plainly
+    valid, and return the observables of the given types (or of any types)
+    along with any errors.
+
+    The values of case-insensitive types are lowercased, and duplicates are
+    dropped (preserving the order).
+    """
+    if not (type(data) is list and all(map(_is_simple, data))):
+        error = _observables_schema.validate(data)
+        if error:
+            return None, error
+
+    observables = {}
+
+    for observable in data:
+        type_, value = observable['type'], observable['value']
+
+        if types is not None and type_ not in types:
+            continue
+
+        if type_ in CASE_INSENSITIVE_TYPES:
+            value = value.lower()
+
+        observables.setdefault(
+            (type_, value), {'type': type_, 'value': value}
+        )
+
+    return list(observables.values()), None
@@ -0,0 +1,173 @@
+import codecs
+import json
+
+_WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+
+# Returned by the parsing states instead of a parsed item of the array.
+_MORE = object()
+_PROGRESS = object()
+
+
+class ArrayItemsParser:
+    """
+    Incrementally parse a JSON object (e.g. a GTI API response payload) fed
+    in chunks of bytes, yielding the items of its array under a given key as
+    soon as each of them is parsed in full. Any other keys are skipped.
+
+    >>> parser = ArrayItemsParser('events')
+    >>> list(parser.feed(b'{"total": 2, "events": [{"a": 1}, {"a"'))
+    [{'a': 1}]
+    >>> list(parser.feed(b': 2}]}')) + list(parser.close())
+    [{'a': 2}]
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._position = 0
+        self._state = self._object_start
+        self._current_key = None
+        self._final = False
+
+    def feed(self, chunk):
+        """Parse another chunk yielding any items completed by it."""
+        self._buffer = (
+            self._buffer[self._position:] +
+            self._text.decode(chunk, final=self._final)
+        )
+        self._position = 0
+
+        while self._state is not None:
+            self._skip_whitespace()
+
+            if self._position == len(self._buffer):
+                break
+
+            result = self._state()
+            if result is _MORE:
+                break
+
+            if result is not _PROGRESS:
+                yield result
+
+    @property
+    def done(self):
+        return self._state is None
+
+    def close(self):
+        """Parse the rest of the data making sure the object is complete."""
+        self._final = True
+        yield from self.feed(b'')
+
+        if self._state is not None:
+            raise ValueError('Incomplete JSON object')
+
+    def _skip_whitespace(self):
+        while (
+            self._position < len(self._buffer) and
+            self._buffer[self._position] in _WHITESPACE
+        ):
+            self._position += 1
+
+    def _char(self, expected):
+        char = self._buffer[self._position]
+        if char not in expected:
+            raise ValueError(
+                f'Expecting one of {expected!r} at position {self._position}'
+            )
+        self._position += 1
+        return char
+
+    def _value(self):
+        try:
+            value, end = _decoder.raw_decode(self._buffer, self._position)
+        except json.JSONDecodeError:
+            if self._final:
+                raise
+            return None, False
+
+        # Something like a number may still continue in the next chunk.
+        if end == len(self._buffer) and not self._final:
+            return None, False
+
+        self._position = end
+        return value, True
+
+    # The states below return either `_MORE` if more data is needed to go on,
+    # or `_PROGRESS` if something was parsed, or an item parsed in full.
+
+    def _object_start(self):
+        self._char('{')
+        self._state = self._key_or_end
+        return _PROGRESS
+
+    def _key_or_end(self):
+        if self._buffer[self._position] == '}':
+            self._position += 1
+            self._state = None
+            return _PROGRESS
+
+        key, complete = self._value()
+        if not complete:
+            return _MORE
+
+        self._current_key = key
+        self._state = self._colon
+        return _PROGRESS
+
+    def _colon(self):
+        self._char(':')
+        self._state = (
+            self._array_start if self._current_key == self.key else
+            self._skipped_value
+        )
+        return _PROGRESS
+
+    def _skipped_value(self):
+        _, complete = self._value()
+        if not complete:
+            return _MORE
+
+        self._state = self._next_key
+        return _PROGRESS
+
+    def _next_key(self):
+        if self._char(',}') == '}':
+            self._state = None
+        else:
+            self._state = self._key_or_end
+        return _PROGRESS
+
+    def _array_start(self):
+        if self._buffer[self._position] != '[':
+            # E.g. null instead of an empty array.
+            self._state = self._skipped_value
+            return _PROGRESS
+
+        self._position += 1
+        self._state = self._item_or_end
+        return _PROGRESS
+
+    def _item_or_end(self):
+        if self._buffer[self._position] == ']':
+            self._position += 1
+            self._state = self._next_key
+            return _PROGRESS
+
+        item, complete = self._value()
+        if not complete:
+            return _MORE
+
+        self._state = self._next_item
+        return item
+
+    def _next_item(self):
+        if self._char(',]') == ']':
+            self._state = self._next_key
+        else:
+            self._state = self._item_or_end
+        return _PROGRESS
@@ -1,13 +1,18 @@
 import json
+import re
 from json.decoder import JSONDecodeError
 
 import jwt
 import requests
-from flask import request, current_app, jsonify
+from flask import request, current_app
 from jwt import InvalidSignatureError, InvalidAudienceError, DecodeError
 from requests.exceptions import ConnectionError, InvalidURL, HTTPError
 
+from api.admission import digest
+from api.context import Context
 from api.errors import AuthenticationRequiredError
+from api.jsonlib import encoder, jsonify
+from api.schemas import parse_observables
 
 NO_AUTH_HEADER = 'Authorization header is missing'
 WRONG_AUTH_TYPE = 'Wrong authorization type'
@@ -24,7 +29,7 @@ WRONG_JWKS_HOST = ('Wrong jwks_host in JWT payload. Make sure domain follows '
                    'the visibility.<region>.cisco.com structure')
 
 
-def set_ctr_entities_limit(payload):
+def get_ctr_entities_limit(payload):
     try:
         ctr_entities_limit = int(payload['CTR_ENTITIES_LIMIT'])
         assert ctr_entities_limit > 0
@@ -35,7 +40,23 @@ def set_ctr_entities_limit(payload):
     except (KeyError, ValueError, AssertionError):
         ctr_entities_limit = current_app.config['CTR_ENTITIES_LIMIT_DEFAULT']
 
-    current_app.config['CTR_ENTITIES_LIMIT'] = ctr_entities_limit
+    return ctr_entities_limit
+
+
+def get_excluded_event_types(payload):
+    # E.g. 'flow, DNS' -> ('flow', 'dns'). Anything not looking like an event
+    # type is just ignored, since it ends up in the query to the GTI API.
+    value = payload.get('GTI_EXCLUDED_EVENT_TYPES') or ''
+    event_types = []
+
+    for event_type in str(value).split(','):
+        event_type = event_type.strip().lower()
+        if re.fullmatch(r'\w+', event_type, re.ASCII) and (
+            event_type not in event_types
+        ):
+            event_types.append(event_type)
+
+    return tuple(event_types)
 
 
 def get_auth_token():
@@ -52,6 +73,20 @@ def get_auth_token():
         raise AuthenticationRequiredError(expected_errors[error.__class__])
 
 
+def get_tenant():
+    """
+    Identify the tenant (i.e. the digest of its API key) of the current request
+    without validating the JWT yet, or return None if that's not possible.
+    """
+    try:
+        token = get_auth_token()
+        payload = jwt.decode(token, options={'verify_signature': False})
+        return digest(payload['key'])
+    except (AuthenticationRequiredError, DecodeError, KeyError, TypeError,
+            AttributeError):
+        return None
+
+
 def get_public_key(jwks_host, token):
     expected_errors = (
         ConnectionError,
@@ -77,10 +112,11 @@ def get_public_key(jwks_host, token):
         raise AuthenticationRequiredError(WRONG_JWKS_HOST)
 
 
-def get_key():
+def get_context():
     """
     Get authorization token and validate its signature against the public key
-    from /.well-known/jwks endpoint
+    from /.well-known/jwks endpoint, then restore the request-scoped context
+    (i.e. the GTI API key along with the module settings) from its payload
     """
     expected_errors = {
         KeyError: WRONG_PAYLOAD_STRUCTURE,
@@ -102,35 +138,110 @@ def get_key():
             token, key=key, algorithms=['RS256'], audience=[aud.rstrip('/')]
         )
 
-        set_ctr_entities_limit(payload)
-        current_app.config['GTI_ALLOW_TEST_ACCOUNTS'] = \
-            payload['GTI_ALLOW_TEST_ACCOUNTS']
-
-        return payload['key']
+        return Context(
+            key=payload['key'],
+            config=current_app.config,
+            entities_limit=get_ctr_entities_limit(payload),
+            allow_test_accounts=payload['GTI_ALLOW_TEST_ACCOUNTS'],
+            aggregate_sightings=bool(payload.get('GTI_AGGREGATE_SIGHTINGS')),
+            excluded_event_types=get_excluded_event_types(payload),
+        )
     except tuple(expected_errors) as error:
         message = expected_errors[error.__class__]
         raise AuthenticationRequiredError(message)
 
 
+def invalid_payload(error):
+    return {
+        'code': 'invalid payload received',
+        'message': f'Invalid JSON payload received. {json.dumps(error)}.',
+    }
+
+
 def get_json(schema):
     data = request.get_json(force=True, silent=True, cache=False)
 
     error = schema.validate(data) or None
     if error:
         data = None
-        error = {
-            'code': 'invalid payload received',
-            'message': f'Invalid JSON payload received. {json.dumps(error)}.',
-        }
+        error = invalid_payload(error)
 
     return data, error
 
 
-def jsonify_data(data):
-    return jsonify({'data': data})
+def get_observables(types=None):
+    """
+    The same as `get_json(ObservableSchema(many=True))`, but faster, and only
+    the canonicalized unique observables of the given types are returned (see
+    `parse_observables`).
+    """
+    data = request.get_json(force=True, silent=True, cache=False)
 
+    observables, error = parse_observables(data, types)
+    if error:
+        return None, invalid_payload(error)
 
-def jsonify_errors(error, data=None):
+    return observables, None
+
+
+def jsonify_data(data, warnings=None):
+    payload = {'data': data}
+
+    # Unlike errors, warnings come along with (possibly incomplete) data.
+    if warnings:
+        payload['errors'] = warnings
+
+    return jsonify(payload)
+
+
+def stream_data(bundle, warnings=None, chunk_size=64 * 1024, streamed=True):
+    """
+    The same as `jsonify_data(bundle.json(), warnings)`, but the response is
+    encoded lazily while being sent (in chunks of roughly the given size).
+
+    Unless `streamed`, the response is encoded right away (and sent along
+    with its length) the same way, e.g. to reuse any already encoded entities
+    (see `Bundle.stream`).
+    """
+    app = current_app
+
+    # Only the compact output can be streamed exactly the same way.
+    if app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug:
+        return jsonify_data(bundle.json(), warnings=warnings)
+
+    sort_keys = app.config['JSON_SORT_KEYS']
+    encode = encoder(sort_keys, app.config['JSON_AS_ASCII'])
+
+    def generate():
+        pieces = ['{"data":']
+        size = 0
+
+        for piece in bundle.stream(encode, sort_keys=sort_keys):
+            pieces.append(piece)
+            size += len(piece)
+
+            if size >= chunk_size:
+                yield ''.join(pieces).encode()
+                pieces.clear()
+                size = 0
+
+        # The data comes before the errors either way (even unsorted).
+        if warnings:
+            pieces.append(',"errors":' + encode(warnings))
+
+        pieces.append('}\n')
+        yield ''.join(pieces).encode()
+
+    chunks = generate()
+    if not streamed:
+        chunks = b''.join(chunks)
+
+    return app.response_class(
+        chunks, mimetype=app.config['JSONIFY_MIMETYPE']
+    )
+
+
+def format_error(error):
     error['code'] = error['code'].replace('.', ' : ').replace('_', ' ')
 
     # According to the official documentation, an error here means that the
@@ -140,7 +251,11 @@ def jsonify_errors(error, data=None):
     # https://visibility.amp.cisco.com/help/alerts-errors-warnings.
     error['type'] = 'fatal'
 
-    payload = {'errors': [error]}
+    return error
+
+
+def jsonify_errors(error, data=None):
+    payload = {'errors': [format_error(error)]}
     if data:
         payload['data'] = data
 
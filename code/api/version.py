@@ -7,3 +7,7 @@ version_api = Blueprint('version', __name__)
 @version_api.route('/version', methods=['POST'])
 def version():
     return jsonify({'version': current_app.config['VERSION']})
+
+
+async def version_async():
+    return version()
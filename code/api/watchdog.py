@@ -12,3 +12,7 @@ def watchdog():
         return jsonify_data(watchdog_key)
     except KeyError:
         raise WatchdogError
+
+
+async def watchdog_async():
+    return watchdog()
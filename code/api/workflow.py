@@ -1,128 +1,246 @@
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from multiprocessing import cpu_count
+import asyncio
+from collections import defaultdict, namedtuple
+from concurrent.futures import as_completed
+from functools import lru_cache
 from operator import itemgetter
 
-from flask import current_app
-
+from api import integration_async
+from api.budget import Allocation
 from api.integration import (
     get_detections_for_entity,
     get_events_for_detection,
     get_events,
     get_dhcp_records_by_ip,
     is_allowed,
+    _url,
 )
+from api.integration_async import run_sync
+from api.scheduler import get_async_scheduler, get_scheduler
 
 
-def _get_events_for_detection(key, detection_uuid):
-    from app import app
-
-    # Run the original function in the context of the current app since this
-    # helper function will be called in multiple separate worker threads.
-    with app.app_context():
-        return detection_uuid, get_events_for_detection(key, detection_uuid)
+QueryPlan = namedtuple('QueryPlan', [
+    'detections',
+    'events',
+    'day_range',
+    'events_limit',
+    'dhcp',
+])
 
 
-def _values(obj, path):
+def plan_query(context, observable):
     """
-    Extract all the values located on a particular path in a given object.
+    Choose the upstream calls to make for an observable depending on its type
+    (e.g. DHCP records are of little use for hashes) as configured.
+    """
+    return QueryPlan(**{
+        **context.config['GTI_QUERY_PLAN_DEFAULTS'],
+        **context.config['GTI_QUERY_PLANS'].get(observable['type'], {}),
+    })
 
-    The function returns a generator yielding one value at a time.
-    If the path doesn't exist for the object, the function won't yield anything
-    resulting in an empty generator.
 
-    >>> list(_values({'x': {'y': [{'z': 1}, {'z': 2}, {'z': 3}]}}, ('x', 'y', 'z')))  # noqa: E501
-    [1, 2, 3]
-    """
-    if not path:
-        yield obj
-        return
+def _default_allocation(context, allocation):
+    if allocation is None:
+        limit = context.entities_limit
+        allocation = Allocation(limit, limit)
+    return allocation
 
-    key = path[0]
-    if not (isinstance(obj, dict) and key in obj):
-        return
 
-    if isinstance(obj[key], list):
-        for item in obj[key]:
-            yield from _values(item, path[1:])
-    else:
-        yield from _values(obj[key], path[1:])
+def _events_limit(plan, allocation, events):
+    limit = allocation.share - len(events)
+    if plan.events_limit is not None:
+        limit = min(limit, plan.events_limit)
+    return limit
 
 
-def get_events_for_observable(key, observable):
-    entity = observable['value']
+def explain_query(context, observable, allocation=None):
+    """
+    Describe the upstream calls planned for an observable along with their
+    estimated number without actually making any of them.
 
-    detections, error = get_detections_for_entity(key, entity)
+    The number of detections (i.e. of the calls for their events) can't be
+    known in advance, so it is estimated as configured.
+    """
+    allocation = _default_allocation(context, allocation)
+
+    plan = plan_query(context, observable)
+
+    calls = []
+
+    if plan.detections:
+        calls.append({
+            'step': 'detections',
+            'method': 'GET',
+            'url': _url(context, 'detection', 'detections'),
+            'count': 1,
+        })
+        calls.append({
+            'step': 'events_for_detections',
+            'method': 'GET',
+            'url': _url(context, 'detection', 'events'),
+            'count': context.config['GTI_QUERY_PLAN_EXPECTED_DETECTIONS'],
+            'limit': allocation.detected,
+        })
+
+    limit = _events_limit(plan, allocation, [])
+    if plan.events and limit > 0:
+        calls.append({
+            'step': 'events',
+            'method': 'POST',
+            'url': _url(context, 'event', 'query'),
+            # One call per day at most (stopping as soon as the limit is hit).
+            'count': plan.day_range,
+            'limit': limit,
+        })
+
+    if plan.dhcp:
+        calls.append({
+            'step': 'dhcp_records',
+            'method': 'POST',
+            'url': _url(context, 'entity', 'entity/tracking/bulk/get/ip'),
+            'count': 1,
+        })
+
+    return {
+        'observable': observable,
+        'plan': plan._asdict(),
+        'calls': calls,
+        'estimated_calls': sum(call['count'] for call in calls),
+    }
+
+
+def _get_events_for_detection(context, detection_uuid, entity, limit):
+    return detection_uuid, get_events_for_detection(
+        context, detection_uuid, entity, limit=limit
+    )
+
+
+async def _get_events_for_detection_async(context, detection_uuid,
+                                          entity, limit):
+    return detection_uuid, await integration_async.get_events_for_detection(
+        context, detection_uuid, entity, limit=limit
+    )
+
+
+_MISSING = object()
+
+
+def _leaf_matcher(key):
+    def match(obj, value):
+        if not isinstance(obj, dict):
+            return False
+
+        item = obj.get(key, _MISSING)
+        if isinstance(item, list):
+            return value in item
+        return item is not _MISSING and item == value
+
+    return match
+
+
+def _step_matcher(key, match_item):
+    def match(obj, value):
+        if not isinstance(obj, dict):
+            return False
+
+        item = obj.get(key, _MISSING)
+        if isinstance(item, list):
+            for element in item:
+                if match_item(element, value):
+                    return True
+            return False
+        return item is not _MISSING and match_item(item, value)
+
+    return match
+
+
+@lru_cache(maxsize=1024)
+def _compile_path(path):
+    """
+    Compile a path into a function matching a value against all the values
+    located on that path in a given object (along with any lists on it).
+
+    >>> match = _compile_path(('x', 'y', 'z'))
+    >>> match({'x': {'y': [{'z': 1}, {'z': 2}, {'z': 3}]}}, 2)
+    True
+    >>> match({'x': {'y': {'z': [1, 2]}}}, 3)
+    False
+    """
+    match = _leaf_matcher(path[-1])
+    for key in reversed(path[:-1]):
+        match = _step_matcher(key, match)
+    return match
+
+
+@lru_cache(maxsize=1024)
+def _compile_field(field):
+    """
+    Compile an indicator field into the type of its values along with the
+    function matching a value against the values of an event in that field.
+
+    E.g.
+    'dst.ip' -> ('dst', 'ip'),
+    'http:host.domain' -> ('host', 'domain'),
+    'http:files.sha256' -> ('files', 'sha256'),
+    etc.
+    """
+    path = tuple(field.split(':')[-1].split('.'))
+    return path[-1], _compile_path(path)
 
-    if error:
-        return None, error
 
-    # Fetch all the detections for the given entity and then all the events for
-    # each detection enriching them with some additional context along the way.
+def _detected_events(context, entity, detections, results):
+    """
+    Match the events for each detection against the given entity enriching
+    them with some additional context along the way.
 
+    The results are `(detection_uuid, (events_for_detection, error))` pairs
+    coming in any order (e.g. as soon as the corresponding calls complete).
+    """
     events = []
 
     impacted_devices_by_rule_account = defaultdict(set)
     indicator_values_by_rule_account = defaultdict(set)
 
-    with ThreadPoolExecutor(max_workers=(cpu_count() or 1) * 5) as executor:
-        futures = [
-            executor.submit(_get_events_for_detection, key, detection['uuid'])
-            for detection in detections if
-            is_allowed(detection['account_uuid'])
-        ]
-        for future in as_completed(futures):
-            detection_uuid, (events_for_detection, error) = future.result()
-
-            # Suppress any errors and continue processing.
-            if error:
-                events_for_detection = []
+    for detection_uuid, (events_for_detection, error) in results:
+        # Suppress any errors and continue processing.
+        if error:
+            events_for_detection = []
 
-            detection = next(
-                detection
-                for detection in detections
-                if detection['uuid'] == detection_uuid
-            )
+        detection = next(
+            detection
+            for detection in detections
+            if detection['uuid'] == detection_uuid
+        )
 
-            rule_account = detection['rule']['uuid'], detection['account_uuid']
+        rule_account = detection['rule']['uuid'], detection['account_uuid']
 
-            impacted_devices_by_rule_account[
-                rule_account
-            ].add(
-                detection['device_ip']
-            )
+        impacted_devices_by_rule_account[
+            rule_account
+        ].add(
+            detection['device_ip']
+        )
 
-            indicator_field_paths = []
+        # The compiled functions are shared by equivalent fields (e.g. with
+        # different event types), so match each of them only once.
+        matchers = {}
 
-            observable_types = current_app.config['GTI_OBSERVABLE_TYPES']
+        observable_types = context.config['GTI_OBSERVABLE_TYPES']
 
-            for indicator in detection['indicators']:
-                # E.g.
-                # 'dst.ip' -> ('dst', 'ip'),
-                # 'http:host.domain' -> ('host', 'domain'),
-                # 'http:files.sha256' -> ('files', 'sha256'),
-                # etc.
-                indicator_field_path = tuple(
-                    indicator['field'].split(':')[-1].split('.')
-                )
+        for indicator in detection['indicators']:
+            indicator_type, match = _compile_field(indicator['field'])
 
-                indicator_type = indicator_field_path[-1]
-                if indicator_type in observable_types:
-                    indicator_field_paths.append(indicator_field_path)
+            if indicator_type in observable_types:
+                matchers[match] = None
 
-                    indicator_values_by_rule_account[
-                        rule_account
-                    ].update(
-                        indicator['values']
-                    )
+                indicator_values_by_rule_account[
+                    rule_account
+                ].update(
+                    indicator['values']
+                )
 
-            for event in events_for_detection:
-                if any(
-                    entity in _values(event, indicator_field_path)
-                    for indicator_field_path in indicator_field_paths
-                ):
-                    event['detection'] = detection
-                    events.append(event)
+        for event in events_for_detection:
+            if any(match(event, entity) for match in matchers):
+                event['detection'] = detection
+                events.append(event)
 
     for event in events:
         detection = event['detection']
@@ -139,26 +257,10 @@ def get_events_for_observable(key, observable):
 
         detection['summary'] = summary
 
-    # Fetch some of the most recent events for the given entity and merge them
-    # to the already processed ones making sure to filter out any duplicates.
-
-    event_uuids = frozenset(event['uuid'] for event in events)
-    events_for_entity, error = get_events(key, observable, event_uuids)
-
-    if error:
-        return None, error
-
-    events.extend(events_for_entity)
+    return events
 
-    limit = current_app.config['CTR_ENTITIES_LIMIT']
-
-    events = events[:limit]
-
-    events.sort(key=itemgetter('timestamp'), reverse=True)
-
-    # Additionally, try to enrich each internal device with some of its most
-    # recent DHCP records if available.
 
+def _event_time_by_ip(events):
     event_time_by_ip = {}
 
     for event in events:
@@ -169,11 +271,10 @@ def get_events_for_observable(key, observable):
                 if ip not in event_time_by_ip:
                     event_time_by_ip[ip] = event['timestamp']
 
-    dhcp_records_by_ip, error = get_dhcp_records_by_ip(key, event_time_by_ip)
+    return event_time_by_ip
 
-    if error:
-        return None, error
 
+def _enrich_events(events, observable, dhcp_records_by_ip):
     for event in events:
         for loc in ['src', 'dst']:
             if loc in event and event[loc]['internal']:
@@ -185,4 +286,179 @@ def get_events_for_observable(key, observable):
     for event in events:
         event['observable'] = observable
 
+
+def get_events_for_observable(context, observable, allocation=None):
+    if context.config['GTI_ASYNC_CLIENT']:
+        return run_sync(
+            get_events_for_observable_async(context, observable, allocation)
+        )
+
+    allocation = _default_allocation(context, allocation)
+
+    plan = plan_query(context, observable)
+
+    entity = observable['value']
+
+    events = []
+
+    if plan.detections:
+        detections, error = get_detections_for_entity(context, entity)
+
+        if error:
+            return None, error
+
+        # Fetch all the detections for the given entity and then all the
+        # events for each detection enriching them with some additional
+        # context along the way.
+
+        # The calls are made by the workers shared with all the other
+        # requests, so make sure to tell apart the current one (i.e. its
+        # context).
+        scheduler = get_scheduler(context.config)
+
+        futures = [
+            scheduler.submit(
+                context.tenant,
+                id(context),
+                _get_events_for_detection,
+                context,
+                detection['uuid'],
+                entity,
+                allocation.detected,
+            )
+            for detection in detections if
+            is_allowed(context, detection['account_uuid'])
+        ]
+        events = _detected_events(
+            context,
+            entity,
+            detections,
+            (future.result() for future in as_completed(futures)),
+        )
+
+        # Detection-backed events are preferred over any other ones, so they
+        # may take up even more than the allocated share (but never the other
+        # way).
+        events = events[:allocation.detected]
+
+    # Fetch some of the most recent events for the given entity and merge them
+    # to the already processed ones making sure to filter out any duplicates.
+
+    event_uuids = frozenset(event['uuid'] for event in events)
+    limit = _events_limit(plan, allocation, events)
+
+    if plan.events and limit > 0:
+        events_for_entity, error = get_events(
+            context, observable, event_uuids,
+            limit=limit, day_range=plan.day_range,
+        )
+
+        if error:
+            return None, error
+
+        events.extend(events_for_entity[:limit])
+
+    events.sort(key=itemgetter('timestamp'), reverse=True)
+
+    # Additionally, try to enrich each internal device with some of its most
+    # recent DHCP records if available.
+
+    dhcp_records_by_ip = {}
+
+    if plan.dhcp:
+        dhcp_records_by_ip, error = get_dhcp_records_by_ip(
+            context, _event_time_by_ip(events)
+        )
+
+        if error:
+            return None, error
+
+    _enrich_events(events, observable, dhcp_records_by_ip)
+
+    return events, None
+
+
+async def get_events_for_observable_async(context,
+                                          observable,
+                                          allocation=None):
+    """
+    The same as `get_events_for_observable`, but fetches all the events for
+    the detections concurrently on the event loop instead of worker threads
+    (still taking turns with the other requests the same way).
+    """
+    allocation = _default_allocation(context, allocation)
+
+    plan = plan_query(context, observable)
+
+    entity = observable['value']
+
+    events = []
+
+    if plan.detections:
+        detections, error = await integration_async.get_detections_for_entity(
+            context, entity
+        )
+
+        if error:
+            return None, error
+
+        scheduler = get_async_scheduler(context.config)
+
+        futures = [
+            scheduler.submit(
+                context.tenant,
+                id(context),
+                _get_events_for_detection_async,
+                context,
+                detection['uuid'],
+                entity,
+                allocation.detected,
+            )
+            for detection in detections if
+            is_allowed(context, detection['account_uuid'])
+        ]
+
+        try:
+            results = [
+                await result for result in asyncio.as_completed(futures)
+            ]
+        finally:
+            # Don't leave any queued calls behind if the lookup fails.
+            for future in futures:
+                future.cancel()
+
+        events = _detected_events(context, entity, detections, results)
+
+        events = events[:allocation.detected]
+
+    event_uuids = frozenset(event['uuid'] for event in events)
+    limit = _events_limit(plan, allocation, events)
+
+    if plan.events and limit > 0:
+        events_for_entity, error = await integration_async.get_events(
+            context, observable, event_uuids,
+            limit=limit, day_range=plan.day_range,
+        )
+
+        if error:
+            return None, error
+
+        events.extend(events_for_entity[:limit])
+
+    events.sort(key=itemgetter('timestamp'), reverse=True)
+
+    dhcp_records_by_ip = {}
+
+    if plan.dhcp:
+        dhcp_records_by_ip, error = (
+            await integration_async.get_dhcp_records_by_ip(
+                context, _event_time_by_ip(events)
+            )
+        )
+
+        if error:
+            return None, error
+
+    _enrich_events(events, observable, dhcp_records_by_ip)
+
     return events, None
@@ -2,9 +2,13 @@ import traceback
 
 from flask import Flask, jsonify
 
+from api.admission import AdmissionController
+from api.bulk import bulk_api
 from api.enrich import enrich_api
 from api.errors import RelayError
 from api.health import health_api
+from api.jsonlib import JSONDecoder, JSONEncoder
+from api.metrics import metrics_api
 from api.version import version_api
 from api.watchdog import watchdog_api
 
@@ -13,8 +17,22 @@ app = Flask(__name__)
 app.url_map.strict_slashes = False
 app.config.from_object('config.Config')
 
+if app.config['JSON_FAST_BACKEND']:
+    app.json_encoder = JSONEncoder
+    app.json_decoder = JSONDecoder
+
+app.extensions['admission'] = AdmissionController(
+    tenant_limit=app.config['ADMISSION_TENANT_LIMIT'],
+    total_limit=app.config['ADMISSION_TOTAL_LIMIT'],
+    timeout=app.config['ADMISSION_TIMEOUT'],
+    directory=app.config['ADMISSION_DIRECTORY'],
+    tenant_buckets=app.config['ADMISSION_TENANT_BUCKETS'],
+)
+
+app.register_blueprint(bulk_api)
 app.register_blueprint(health_api)
 app.register_blueprint(enrich_api)
+app.register_blueprint(metrics_api)
 app.register_blueprint(version_api)
 app.register_blueprint(watchdog_api)
 
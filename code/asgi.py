@@ -0,0 +1,155 @@
+import sys
+from io import BytesIO
+
+from flask import request
+
+from api.bulk import observe_observables_bulk_async
+from api.enrich import (
+    admit_request,
+    admit_request_async,
+    observe_observables_async,
+    refer_observables_async,
+)
+from api.health import health_async
+from api.integration_async import close_session
+from api.metrics import get_metrics_async
+from api.scheduler import close_async_scheduler
+from api.version import version_async
+from api.watchdog import watchdog_async
+from app import app
+
+# The ASGI app reuses the routing, the configuration and the error handling
+# of the WSGI app, but serves each route with its asynchronous counterpart.
+ASYNC_VIEWS = {
+    'bulk.observe_observables_bulk': observe_observables_bulk_async,
+    'enrich.observe_observables': observe_observables_async,
+    'enrich.refer_observables': refer_observables_async,
+    'health.health': health_async,
+    'metrics.get_metrics': get_metrics_async,
+    'version.version': version_async,
+    'watchdog.watchdog': watchdog_async,
+}
+
+
+async def _read_body(receive):
+    body = b''
+
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+def _environ(scope, body):
+    """Build a WSGI environ from an ASGI HTTP connection scope."""
+    server = scope.get('server') or ('localhost', 80)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+
+        if name in environ:
+            value = f'{environ[name]},{value}'
+
+        environ[name] = value
+
+    # The body is already read in full (even if it was chunked).
+    environ['CONTENT_LENGTH'] = str(len(body))
+
+    return environ
+
+
+async def _dispatch():
+    try:
+        if request.routing_exception is not None:
+            raise request.routing_exception
+
+        # Requests are admitted without blocking the event loop, so the hooks
+        # don't wait for anything.
+        hooks = app.before_request_funcs.get(request.blueprint, ())
+        if admit_request in hooks:
+            await admit_request_async()
+
+        rv = app.preprocess_request()
+        if rv is None:
+            rv = await ASYNC_VIEWS[request.endpoint]()
+    except Exception as exception:
+        rv = app.handle_user_exception(exception)
+
+    return app.process_response(app.make_response(rv))
+
+
+async def _iter_body(response):
+    # Asynchronous views may stream their responses from async generators.
+    if hasattr(response.response, '__aiter__'):
+        async for chunk in response.response:
+            yield chunk
+    else:
+        for chunk in response.iter_encoded():
+            yield chunk
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_scheduler()
+            await close_session()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    assert scope['type'] == 'http'
+
+    body = await _read_body(receive)
+
+    with app.request_context(_environ(scope, body)):
+        response = await _dispatch()
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in response.headers.items()
+            ],
+        })
+
+        async for chunk in _iter_body(response):
+            await send({
+                'type': 'http.response.body',
+                'body': chunk,
+                'more_body': True,
+            })
+
+        await send({'type': 'http.response.body'})
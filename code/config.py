@@ -1,4 +1,7 @@
 import json
+import os
+import tempfile
+from multiprocessing import cpu_count
 
 
 class Config:
@@ -10,10 +13,79 @@ class Config:
         '<tr-integrations-support@cisco.com>'
     )
 
+    # Encode/decode JSON with `orjson` (if installed) instead of the standard
+    # `json` module. The output stays exactly the same either way.
+    JSON_FAST_BACKEND = True
+
     CTR_ENTITIES_LIMIT_DEFAULT = 100
 
     CTR_ENTITIES_LIMIT_MAX = 1000
 
+    # Maximum number of events (i.e. sightings) in a single response shared by
+    # all the requested observables, and the strategy of allocating it (either
+    # 'round-robin' or 'weighted', i.e. preferring detection-backed events).
+    CTR_ENTITIES_BUDGET = 1000
+    CTR_ENTITIES_BUDGET_STRATEGY = 'round-robin'
+
+    # Maximum number of events referenced by a single aggregated sighting.
+    CTR_AGGREGATED_EVENTS_SAMPLE = 10
+
+    # Maximum number of unique relations embedded into a single sighting (the
+    # rest are only counted), or None to embed all of them.
+    CTR_SIGHTING_RELATIONS_LIMIT = 100
+
+    # Maximum (approximate) size of the bundle of observed entities in bytes
+    # (or None for no limit). The most important sightings (detected ones
+    # first, then the most recent ones) fitting into it are kept, and a
+    # warning is returned about the rest of them.
+    CTR_RESPONSE_SIZE_LIMIT = 10 * 2 ** 20
+
+    # Encode the bundle of observed entities lazily while sending it (one
+    # entity at a time) instead of the whole response at once, which lowers
+    # the peak memory usage for large bundles. The response stays the same.
+    CTR_STREAMING_RESPONSE = False
+
+    # Number of processes per worker process taking over mapping events into
+    # sightings and encoding them for requests with at least the threshold
+    # number of events (or sightings), so that these don't hold the GIL shared
+    # with the other requests, or 0 to do everything in place.
+    CTR_OFFLOAD_PROCESSES = 0
+    CTR_OFFLOAD_THRESHOLD = 1000
+
+    # Python interpreter to start the offloading processes with, or None for
+    # the current one (which is looked up next to the embedded one in uWSGI,
+    # since `sys.executable` is the uWSGI binary there).
+    CTR_OFFLOAD_EXECUTABLE = None
+
+    # Compress the responses of the enrichment endpoints with either brotli
+    # (if installed) or gzip, if accepted by the client and not too short
+    # (in bytes). Streamed responses are always compressed.
+    CTR_COMPRESSION = True
+    CTR_COMPRESSION_THRESHOLD = 1024
+    CTR_COMPRESSION_LEVELS = {'br': 4, 'gzip': 6}
+
+    # Maximum number of observables looked up concurrently by a single bulk
+    # enrichment request (the rest of them wait in the input order).
+    CTR_BULK_CONCURRENCY = 10
+
+    # Maximum number of enrichment requests served concurrently by all the
+    # worker processes per tenant (i.e. API key) and in total, the maximum
+    # time (in seconds) to wait for a free slot before shedding a request, and
+    # the directory (shared by the worker processes) keeping track of the
+    # slots. The limits may be set from the environment. The defaults match
+    # the 4 processes with 2 threads each served by uWSGI (see
+    # `scripts/uwsgi.ini`), so no tenant can occupy more than half of them,
+    # while `scripts/start.sh` raises them when serving the ASGI app.
+    ADMISSION_TENANT_LIMIT = int(os.environ.get('ADMISSION_TENANT_LIMIT', 4))
+    ADMISSION_TOTAL_LIMIT = int(os.environ.get('ADMISSION_TOTAL_LIMIT', 8))
+    ADMISSION_TIMEOUT = 2
+    ADMISSION_DIRECTORY = os.path.join(tempfile.gettempdir(), 'gti-admission')
+
+    # Number of buckets the tenants are hashed into for the per-tenant limit
+    # (i.e. the tenants in the same bucket share the limit), which bounds the
+    # number of slot files created for (not yet authenticated) tenants.
+    ADMISSION_TENANT_BUCKETS = 256
+
     GTI_OBSERVABLE_TYPES = {
         'ip': 'IP',
         'domain': 'domain',
@@ -30,6 +102,26 @@ class Config:
         'entity': 'https://entity.icebrg.io/v2/',
     }
 
+    # Number of threads per worker process making calls to the GTI API on
+    # behalf of all the requests, and the weights of tenants (by digests of
+    # their API keys) when taking turns to make their calls (defaults to 1).
+    GTI_UPSTREAM_WORKERS = (cpu_count() or 1) * 5
+    GTI_UPSTREAM_TENANT_WEIGHTS = {}
+
+    # Send a second identical request if a call to an idempotent endpoint of
+    # the GTI API takes longer than the recent 95th percentile of its
+    # latencies, taking whichever response comes first. The budget is the
+    # maximum ratio of such extra calls to all the calls.
+    GTI_HEDGING = False
+    GTI_HEDGING_BUDGET = 0.05
+
+    # Query the GTI API asynchronously (i.e. multiplexing all the concurrent
+    # calls on one event loop per worker instead of one thread per call).
+    GTI_ASYNC_CLIENT = False
+
+    # Maximum number of simultaneous connections to the GTI API per worker.
+    GTI_ASYNC_CONNECTIONS_LIMIT = 100
+
     GTI_UI_RULE_URL = 'https://portal.icebrg.io/detections/rules/{rule_uuid}'
     GTI_UI_RULE_ACCOUNT_URL = GTI_UI_RULE_URL + '?account_uuid={account_uuid}'
 
@@ -41,3 +133,44 @@ class Config:
     }
 
     DAY_RANGE = 7  # Default day range for Gigamon API events search
+
+    # Upstream calls to make for each type of observables, i.e. whether to
+    # look for detections (along with their events), whether to query for the
+    # most recent events (within a number of days and up to a limit if any),
+    # and whether to fetch DHCP records for internal IPs. Any settings missing
+    # for a particular type are taken from the defaults, e.g.
+    # {'sha256': {'dhcp': False}}.
+    GTI_QUERY_PLAN_DEFAULTS = {
+        'detections': True,
+        'events': True,
+        'day_range': DAY_RANGE,
+        'events_limit': None,
+        'dhcp': True,
+    }
+    GTI_QUERY_PLANS = {}
+
+    # Return the planned upstream calls (along with their estimated number)
+    # instead of making them when observing observables with `?explain`.
+    # The number of detections per observable can't be known in advance.
+    GTI_QUERY_PLAN_EXPLAIN = False
+    GTI_QUERY_PLAN_EXPECTED_DETECTIONS = 5
+
+    # Parse the events coming from the GTI API one by one as they are being
+    # downloaded (instead of the whole payload at once), so that the rest of
+    # the payload isn't downloaded at all once enough events are collected.
+    GTI_STREAMING_PARSE = False
+
+    # Request only the fields of events actually used for building CTIM
+    # entities when querying the GTI API for events (instead of all of them).
+    GTI_EVENTS_QUERY_PROJECTION = False
+
+    # Push the indicator value, the time bound (i.e. the day range) and the
+    # limit down to the GTI API when fetching the events of detections. Only
+    # enable if the GTI API supports all of them, since otherwise the limit
+    # may cut off some of the matching events.
+    GTI_DETECTION_EVENTS_PUSH_DOWN = False
+
+    # Derive CTIM IDs of sightings and relationships from the UUIDs of the
+    # underlying GTI events and rules instead of generating random ones, so
+    # that the same data always results in the same entities.
+    CTIM_DETERMINISTIC_IDS = False
@@ -0,0 +1,136 @@
+"""
+Post-processing of a batch of events (filtering out seen events and test
+accounts, sorting by time and collecting internal IPs for DHCP records):
+per-event passes (see `api.integration._events` and
+`api.workflow._event_time_by_ip`) vs columnar passes (i.e. extracting the
+columns first and then processing them with builtins only).
+
+Sets the crossover point (if any) from which the columnar passes win.
+"""
+
+import random
+from itertools import compress
+from operator import itemgetter
+
+from api.context import Context
+from api.integration import _events, _excluded_accounts, is_allowed
+from api.workflow import _event_time_by_ip
+from app import app
+from tests.benchmarks.utils import make_events, measure, report
+
+SIZES = [10, 100, 1000, 10000]
+
+
+def previous(context, events, event_uuids):
+    # The original implementation (checking the account of each event).
+    events = [
+        event for event in events
+        if event['uuid'] not in event_uuids and
+        is_allowed(context, event['customer_id'])
+    ]
+    events.sort(key=itemgetter('timestamp'), reverse=True)
+    return events, _event_time_by_ip(events)
+
+
+def current(context, events, event_uuids):
+    events = list(_events(context, events, event_uuids))
+    events.sort(key=itemgetter('timestamp'), reverse=True)
+    return events, _event_time_by_ip(events)
+
+
+def _internal_ip(device):
+    if device and device['internal']:
+        return device['ip']
+    return None
+
+
+def columnar(context, events, event_uuids):
+    excluded_accounts = _excluded_accounts(context)
+
+    uuids = map(itemgetter('uuid'), events)
+    accounts = map(itemgetter('customer_id'), events)
+    events = list(compress(events, [
+        not (uuid in event_uuids or account in excluded_accounts)
+        for uuid, account in zip(uuids, accounts)
+    ]))
+
+    timestamps = list(map(itemgetter('timestamp'), events))
+    order = sorted(
+        range(len(events)), key=timestamps.__getitem__, reverse=True
+    )
+    events = list(map(events.__getitem__, order))
+    timestamps = list(map(timestamps.__getitem__, order))
+
+    ips = []
+    for loc in ['src', 'dst']:
+        ips.append(map(_internal_ip, map(
+            dict.get, events, [loc] * len(events)
+        )))
+    pairs = [
+        pair
+        for src_pair, dst_pair in zip(
+            zip(ips[0], timestamps), zip(ips[1], timestamps)
+        )
+        for pair in [src_pair, dst_pair]
+        if pair[0] is not None
+    ]
+
+    # The most recent (i.e. the first) time of each IP in the same order.
+    event_time_by_ip = dict(reversed(pairs))
+    event_time_by_ip = {
+        ip: event_time_by_ip[ip] for ip in dict.fromkeys(
+            ip for ip, _ in pairs
+        )
+    }
+
+    return events, event_time_by_ip
+
+
+def make_batch(count):
+    random.seed(count)
+
+    events = make_events(count, files=0)
+    for event in events:
+        event['timestamp'] = '2020-05-04T21:{:02}:{:02}.000Z'.format(
+            random.randrange(60), random.randrange(60)
+        )
+        event['customer_id'] = random.choice(['cstmr', 'dmo'])
+        event['dst']['ip'] = f'10.1.70.{random.randrange(256)}'
+
+    # A third of them are already seen (e.g. as detected events).
+    event_uuids = frozenset(event['uuid'] for event in events[::3])
+
+    return events, event_uuids
+
+
+def main():
+    context = Context(key=None, config=app.config, entities_limit=100)
+
+    crossover = None
+
+    for size in SIZES:
+        events, event_uuids = make_batch(size)
+
+        expected = previous(context, events, event_uuids)
+        assert current(context, events, event_uuids) == expected
+        assert columnar(context, events, event_uuids) == expected
+
+        times = {
+            name: measure(lambda: function(context, events, event_uuids))
+            for name, function in [('previous', previous),
+                                   ('current', current),
+                                   ('columnar', columnar)]
+        }
+
+        if crossover is None and times['columnar'] < times['current']:
+            crossover = size
+
+        report(f'{size} events:', [
+            (f'{name}, ms', f'{time:.3f}') for name, time in times.items()
+        ])
+
+    report('Crossover:', [('columnar wins from', crossover or 'never')])
+
+
+if __name__ == '__main__':
+    main()
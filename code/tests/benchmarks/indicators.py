@@ -0,0 +1,82 @@
+"""
+Matching of events against the indicators of detections with the compiled
+field extractors (see `api.workflow._compile_field`) vs walking each event
+with a generator per indicator field.
+"""
+
+from api.workflow import _compile_field
+from tests.benchmarks.utils import make_events, measure, report
+
+FIELDS = [
+    'src.ip',
+    'dst.ip',
+    'http:host.domain',
+    'http:files.md5',
+    'http:files.sha1',
+    'http:files.sha256',
+    'dns:query.domain',
+    'dns:answers.ip',
+    'x509:san_dns.domain',
+    'ssl:server_name_indication.domain',
+]
+
+
+def _values(obj, path):
+    # The original implementation.
+    if not path:
+        yield obj
+        return
+
+    key = path[0]
+    if not (isinstance(obj, dict) and key in obj):
+        return
+
+    if isinstance(obj[key], list):
+        for item in obj[key]:
+            yield from _values(item, path[1:])
+    else:
+        yield from _values(obj[key], path[1:])
+
+
+def match_values(events, fields, entity):
+    paths = [tuple(field.split(':')[-1].split('.')) for field in fields]
+    return [
+        event
+        for event in events
+        if any(entity in _values(event, path) for path in paths)
+    ]
+
+
+def match_compiled(events, fields, entity):
+    matchers = dict.fromkeys(_compile_field(field)[1] for field in fields)
+    return [
+        event
+        for event in events
+        if any(match(event, entity) for match in matchers)
+    ]
+
+
+def main():
+    for count, indicators in [(100, 3), (1000, 10)]:
+        events = make_events(count)
+        fields = FIELDS[:indicators]
+
+        # The last file of the last event (i.e. the worst case for both).
+        entity = events[-1]['files'][-1]['sha256']
+
+        rows = []
+
+        for name, function in [('generators', match_values),
+                               ('compiled', match_compiled)]:
+            time = measure(lambda: function(events, fields, entity))
+            rows.append((f'{name}, ms', f'{time:.3f}'))
+
+        rows.append(('identical output', match_values(
+            events, fields, entity
+        ) == match_compiled(events, fields, entity)))
+
+        report(f'{count} events, {indicators} indicators:', rows)
+
+
+if __name__ == '__main__':
+    main()
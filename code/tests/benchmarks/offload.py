@@ -0,0 +1,92 @@
+"""
+Mapping events into sightings and encoding them in the current process vs
+in the pool of processes (see `api.offload`): the wall time and the CPU time
+of the current process (i.e. roughly the time it holds the GIL shared with
+the other requests served by the same worker process, including pickling in
+the background threads of the pool).
+
+Sets the threshold (see `CTR_OFFLOAD_THRESHOLD`) from which the pool pays
+off, i.e. the current process spends less than half the CPU time it does in
+place, while the wall time doesn't grow by more than 10% (for all the
+larger numbers of events too).
+"""
+
+from time import perf_counter, process_time
+
+from api import offload
+from api.bundle import Bundle
+from api.context import Context
+from api.enrich import bundle_events
+from api.jsonlib import dumps
+from app import app
+from tests.benchmarks.utils import make_events, report
+
+SIZES = [10, 30, 100, 300, 1000, 3000]
+
+REPEAT = 5
+
+
+def serve(events, offloaded):
+    """Map the events into a bundle and encode it."""
+    context = Context(key=None, config=app.config, entities_limit=100)
+
+    app.config['CTR_OFFLOAD_THRESHOLD'] = 0 if offloaded else len(events) + 1
+
+    bundle = Bundle()
+    bundle_events(bundle, context, events, {})
+
+    return ''.join(bundle.stream(dumps))
+
+
+def timed(function):
+    """Return the best wall and process CPU times (in milliseconds)."""
+    wall, cpu = [], []
+
+    for _ in range(REPEAT):
+        start, start_cpu = perf_counter(), process_time()
+        function()
+        wall.append(perf_counter() - start)
+        cpu.append(process_time() - start_cpu)
+
+    return min(wall) * 1000, min(cpu) * 1000
+
+
+def main():
+    app.config['CTR_OFFLOAD_PROCESSES'] = 2
+    # Make the outputs comparable.
+    app.config['CTIM_DETERMINISTIC_IDS'] = True
+
+    threshold = None
+
+    with app.app_context():
+        # Don't count starting the processes.
+        serve(make_events(10), offloaded=True)
+
+        for size in SIZES:
+            events = make_events(size)
+
+            assert serve(events, False) == serve(events, True)
+
+            wall, cpu = timed(lambda: serve(events, offloaded=False))
+            offloaded_wall, offloaded_cpu = timed(
+                lambda: serve(events, offloaded=True)
+            )
+
+            report(f'Mapping and encoding, {size} events:', [
+                ('in place, wall/CPU ms', f'{wall:.1f}/{cpu:.1f}'),
+                ('offloaded, wall/CPU ms',
+                 f'{offloaded_wall:.1f}/{offloaded_cpu:.1f}'),
+            ])
+
+            if offloaded_cpu < cpu / 2 and offloaded_wall <= wall * 1.1:
+                threshold = threshold or size
+            else:
+                threshold = None
+
+    offload.get_pool(app.config).shutdown()
+
+    print(f'Threshold: {threshold or "never"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Memory usage of sightings mapped into CTIM dicts vs compact records (see
+`api.mappings.SightingRecord`) rendered into CTIM dicts only when needed.
+"""
+
+import gc
+import tracemalloc
+from unittest import mock
+
+from api.mappings import Sighting
+from app import app
+from tests.benchmarks.utils import make_events, report
+
+
+def traced(function, events):
+    """Return the memory (in MB) taken by the result of a function."""
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        result = function(events)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    del result
+    return size / 2 ** 20
+
+
+def dicts(events):
+    return [Sighting.map(event) for event in events]
+
+
+def records(events):
+    return [Sighting.record([event]) for event in events]
+
+
+def main():
+    # Make the output comparable (i.e. not depending on random IDs).
+    with app.app_context(), \
+            mock.patch.dict(app.config, {'CTIM_DETERMINISTIC_IDS': True}):
+        for sightings in [1000, 10000]:
+            events = make_events(sightings)
+
+            rows = []
+
+            for name, function in [('CTIM dicts', dicts),
+                                   ('records', records)]:
+                size = traced(function, events)
+                rows.append((f'{name}, MB', f'{size:.1f}'))
+
+            rows.append(('identical output', dicts(events[:100]) == [
+                record.json() for record in records(events[:100])
+            ]))
+
+            report(f'Mapped sightings, {sightings} sightings:', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Serialization time of large bundles with the standard `json` module vs the
+fast JSON backend (see `api.jsonlib`).
+"""
+
+from unittest import mock
+
+from flask import json
+
+from api import jsonlib
+from api.bundle import Bundle
+from api.mappings import Sighting, Indicator, Relationship
+from api.utils import jsonify_data
+from app import app
+from tests.benchmarks.utils import make_events, measure, report
+
+
+def make_bundle(sightings):
+    bundle = Bundle()
+
+    for event in make_events(sightings):
+        sighting = bundle.add(Sighting.record([event]))
+        indicator = bundle.add(Indicator.map(event['detection']['rule']))
+        bundle.add(Relationship.map(sighting, indicator))
+
+    return bundle.json()
+
+
+def main():
+    with app.app_context():
+        for sightings in [100, 1000]:
+            data = make_bundle(sightings)
+
+            rows = []
+            outputs = []
+
+            for name, encoder in [
+                ('stdlib', json.JSONEncoder),
+                ('orjson' if jsonlib.orjson else 'stdlib (fallback)',
+                 jsonlib.JSONEncoder),
+            ]:
+                with mock.patch.object(app, 'json_encoder', encoder):
+                    outputs.append(jsonify_data(data).get_data())
+                    time = measure(lambda: jsonify_data(data))
+
+                rows.append((f'{name}, ms', f'{time:.2f}'))
+
+            rows.append(('output size, bytes', len(outputs[0])))
+            rows.append(('identical output', outputs[0] == outputs[1]))
+
+            report(f'jsonify_data, {sightings} sightings:', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Peak memory usage of encoding large bundles into a response at once vs
+streaming them (see `api.utils.stream_data`).
+"""
+
+import tracemalloc
+
+from api.bundle import Bundle
+from api.mappings import Sighting, Indicator, Relationship
+from api.utils import jsonify_data, stream_data
+from app import app
+from tests.benchmarks.utils import make_events, report
+
+
+def make_bundle(events):
+    bundle = Bundle()
+
+    for event in events:
+        sighting = bundle.add(Sighting.record([event]))
+        indicator = bundle.add(Indicator.map(event['detection']['rule']))
+        bundle.add(Relationship.map(sighting, indicator))
+
+    return bundle
+
+
+def traced(function, events):
+    """Return the output size along with the peak memory usage (in MB)."""
+    tracemalloc.start()
+
+    try:
+        # The bundle is counted too, since streaming releases it gradually.
+        size = function(make_bundle(events))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return size, peak / 2 ** 20
+
+
+def jsonify(bundle):
+    return len(jsonify_data(bundle.json()).get_data())
+
+
+def stream(bundle):
+    return sum(len(chunk) for chunk in stream_data(bundle).response)
+
+
+def main():
+    with app.app_context():
+        for sightings in [100, 1000]:
+            events = make_events(sightings)
+
+            rows = []
+
+            for name, function in [('jsonify_data', jsonify),
+                                   ('stream_data', stream)]:
+                size, peak = traced(function, events)
+                rows.append((f'{name}, peak MB', f'{peak:.1f}'))
+
+            rows.append(('output size, bytes', size))
+
+            report(f'Response encoding, {sightings} sightings:', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Helpers shared by the benchmarks (run them from the `code` directory, e.g.
+`python -m tests.benchmarks.serialization`).
+"""
+
+import copy
+from timeit import Timer
+from uuid import UUID
+
+from tests.unit.api.utils import load_fixture
+
+
+def make_events(count, files=10):
+    """
+    Make a number of unique detection-backed HTTP events (with the given
+    number of files each, i.e. quite a few relations per sighting).
+    """
+    template = next(
+        event
+        for event in load_fixture('workflow/events_for_observable')
+        if event['event_type'] == 'http'
+    )
+
+    events = []
+
+    for index in range(count):
+        event = copy.deepcopy(template)
+        event['uuid'] = str(UUID(int=index))
+        event['files'] = [
+            {
+                'md5': f'{index:016x}{number:016x}',
+                'sha1': f'{index:020x}{number:020x}',
+                'sha256': f'{index:032x}{number:032x}',
+            }
+            for number in range(files)
+        ]
+        events.append(event)
+
+    return events
+
+
+def measure(function, repeat=5):
+    """Return the best time of a single call (in milliseconds)."""
+    timer = Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1000
+
+
+def report(title, rows):
+    print(title)
+    for name, value in rows:
+        print(f'  {name:<40} {value}')
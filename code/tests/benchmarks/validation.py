@@ -0,0 +1,46 @@
+"""
+Validation of large arrays of observables: `ObservableSchema(many=True)`
+(followed by filtering out unsupported types) vs `parse_observables`.
+"""
+
+from api.schemas import ObservableSchema, parse_observables
+from app import app
+from tests.benchmarks.utils import measure, report
+
+SIZES = [100, 1000, 10000]
+
+TYPES = ['ip', 'domain', 'md5', 'sha1', 'sha256', 'url']
+
+
+def make_observables(count):
+    return [
+        {'type': TYPES[index % len(TYPES)], 'value': f'Value{index}'}
+        for index in range(count)
+    ]
+
+
+SCHEMA = ObservableSchema(many=True)
+
+
+def schema(data, types):
+    error = SCHEMA.validate(data)
+    assert not error
+    return [observable for observable in data if observable['type'] in types]
+
+
+def main():
+    types = app.config['GTI_OBSERVABLE_TYPES']
+
+    for size in SIZES:
+        data = make_observables(size)
+
+        report(f'Validation, {size} observables:', [
+            ('ObservableSchema, ms',
+             f'{measure(lambda: schema(data, types)):.2f}'),
+            ('parse_observables, ms',
+             f'{measure(lambda: parse_observables(data, types)):.2f}'),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import asyncio
+import importlib
+from http import HTTPStatus
+from threading import Thread
+from unittest import mock
+
+from pytest import fixture, raises
+
+import config
+from api.admission import AdmissionController, digest
+from api.errors import TooManyRequestsError
+from api.metrics import metrics
+
+from tests.unit.test_asgi import asgi_open
+from .utils import headers
+
+
+@fixture(scope='function', autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+@fixture(scope='function')
+def controller(tmp_path):
+    def build(tenant_limit, total_limit, timeout):
+        return AdmissionController(tenant_limit=tenant_limit,
+                                   total_limit=total_limit,
+                                   timeout=timeout,
+                                   directory=str(tmp_path),
+                                   tenant_buckets=256)
+
+    return build
+
+
+def test_admission_within_limits(controller):
+    controller = controller(tenant_limit=2, total_limit=3, timeout=0)
+
+    tickets = [
+        controller.acquire('a'),
+        controller.acquire('a'),
+        controller.acquire('b'),
+    ]
+
+    for ticket in tickets:
+        controller.release(ticket)
+
+    assert metrics.get('admission.queue_time')['count'] == 3
+    assert metrics.get('admission.shed') is None
+
+
+def test_admission_sheds_over_tenant_limit(controller):
+    controller = controller(tenant_limit=1, total_limit=3, timeout=0)
+
+    controller.acquire('a')
+
+    with raises(TooManyRequestsError):
+        controller.acquire('a')
+
+    # The other tenants are still admitted.
+    controller.acquire('b')
+
+    assert metrics.get('admission.shed') == 1
+
+
+def test_admission_sheds_over_total_limit(controller):
+    controller = controller(tenant_limit=1, total_limit=2, timeout=0)
+
+    ticket = controller.acquire('a')
+    controller.acquire(None)
+
+    with raises(TooManyRequestsError):
+        controller.acquire('b')
+
+    # The shed request doesn't keep the slot of its tenant.
+    controller.release(ticket)
+    controller.acquire('b')
+
+    assert metrics.get('admission.shed') == 1
+
+
+def test_admission_waits_for_release(controller):
+    controller = controller(tenant_limit=1, total_limit=1, timeout=5)
+
+    ticket = controller.acquire('a')
+
+    waiter = Thread(target=controller.acquire, args=('b',))
+    waiter.start()
+
+    controller.release(ticket)
+    waiter.join()
+
+    assert metrics.get('admission.shed') is None
+    assert metrics.get('admission.queue_time')['count'] == 2
+
+
+def test_admission_limits_shared_by_processes(controller):
+    # Each worker process has its own controller (using the same directory).
+    first = controller(tenant_limit=1, total_limit=2, timeout=0)
+    second = controller(tenant_limit=1, total_limit=2, timeout=0.5)
+
+    ticket = first.acquire('a')
+
+    with raises(TooManyRequestsError):
+        second.acquire('a')
+
+    second.acquire('b')
+
+    with raises(TooManyRequestsError):
+        second.acquire('c')
+
+    # The slots freed by another process are taken after a while.
+    waiter = Thread(target=second.acquire, args=('c',))
+    waiter.start()
+
+    first.release(ticket)
+    waiter.join()
+
+    assert metrics.get('admission.shed') == 2
+
+
+def test_admission_slot_files_bounded(controller, tmp_path):
+    controller = controller(tenant_limit=1, total_limit=1, timeout=0)
+
+    for index in range(1000):
+        controller.release(controller.acquire(digest(f'key-{index}')))
+
+    # The tenant buckets plus the total slot.
+    assert len(list(tmp_path.iterdir())) <= 256 + 1
+
+
+def test_admission_limits_set_from_environment(monkeypatch):
+    monkeypatch.setenv('ADMISSION_TENANT_LIMIT', '100')
+    monkeypatch.setenv('ADMISSION_TOTAL_LIMIT', '400')
+
+    try:
+        importlib.reload(config)
+        assert config.Config.ADMISSION_TENANT_LIMIT == 100
+        assert config.Config.ADMISSION_TOTAL_LIMIT == 400
+    finally:
+        monkeypatch.undo()
+        importlib.reload(config)
+
+    assert config.Config.ADMISSION_TENANT_LIMIT == 4
+    assert config.Config.ADMISSION_TOTAL_LIMIT == 8
+
+
+def test_admission_waits_async_without_blocking(controller):
+    controller = controller(tenant_limit=1, total_limit=1, timeout=5)
+
+    ticket = controller.acquire('a')
+
+    async def main():
+        waiter = asyncio.create_task(controller.acquire_async('b'))
+
+        # The event loop keeps running the other tasks meanwhile.
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+
+        controller.release(ticket)
+        return await waiter
+
+    assert asyncio.run(main())
+    assert metrics.get('admission.shed') is None
+
+
+def test_enrich_call_when_busy_failure(client, valid_json, valid_jwt,
+                                       controller):
+    app = client.application
+
+    controller = controller(tenant_limit=1, total_limit=1, timeout=0)
+    controller.acquire(digest('someone else'))
+
+    with mock.patch.dict(app.extensions, {'admission': controller}):
+        response = client.post('/observe/observables',
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
+    expected_payload = {
+        'errors': [
+            {
+                'code': 'too many requests',
+                'message': (
+                    'The relay is busy: '
+                    'Too many concurrent requests, please try again later'
+                ),
+                'type': 'fatal',
+            }
+        ]
+    }
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.get_json() == expected_payload
+    assert metrics.get('admission.shed') == 1
+
+
+def test_asgi_enrich_call_when_busy_failure(client, valid_json, valid_jwt,
+                                            controller):
+    app = client.application
+
+    controller = controller(tenant_limit=1, total_limit=1, timeout=0)
+    controller.acquire(digest('someone else'))
+
+    with mock.patch.dict(app.extensions, {'admission': controller}):
+        expected = client.post('/observe/observables',
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
+        response = asgi_open('/observe/observables',
+                             payload=valid_json,
+                             headers=headers(valid_jwt()))
+
+    assert response.status_code == expected.status_code
+    assert response.data == expected.data
+    assert metrics.get('admission.shed') == 2
@@ -0,0 +1,64 @@
+from pytest import raises
+
+from api.budget import Allocation, Budget
+
+
+def test_budget_round_robin():
+    budget = Budget(10, 3, 100, strategy=Budget.ROUND_ROBIN)
+
+    assert budget.allocate() == Allocation(4, 4)
+    budget.spend(4)
+
+    assert budget.allocate() == Allocation(3, 3)
+    budget.spend(3)
+
+    assert budget.allocate() == Allocation(3, 3)
+    budget.spend(3)
+
+    assert budget.exhausted
+    assert budget.allocate() == Allocation(0, 0)
+
+
+def test_budget_redistributes_unused_shares():
+    budget = Budget(10, 3, 100, strategy=Budget.ROUND_ROBIN)
+
+    budget.spend(len([]))
+
+    assert budget.allocate() == Allocation(5, 5)
+
+
+def test_budget_respects_limit():
+    budget = Budget(1000, 2, 100, strategy=Budget.ROUND_ROBIN)
+
+    assert budget.allocate() == Allocation(100, 100)
+
+
+def test_budget_weighted_prefers_detected_events():
+    budget = Budget(10, 3, 100, strategy=Budget.WEIGHTED)
+
+    assert budget.allocate() == Allocation(4, 8)
+    budget.spend(8)
+
+    assert budget.allocate() == Allocation(1, 1)
+    budget.spend(1)
+
+    assert budget.allocate() == Allocation(1, 1)
+
+
+def test_budget_weighted_leaves_fair_shares_to_next_observables():
+    budget = Budget(300, 3, 1000, strategy=Budget.WEIGHTED)
+
+    # The first observable takes at most a couple of fair shares.
+    assert budget.allocate() == Allocation(100, 200)
+    budget.spend(200)
+
+    assert budget.allocate() == Allocation(50, 99)
+    budget.spend(0)
+
+    # So a later observable with detections still gets enough of them.
+    assert budget.allocate() == Allocation(100, 100)
+
+
+def test_budget_with_unknown_strategy_failure():
+    with raises(ValueError):
+        Budget(10, 3, 100, strategy='unknown')
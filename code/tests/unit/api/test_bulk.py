@@ -0,0 +1,255 @@
+import json
+import time
+from http import HTTPStatus
+from threading import Lock
+from unittest import mock
+
+from pytest import fixture
+
+from tests.unit.api.mock_keys_for_tests import \
+    EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+from tests.unit.test_asgi import asgi_open
+from .utils import headers, load_fixture
+
+
+@fixture(scope='module')
+def body():
+    return '\n'.join([
+        json.dumps({'type': 'sha256', 'value': 'SHA256'}),
+        '',
+        '{"type": "ip", ',
+        json.dumps({'type': 'user', 'value': 'admin'}),
+        json.dumps({'type': 'ip', 'value': ''}),
+        json.dumps({'type': 'ip', 'value': '1.1.1.1'}),
+    ]) + '\n'
+
+
+def get_events_for_observable(_, observable, allocation):
+    if observable['type'] == 'ip':
+        return None, {'code': 'permission.denied', 'message': 'Denied.'}
+    return load_fixture('workflow/events_for_observable'), None
+
+
+def expected_lines(client, valid_jwt):
+    # The bundle for an observable is the same as the one sent by the
+    # regular endpoint.
+    data = client.post(
+        '/observe/observables',
+        json=[{'type': 'sha256', 'value': 'sha256'}],
+        headers=headers(valid_jwt()),
+    ).get_json()['data']
+
+    return [
+        {
+            'line': 1,
+            'observable': {'type': 'sha256', 'value': 'sha256'},
+            'data': data,
+        },
+        {
+            'line': 3,
+            'errors': [{
+                'code': 'invalid payload received',
+                'message': 'Invalid JSON payload received. '
+                           '{"_schema": ["Invalid input type."]}.',
+                'type': 'fatal',
+            }],
+        },
+        {
+            'line': 4,
+            'observable': {'type': 'user', 'value': 'admin'},
+            'data': {},
+        },
+        {
+            'line': 5,
+            'errors': [{
+                'code': 'invalid payload received',
+                'message': 'Invalid JSON payload received. '
+                           '{"value": ["Field may not be blank."]}.',
+                'type': 'fatal',
+            }],
+        },
+        {
+            'line': 6,
+            'observable': {'type': 'ip', 'value': '1.1.1.1'},
+            'errors': [{
+                'code': 'permission : denied',
+                'message': 'Denied.',
+                'type': 'fatal',
+            }],
+        },
+    ]
+
+
+def parse_lines(data):
+    return [json.loads(line) for line in data.decode().splitlines()]
+
+
+def test_bulk_call_success(client, body, valid_jwt,
+                           rsa_api_request, rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    with mock.patch.dict(app.config, {'CTIM_DETERMINISTIC_IDS': True}), \
+            mock.patch('api.enrich.get_events_for_observable',
+                       side_effect=get_events_for_observable), \
+            mock.patch('api.bulk.get_events_for_observable',
+                       side_effect=get_events_for_observable):
+        expected = expected_lines(client, valid_jwt)
+
+        response = client.post('/observe/observables/bulk',
+                               data=body,
+                               headers=headers(valid_jwt()))
+
+        # The lines are only produced while the response is being read.
+        lines = parse_lines(response.data)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == 'application/x-ndjson'
+    assert 'Content-Encoding' not in response.headers
+    assert lines == expected
+
+
+def test_bulk_call_keeps_order_within_concurrency(client, valid_jwt,
+                                                  rsa_api_request,
+                                                  rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    lock = Lock()
+    calls = {'running': 0, 'max': 0}
+
+    def get_events_for_observable(_, observable, allocation):
+        with lock:
+            calls['running'] += 1
+            calls['max'] = max(calls['max'], calls['running'])
+
+        # The earlier observables take longer.
+        time.sleep(0.01 * (10 - int(observable['value'].split('.')[-1])))
+
+        with lock:
+            calls['running'] -= 1
+
+        return [], None
+
+    body = ''.join(
+        json.dumps({'type': 'ip', 'value': f'1.1.1.{index}'}) + '\n'
+        for index in range(10)
+    )
+
+    with mock.patch.dict(app.config, {'CTR_BULK_CONCURRENCY': 3}), \
+            mock.patch('api.bulk.get_events_for_observable',
+                       side_effect=get_events_for_observable):
+        response = client.post('/observe/observables/bulk',
+                               data=body,
+                               headers=headers(valid_jwt()))
+
+        lines = parse_lines(response.data)
+
+    assert [line['line'] for line in lines] == list(range(1, 11))
+    assert calls['max'] == 3
+
+
+def test_asgi_bulk_call_matches_wsgi_call(client, body, valid_jwt,
+                                          rsa_api_request, rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    async def get_events_for_observable_async(*args):
+        return get_events_for_observable(*args)
+
+    with mock.patch.dict(app.config, {'CTIM_DETERMINISTIC_IDS': True}), \
+            mock.patch('api.bulk.get_events_for_observable',
+                       side_effect=get_events_for_observable), \
+            mock.patch('api.bulk.get_events_for_observable_async',
+                       side_effect=get_events_for_observable_async):
+        expected = client.post('/observe/observables/bulk',
+                               data=body,
+                               headers=headers(valid_jwt()))
+        expected.get_data()
+
+        response = asgi_open('/observe/observables/bulk',
+                             body=body.encode(),
+                             headers=headers(valid_jwt()))
+
+    assert response.status_code == expected.status_code
+    assert response.headers['content-type'] == expected.content_type
+    assert response.data == expected.data
+
+
+def get_events_or_raise(_, observable, allocation):
+    if observable['value'] == '1.1.1.1':
+        raise ConnectionError('Connection refused')
+    return [], None
+
+
+def expected_lines_with_failure():
+    return [
+        {
+            'line': 1,
+            'observable': {'type': 'ip', 'value': '1.1.1.1'},
+            'errors': [{
+                'code': 'oops',
+                'message': 'Something went wrong.',
+                'type': 'fatal',
+            }],
+        },
+        {
+            'line': 2,
+            'observable': {'type': 'ip', 'value': '2.2.2.2'},
+            'data': {},
+        },
+    ]
+
+
+FAILING_BODY = ''.join(
+    json.dumps({'type': 'ip', 'value': value}) + '\n'
+    for value in ['1.1.1.1', '2.2.2.2']
+)
+
+
+def test_bulk_call_goes_on_after_failed_lookup(client, valid_jwt,
+                                               rsa_api_request,
+                                               rsa_api_response):
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    with mock.patch('api.bulk.get_events_for_observable',
+                    side_effect=get_events_or_raise):
+        response = client.post('/observe/observables/bulk',
+                               data=FAILING_BODY,
+                               headers=headers(valid_jwt()))
+
+        lines = parse_lines(response.data)
+
+    assert response.status_code == HTTPStatus.OK
+    assert lines == expected_lines_with_failure()
+
+
+def test_asgi_bulk_call_goes_on_after_failed_lookup(client, valid_jwt,
+                                                    rsa_api_request,
+                                                    rsa_api_response):
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    async def get_events_or_raise_async(*args):
+        return get_events_or_raise(*args)
+
+    with mock.patch('api.bulk.get_events_for_observable_async',
+                    side_effect=get_events_or_raise_async):
+        response = asgi_open('/observe/observables/bulk',
+                             body=FAILING_BODY.encode(),
+                             headers=headers(valid_jwt()))
+
+    assert response.status_code == HTTPStatus.OK
+    assert parse_lines(response.data) == expected_lines_with_failure()
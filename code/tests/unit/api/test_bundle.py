@@ -0,0 +1,212 @@
+from copy import deepcopy
+from unittest import mock
+
+from api.bundle import Bundle
+from api.jsonlib import dumps
+from api.mappings import Sighting, Indicator, Relationship
+from api.utils import jsonify_data, stream_data
+
+from .utils import load_fixture
+
+
+def events_for_observables(*observables):
+    events = load_fixture('workflow/events_for_observable')
+
+    for observable in observables:
+        for event in deepcopy(events):
+            event['observable'] = observable
+            yield event
+
+
+def fill(bundle, events):
+    for event in events:
+        sighting = bundle.add(Sighting.record([event]))
+
+        if 'detection' in event:
+            indicator = bundle.add(Indicator.map(event['detection']['rule']))
+            bundle.add(Relationship.map(sighting, indicator))
+
+
+def test_bundle_keeps_ids_unique(app_context):
+    events = load_fixture('workflow/events_for_observable')
+
+    bundle = Bundle()
+
+    with mock.patch.dict(app_context.config, {'CTIM_DETERMINISTIC_IDS': True}):
+        for _ in range(2):
+            for event in events:
+                bundle.add(Sighting.record([event]))
+
+    sightings = bundle.json()['sightings']
+
+    assert sightings['count'] == len(events)
+    assert len({sighting['id'] for sighting in sightings['docs']}) == len(
+        events
+    )
+
+
+def test_bundle_deduplicates_entities_across_observables(app_context):
+    observables = [
+        {'type': 'sha256', 'value': 'sha256'},
+        {'type': 'md5', 'value': 'md5'},
+    ]
+
+    bundle = Bundle()
+
+    fill(bundle, events_for_observables(*observables))
+
+    data = bundle.json()
+
+    events = load_fixture('workflow/events_for_observable')
+    detected_events = [event for event in events if 'detection' in event]
+    rule_uuids = {event['detection']['rule']['uuid']
+                  for event in detected_events}
+
+    assert data['sightings']['count'] == len(events)
+    assert data['indicators']['count'] == len(rule_uuids)
+    assert data['relationships']['count'] == len(detected_events)
+
+    for sighting in data['sightings']['docs']:
+        assert sighting['observables'] == observables
+
+    sighting_ids = {sighting['id'] for sighting in data['sightings']['docs']}
+    indicator_ids = {
+        indicator['id'] for indicator in data['indicators']['docs']
+    }
+
+    for relationship in data['relationships']['docs']:
+        assert relationship['source_ref'] in sighting_ids
+        assert relationship['target_ref'] in indicator_ids
+
+
+def test_bundle_deduplicates_aggregated_sightings_by_leading_event(
+        app_context):
+    observables = [
+        {'type': 'sha256', 'value': 'sha256'},
+        {'type': 'md5', 'value': 'md5'},
+    ]
+    events = list(events_for_observables(*observables))
+    first, second = events[:len(events) // 2], events[len(events) // 2:]
+
+    bundle = Bundle()
+
+    # The same leading event with different samples of the other events.
+    bundle.add(Sighting.record([first[0], first[1], first[2]]))
+    bundle.add(Sighting.record([second[0], second[3]]))
+
+    sightings = bundle.json()['sightings']
+
+    assert sightings['count'] == 1
+    assert sightings['docs'][0]['observables'] == observables
+
+
+def test_bundle_stream_matches_json(app_context):
+    observables = [
+        {'type': 'sha256', 'value': 'sha256'},
+        {'type': 'md5', 'value': 'md5'},
+    ]
+
+    bundle = Bundle()
+
+    fill(bundle, events_for_observables(*observables))
+
+    expected = jsonify_data(bundle.json()).get_data()
+
+    # Make sure that the response is actually split into several chunks.
+    response = stream_data(bundle, chunk_size=1024)
+
+    assert response.is_streamed
+    chunks = list(response.response)
+    assert len(chunks) > 1
+    assert b''.join(chunks) == expected
+
+    # All the entities are released once encoded.
+    assert bundle.json() == {}
+    assert ''.join(bundle.stream(dumps)) == '{}'
+
+
+def measure(bundle):
+    return sum(
+        len(dumps(entity)) + 1
+        for entities in bundle.json().values()
+        for entity in entities['docs']
+    )
+
+
+def test_bundle_prefers_detected_sightings_within_max_size(app_context):
+    events = load_fixture('workflow/events_for_observable')
+    detected_events = [event for event in events if 'detection' in event]
+
+    with mock.patch.dict(app_context.config, {'CTIM_DETERMINISTIC_IDS': True}):
+        expected = Bundle()
+        fill(expected, detected_events)
+
+        # The undetected events come first and then get dropped.
+        bundle = Bundle(max_size=measure(expected))
+        fill(bundle, events)
+
+    assert bundle.truncated == len(events) - len(detected_events)
+    assert bundle.json() == expected.json()
+
+
+def test_bundle_prefers_recent_sightings_within_max_size(app_context):
+    events = load_fixture('workflow/events_for_observable')
+    detected_events = [event for event in events if 'detection' in event]
+
+    with mock.patch.dict(app_context.config, {'CTIM_DETERMINISTIC_IDS': True}):
+        expected = Bundle()
+        fill(expected, detected_events[:1])
+
+        bundle = Bundle(max_size=measure(expected))
+        fill(bundle, reversed(events))
+
+    assert bundle.truncated == len(events) - 1
+    assert bundle.json() == expected.json()
+
+
+def test_bundle_drops_relationships_along_with_sightings(app_context):
+    events = load_fixture('workflow/events_for_observable')
+    detected_events = [event for event in events if 'detection' in event]
+
+    # The same events, but more recent and detected by another rule.
+    recent_events = deepcopy(detected_events)
+    for event in recent_events:
+        event['uuid'] = event['uuid'][::-1]
+        event['timestamp'] = event['timestamp'].replace('2020', '2021')
+        event['detection']['rule']['uuid'] = (
+            event['detection']['rule']['uuid'][::-1]
+        )
+
+    with mock.patch.dict(app_context.config, {'CTIM_DETERMINISTIC_IDS': True}):
+        expected = Bundle()
+        fill(expected, recent_events)
+
+        bundle = Bundle(max_size=measure(expected))
+        fill(bundle, detected_events + recent_events)
+
+    # No relationships (or indicators) left without the dropped sightings.
+    assert bundle.truncated == len(detected_events)
+    assert bundle.json() == expected.json()
+
+
+def test_bundle_encodes_entities_once(app_context):
+    events = load_fixture('workflow/events_for_observable')
+
+    encode = mock.Mock(side_effect=dumps)
+    bundle, expected = Bundle(max_size=10 * 2 ** 20, dumps=encode), Bundle()
+
+    with mock.patch.dict(app_context.config, {'CTIM_DETERMINISTIC_IDS': True}):
+        fill(bundle, events)
+        fill(expected, events)
+
+    data = expected.json()
+
+    assert encode.call_count == sum(
+        entities['count'] for entities in data.values()
+    )
+
+    # The measured entities are passed through, so only the types are left.
+    encode.reset_mock()
+
+    assert ''.join(bundle.stream(encode)) == dumps(data)
+    assert encode.call_count == len(data)
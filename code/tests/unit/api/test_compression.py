@@ -0,0 +1,110 @@
+import gzip
+from unittest import mock
+
+from pytest import fixture
+
+from api.metrics import metrics
+from tests.unit.api.mock_keys_for_tests import \
+    EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+from .utils import headers, load_fixture
+
+
+@fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+@fixture(scope='module')
+def observables():
+    return [
+        {'type': 'domain', 'value': f'www.domain{index}.com'}
+        for index in range(20)
+    ]
+
+
+def refer(client, observables, **headers):
+    return client.post(
+        '/refer/observables', json=observables, headers=headers
+    )
+
+
+def test_response_compressed_with_gzip(client, observables):
+    expected = refer(client, observables)
+
+    with mock.patch('api.compression.brotli', None):
+        response = refer(
+            client, observables, **{'Accept-Encoding': 'br, gzip;q=0.9'}
+        )
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert len(response.data) < len(expected.data)
+    assert gzip.decompress(response.data) == expected.data
+
+    ratio = metrics.get('compression.ratio', encoding='gzip')
+    assert ratio['count'] == 1
+    assert ratio['sum'] == len(response.data) / len(expected.data)
+    assert metrics.get('compression.time', encoding='gzip')['count'] == 1
+
+
+def test_response_not_compressed_unless_accepted(client, observables):
+    with mock.patch('api.compression.brotli', None):
+        response = refer(client, observables, **{'Accept-Encoding': 'br'})
+
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.get_json()['data']
+    assert metrics.get('compression.responses', encoding='br') is None
+
+
+def test_short_response_not_compressed(client, observables):
+    response = refer(client, observables[:1], **{'Accept-Encoding': 'gzip'})
+
+    assert len(response.data) < 1024
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json()['data']
+
+
+def test_streamed_response_compressed_with_gzip(client,
+                                                valid_json,
+                                                valid_jwt,
+                                                rsa_api_request,
+                                                rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    def get_events_for_observable(_, observable, allocation):
+        data = (
+            load_fixture('workflow/events_for_observable')
+            if observable['type'] == 'sha256' else
+            []
+        )
+        return data, None
+
+    config = {'CTIM_DETERMINISTIC_IDS': True, 'CTR_STREAMING_RESPONSE': True}
+    target = 'api.enrich.get_events_for_observable'
+
+    with mock.patch.dict(app.config, config), \
+            mock.patch(target, side_effect=get_events_for_observable):
+        expected = client.post('/observe/observables',
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
+        response = client.post('/observe/observables',
+                               json=valid_json,
+                               headers={**headers(valid_jwt()),
+                                        'Accept-Encoding': 'gzip'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    assert gzip.decompress(response.data) == expected.data
+
+    ratio = metrics.get('compression.ratio', encoding='gzip')
+    assert ratio['count'] == 1
+    assert ratio['sum'] == len(response.data) / len(expected.data)
@@ -4,7 +4,8 @@ from unittest import mock
 
 from pytest import fixture
 
-from tests.unit.conftest import GTI_KEY
+from api.budget import Allocation
+from api.enrich import group_events
 from tests.unit.api.mock_keys_for_tests import \
     EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
 from .utils import headers, load_fixture
@@ -143,6 +144,7 @@ def expected_payload(any_route, client, valid_json):
 
 def test_enrich_call_success(any_route,
                              client,
+                             context,
                              valid_json,
                              valid_jwt,
                              expected_payload,
@@ -159,7 +161,7 @@ def test_enrich_call_success(any_route,
     if any_route.startswith('/observe'):
         target = 'api.enrich.get_events_for_observable'
 
-        def side_effect(_, observable):
+        def side_effect(_, observable, allocation):
             data = (
                 load_fixture('workflow/events_for_observable')
                 if observable['type'] == 'sha256' else
@@ -174,10 +176,11 @@ def test_enrich_call_success(any_route,
                                    json=valid_json,
                                    headers=headers(valid_jwt()))
 
-            key = GTI_KEY
+            # The budget is big enough for each observable to get its limit.
+            allocation = Allocation(100, 100)
 
             get_events_for_observable_mock.assert_has_calls([
-                mock.call(key, observable)
+                mock.call(context, observable, allocation)
                 for observable in valid_json
                 if observable['type'] in app.config['GTI_OBSERVABLE_TYPES']
             ])
@@ -193,6 +196,7 @@ def test_enrich_call_success(any_route,
 
 def test_enrich_call_with_auth_error_from_gti_failure(gti_api_route,
                                                       client,
+                                                      context,
                                                       valid_json,
                                                       valid_jwt,
                                                       rsa_api_request,
@@ -217,15 +221,15 @@ def test_enrich_call_with_auth_error_from_gti_failure(gti_api_route,
                                json=valid_json,
                                headers=headers(valid_jwt()))
 
-        key = GTI_KEY
-
         observable = next(
             observable
             for observable in valid_json
             if observable['type'] in app.config['GTI_OBSERVABLE_TYPES']
         )
 
-        get_events_for_observable_mock.assert_called_once_with(key, observable)
+        get_events_for_observable_mock.assert_called_once_with(
+            context, observable, Allocation(100, 100)
+        )
 
     expected_payload = {
         'errors': [
@@ -239,3 +243,167 @@ def test_enrich_call_with_auth_error_from_gti_failure(gti_api_route,
 
     assert response.status_code == HTTPStatus.OK
     assert response.get_json() == expected_payload
+
+
+def test_group_events():
+    def event(event_type, src, dst, rule=None, sensor='snsr'):
+        event = {
+            'event_type': event_type,
+            'src': {'ip': src},
+            'dst': {'ip': dst},
+            'sensor_id': sensor,
+        }
+        if rule:
+            event['detection'] = {'rule': {'uuid': rule}}
+        return event
+
+    events = [
+        event('flow', '10.0.0.1', '8.8.8.8'),
+        event('dns', '10.0.0.1', '8.8.8.8'),
+        event('flow', '10.0.0.1', '8.8.8.8'),
+        event('flow', '10.0.0.1', '8.8.8.8', rule='rule'),
+        event('flow', '10.0.0.1', '8.8.8.8', sensor='other'),
+        event('flow', '10.0.0.1', '8.8.4.4'),
+        event('dns', '10.0.0.1', '8.8.8.8'),
+    ]
+
+    assert group_events(events) == [
+        [events[0], events[2]],
+        [events[1], events[6]],
+        [events[3]],
+        [events[4]],
+        [events[5]],
+    ]
+
+
+def test_observe_call_with_explain(client,
+                                   valid_json,
+                                   valid_jwt,
+                                   rsa_api_request,
+                                   rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    target = 'api.enrich.get_events_for_observable'
+    config = {
+        'GTI_QUERY_PLAN_EXPLAIN': True,
+        'GTI_QUERY_PLANS': {'sha256': {'dhcp': False}},
+    }
+
+    with mock.patch(target) as get_events_for_observable_mock, \
+            mock.patch.dict(app.config, config):
+        response = client.post('/observe/observables?explain',
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
+        get_events_for_observable_mock.assert_not_called()
+
+    assert response.status_code == HTTPStatus.OK
+
+    plans = response.get_json()['data']['plans']
+
+    assert [plan['observable'] for plan in plans] == [
+        observable
+        for observable in valid_json
+        if observable['type'] in app.config['GTI_OBSERVABLE_TYPES']
+    ]
+    for plan in plans:
+        steps = [call['step'] for call in plan['calls']]
+        if plan['observable']['type'] == 'sha256':
+            assert 'dhcp_records' not in steps
+        else:
+            assert 'dhcp_records' in steps
+
+
+def test_observe_call_with_streaming_response(client,
+                                              valid_json,
+                                              valid_jwt,
+                                              rsa_api_request,
+                                              rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    def get_events_for_observable(_, observable, allocation):
+        data = (
+            load_fixture('workflow/events_for_observable')
+            if observable['type'] == 'sha256' else
+            []
+        )
+        return data, None
+
+    target = 'api.enrich.get_events_for_observable'
+
+    with mock.patch.dict(app.config, {'CTIM_DETERMINISTIC_IDS': True}), \
+            mock.patch(target, side_effect=get_events_for_observable):
+        expected = client.post('/observe/observables',
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
+        with mock.patch.dict(app.config, {'CTR_STREAMING_RESPONSE': True}):
+            response = client.post('/observe/observables',
+                                   json=valid_json,
+                                   headers=headers(valid_jwt()))
+
+    # Streamed responses are sent without knowing their length in advance.
+    assert 'Content-Length' in expected.headers
+    assert 'Content-Length' not in response.headers
+    assert response.status_code == HTTPStatus.OK
+    assert response.content_type == expected.content_type
+    assert response.get_json()['data']['sightings']['count']
+    assert response.data == expected.data
+
+
+def test_observe_call_with_truncated_response(client,
+                                              valid_json,
+                                              valid_jwt,
+                                              rsa_api_request,
+                                              rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    def get_events_for_observable(_, observable, allocation):
+        data = (
+            load_fixture('workflow/events_for_observable')
+            if observable['type'] == 'sha256' else
+            []
+        )
+        return data, None
+
+    target = 'api.enrich.get_events_for_observable'
+    config = {'CTIM_DETERMINISTIC_IDS': True, 'CTR_RESPONSE_SIZE_LIMIT': 10}
+
+    responses = []
+
+    with mock.patch.dict(app.config, config), \
+            mock.patch(target, side_effect=get_events_for_observable):
+        for streaming in [False, True]:
+            with mock.patch.dict(app.config,
+                                 {'CTR_STREAMING_RESPONSE': streaming}):
+                responses.append(client.post('/observe/observables',
+                                             json=valid_json,
+                                             headers=headers(valid_jwt())))
+
+    response, streamed_response = responses
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.get_json() == {
+        'data': {},
+        'errors': [
+            {
+                'code': 'response truncated',
+                'message': 'The response exceeded the size limit: '
+                           '4 sightings omitted',
+                'type': 'warning',
+            }
+        ],
+    }
+    assert streamed_response.data == response.data
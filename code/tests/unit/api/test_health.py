@@ -3,7 +3,6 @@ from unittest import mock
 
 from pytest import fixture
 
-from tests.unit.conftest import GTI_KEY
 from tests.unit.api.mock_keys_for_tests import \
     EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
 from .utils import headers
@@ -20,6 +19,7 @@ def route(request):
 
 def test_health_call_success(route,
                              client,
+                             context,
                              valid_jwt,
                              rsa_api_request,
                              rsa_api_response):
@@ -39,19 +39,23 @@ def test_health_call_success(route,
 
         response = client.post(route, headers=headers(valid_jwt()))
 
-        key = GTI_KEY
         entity = app.config['GTI_TEST_ENTITY']
 
-        get_events_mock.assert_called_with(key, entity)
+        get_events_mock.assert_called_with(context, entity)
 
     expected_payload = {'data': {'status': 'ok'}}
 
     assert response.status_code == HTTPStatus.OK
     assert response.get_json() == expected_payload
 
+    # Make sure that no request-scoped settings leak into the shared config.
+    assert 'CTR_ENTITIES_LIMIT' not in app.config
+    assert 'GTI_ALLOW_TEST_ACCOUNTS' not in app.config
+
 
 def test_health_call_with_auth_error_from_gti_failure(route,
                                                       client,
+                                                      context,
                                                       valid_jwt,
                                                       rsa_api_request,
                                                       rsa_api_response):
@@ -73,10 +77,9 @@ def test_health_call_with_auth_error_from_gti_failure(route,
 
         response = client.post(route, headers=headers(valid_jwt()))
 
-        key = GTI_KEY
         entity = app.config['GTI_TEST_ENTITY']
 
-        get_events_mock.assert_called_with(key, entity)
+        get_events_mock.assert_called_with(context, entity)
 
     expected_payload = {
         'errors': [
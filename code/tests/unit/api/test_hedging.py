@@ -0,0 +1,176 @@
+import asyncio
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Timer
+from time import monotonic, sleep
+
+from pytest import fixture
+
+from api.hedging import HedgeBudget, Hedger, LatencyTracker
+from api.metrics import metrics
+
+
+@fixture(scope='function', autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def warmed_up_hedger(ratio=1, latency=0.01, workers=None):
+    hedger = Hedger(ratio, workers=workers)
+
+    tracker = hedger._tracker('events')
+    for _ in range(tracker.min_samples):
+        tracker.record(latency)
+
+    # Make sure there are enough tokens for the first call to be hedged.
+    for _ in range(hedger.budget.capacity):
+        hedger.budget.deposit()
+
+    return hedger
+
+
+def slow_then_fast():
+    calls = count()
+    released = Event()
+
+    def call():
+        if next(calls) == 0:
+            released.wait(timeout=5)
+            return 'slow', None
+        return 'fast', None
+
+    return call, released
+
+
+def test_latency_tracker_percentile():
+    tracker = LatencyTracker(window=100, min_samples=10)
+
+    for latency in range(1, 10):
+        tracker.record(latency)
+    assert tracker.percentile(95) is None
+
+    for latency in range(10, 101):
+        tracker.record(latency)
+    assert tracker.percentile(95) == 95
+
+    # Only the latest latencies are taken into account.
+    for _ in range(100):
+        tracker.record(1)
+    assert tracker.percentile(95) == 1
+
+
+def test_hedge_budget_limits_extra_calls():
+    budget = HedgeBudget(0.05)
+
+    hedges = 0
+    for _ in range(1000):
+        budget.deposit()
+        hedges += budget.withdraw()
+
+    assert hedges == 50
+
+
+def test_hedger_does_not_hedge_without_enough_samples():
+    hedger = Hedger(1)
+
+    call, released = slow_then_fast()
+    released.set()
+
+    assert hedger.call('events', call) == ('slow', None)
+    assert metrics.get('hedging.hedged', endpoint='events') is None
+
+
+def test_hedger_hedges_slow_call():
+    hedger = warmed_up_hedger()
+
+    call, released = slow_then_fast()
+
+    assert hedger.call('events', call) == ('fast', None)
+    assert metrics.get('hedging.hedged', endpoint='events') == 1
+
+    released.set()
+
+
+def test_hedger_prefers_successful_result():
+    hedger = warmed_up_hedger()
+    calls = count()
+
+    def call():
+        if next(calls) == 0:
+            sleep(0.1)
+            return 'data', None
+        return None, {'code': 'code', 'message': 'message'}
+
+    assert hedger.call('events', call) == ('data', None)
+
+
+def test_hedger_does_not_hedge_over_budget():
+    hedger = warmed_up_hedger(ratio=0)
+    hedger.budget._tokens = 0
+
+    call, released = slow_then_fast()
+    Timer(0.1, released.set).start()
+
+    assert hedger.call('events', call) == ('slow', None)
+    assert metrics.get('hedging.hedged', endpoint='events') is None
+    assert metrics.get('hedging.exhausted', endpoint='events') == 1
+
+
+def test_hedger_does_not_cap_concurrency():
+    hedger = warmed_up_hedger(ratio=0, latency=0.2, workers=80)
+    hedger.budget._tokens = 0
+
+    def call():
+        sleep(0.2)
+        return 'data', None
+
+    start = monotonic()
+
+    with ThreadPoolExecutor(40) as executor:
+        results = list(executor.map(
+            lambda _: hedger.call('events', call), range(40)
+        ))
+
+    assert results == [('data', None)] * 40
+    assert monotonic() - start < 0.6
+
+
+def test_hedger_does_not_count_waiting_for_thread():
+    # The only thread is busy with the first call for a while, so the second
+    # call waits for it longer than the delay, but isn't hedged because of
+    # that.
+    hedger = warmed_up_hedger(latency=0.1, workers=1)
+
+    def call():
+        sleep(0.08)
+        return 'data', None
+
+    with ThreadPoolExecutor(2) as executor:
+        results = list(executor.map(
+            lambda _: hedger.call('events', call), range(2)
+        ))
+
+    assert results == [('data', None)] * 2
+    assert metrics.get('hedging.hedged', endpoint='events') is None
+
+
+def test_hedger_hedges_slow_async_call():
+    hedger = warmed_up_hedger()
+    calls = count()
+    cancelled = []
+
+    async def call():
+        if next(calls) == 0:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return 'slow', None
+        return 'fast', None
+
+    assert asyncio.run(hedger.call_async('events', call)) == ('fast', None)
+    assert metrics.get('hedging.hedged', endpoint='events') == 1
+    assert cancelled == [True]
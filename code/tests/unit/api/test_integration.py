@@ -1,23 +1,56 @@
+import json
+from importlib import import_module
 from unittest import mock
 from urllib.parse import urljoin
 from uuid import uuid4
 
-from flask import current_app
 from freezegun import freeze_time
 from pytest import fixture
 
-from api.integration import (
-    get_detections_for_entity,
-    get_events_for_detection,
-    get_events,
-    get_dhcp_records_by_ip,
-)
+from api.integration import _event_filter
+from api.integration_async import run_sync
+from api.mappings import EVENT_FIELDS
+
+
+class Synchronized:
+    """Make an asynchronous implementation callable as a synchronous one."""
+
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        function = getattr(self.module, name)
+
+        def wrapper(*args, **kwargs):
+            return run_sync(function(*args, **kwargs))
+
+        return wrapper
+
+
+def implementations():
+    yield 'api.integration'
+    yield 'api.integration_async'
+
+
+@fixture(scope='module', params=implementations(), ids=lambda module: module)
+def integration(request):
+    module = import_module(request.param)
+
+    if request.param.endswith('_async'):
+        module = Synchronized(module)
+
+    return module
 
 
 @fixture(scope='function')
 def gti_api_request():
+    # Make both implementations send their requests via the same mock.
     with mock.patch('requests.request') as mock_request:
-        yield mock_request
+        async def send(_, method, url, **kwargs):
+            return mock_request(method, url, **kwargs)
+
+        with mock.patch('api.integration_async._send', send):
+            yield mock_request
 
 
 def gti_api_response(*, ok, payload):
@@ -26,11 +59,13 @@ def gti_api_response(*, ok, payload):
     mock_response.ok = ok
 
     mock_response.json = lambda: payload
+    mock_response.content = json.dumps(payload).encode()
 
     return mock_response
 
 
-def test_get_detections_for_entity_failure(client, gti_api_request):
+def test_get_detections_for_entity_failure(client, context, integration,
+                                           gti_api_request):
     app = client.application
 
     expected_error = {
@@ -43,10 +78,9 @@ def test_get_detections_for_entity_failure(client, gti_api_request):
         payload={'error': expected_error},
     )
 
-    key = 'key'
     entity = 'entity'
 
-    detections, error = get_detections_for_entity(key, entity)
+    detections, error = integration.get_detections_for_entity(context, entity)
 
     expected_method = 'GET'
     expected_url = urljoin(
@@ -54,7 +88,7 @@ def test_get_detections_for_entity_failure(client, gti_api_request):
         'detections',
     )
     expected_headers = {
-        'Authorization': f'IBToken {key}',
+        'Authorization': f'IBToken {context.key}',
         'User-Agent': app.config['CTR_USER_AGENT'],
     }
     expected_params = {
@@ -74,7 +108,8 @@ def test_get_detections_for_entity_failure(client, gti_api_request):
     assert error == expected_error
 
 
-def test_get_detections_for_entity_success(client, gti_api_request):
+def test_get_detections_for_entity_success(client, context, integration,
+                                           gti_api_request):
     app = client.application
 
     expected_rules = [{'uuid': str(uuid4())} for _ in range(5)]
@@ -93,10 +128,9 @@ def test_get_detections_for_entity_success(client, gti_api_request):
         for detection, rule in zip(expected_detections, expected_rules * 2)
     ]
 
-    key = 'key'
     entity = 'entity'
 
-    detections, error = get_detections_for_entity(key, entity)
+    detections, error = integration.get_detections_for_entity(context, entity)
 
     expected_method = 'GET'
     expected_url = urljoin(
@@ -104,7 +138,7 @@ def test_get_detections_for_entity_success(client, gti_api_request):
         'detections',
     )
     expected_headers = {
-        'Authorization': f'IBToken {key}',
+        'Authorization': f'IBToken {context.key}',
         'User-Agent': app.config['CTR_USER_AGENT'],
     }
     expected_params = {
@@ -124,7 +158,8 @@ def test_get_detections_for_entity_success(client, gti_api_request):
     assert error is None
 
 
-def test_get_events_for_detection_failure(client, gti_api_request):
+def test_get_events_for_detection_failure(client, context, integration,
+                                          gti_api_request):
     app = client.application
 
     expected_error = {
@@ -137,10 +172,11 @@ def test_get_events_for_detection_failure(client, gti_api_request):
         payload={'error': expected_error},
     )
 
-    key = 'key'
     detection_uuid = 'detection_uuid'
 
-    events, error = get_events_for_detection(key, detection_uuid)
+    events, error = integration.get_events_for_detection(
+        context, detection_uuid
+    )
 
     expected_method = 'GET'
     expected_url = urljoin(
@@ -148,7 +184,7 @@ def test_get_events_for_detection_failure(client, gti_api_request):
         'events',
     )
     expected_headers = {
-        'Authorization': f'IBToken {key}',
+        'Authorization': f'IBToken {context.key}',
         'User-Agent': app.config['CTR_USER_AGENT'],
     }
     expected_params = {
@@ -166,7 +202,8 @@ def test_get_events_for_detection_failure(client, gti_api_request):
     assert error == expected_error
 
 
-def test_get_events_for_detection_success(client, gti_api_request):
+def test_get_events_for_detection_success(client, context, integration,
+                                          gti_api_request):
     app = client.application
 
     expected_events = [{'event': {'uuid': str(uuid4())}} for _ in range(10)]
@@ -178,10 +215,11 @@ def test_get_events_for_detection_success(client, gti_api_request):
 
     expected_events = [event['event'] for event in expected_events]
 
-    key = 'key'
     detection_uuid = 'detection_uuid'
 
-    events, error = get_events_for_detection(key, detection_uuid)
+    events, error = integration.get_events_for_detection(
+        context, detection_uuid
+    )
 
     expected_method = 'GET'
     expected_url = urljoin(
@@ -189,7 +227,7 @@ def test_get_events_for_detection_success(client, gti_api_request):
         'events',
     )
     expected_headers = {
-        'Authorization': f'IBToken {key}',
+        'Authorization': f'IBToken {context.key}',
         'User-Agent': app.config['CTR_USER_AGENT'],
     }
     expected_params = {
@@ -207,8 +245,42 @@ def test_get_events_for_detection_success(client, gti_api_request):
     assert error is None
 
 
+@freeze_time("2021-01-14T03:21:34.123456")
+def test_get_events_for_detection_push_down(client, context, integration,
+                                            gti_api_request):
+    app = client.application
+    app.config['GTI_DETECTION_EVENTS_PUSH_DOWN'] = True
+
+    gti_api_request.return_value = gti_api_response(
+        ok=True,
+        payload={'events': []},
+    )
+
+    try:
+        integration.get_events_for_detection(
+            context, 'detection_uuid', '1.1.1.1', limit=10
+        )
+    finally:
+        app.config['GTI_DETECTION_EVENTS_PUSH_DOWN'] = False
+
+    expected_params = {
+        'detection_uuid': 'detection_uuid',
+        'indicator_value': '1.1.1.1',
+        'limit': 10,
+        'start_date': '2021-01-07T03:21:34.123Z',
+    }
+
+    gti_api_request.assert_called_once_with(
+        'GET',
+        mock.ANY,
+        headers=mock.ANY,
+        params=expected_params,
+    )
+
+
 @freeze_time("2021-01-14T03:21:34.123Z")
-def test_get_events_failure(client, gti_api_request):
+def test_get_events_failure(client, context, integration,
+                            gti_api_request):
     app = client.application
 
     expected_error = {
@@ -221,10 +293,9 @@ def test_get_events_failure(client, gti_api_request):
         payload={'error': expected_error},
     )
 
-    key = 'key'
     observable = app.config['GTI_TEST_ENTITY']
 
-    events, error = get_events(key, observable)
+    events, error = integration.get_events(context, observable)
 
     expected_method = 'POST'
     expected_url = urljoin(
@@ -232,7 +303,7 @@ def test_get_events_failure(client, gti_api_request):
         'query',
     )
     expected_headers = {
-        'Authorization': f'IBToken {key}',
+        'Authorization': f'IBToken {context.key}',
         'User-Agent': app.config['CTR_USER_AGENT'],
     }
     expected_json = {
@@ -253,7 +324,8 @@ def test_get_events_failure(client, gti_api_request):
 
 
 @freeze_time("2021-01-14T03:21:34.123Z")
-def test_get_events_success(client, gti_api_request):
+def test_get_events_success(client, context, integration,
+                            gti_api_request):
     app = client.application
 
     expected_events = [{'uuid': str(uuid4()), 'customer_id': 'id'} for _ in
@@ -267,12 +339,11 @@ def test_get_events_success(client, gti_api_request):
         gti_api_response(
             ok=True,
             payload={'events': ''},
-        ) for _ in range(current_app.config['DAY_RANGE'])]
+        ) for _ in range(app.config['DAY_RANGE'])]
 
-    key = 'key'
     observable = app.config['GTI_TEST_ENTITY']
 
-    events, error = get_events(key, observable)
+    events, error = integration.get_events(context, observable)
 
     expected_method = 'POST'
     expected_url = urljoin(
@@ -280,7 +351,7 @@ def test_get_events_success(client, gti_api_request):
         'query',
     )
     expected_headers = {
-        'Authorization': f'IBToken {key}',
+        'Authorization': f'IBToken {context.key}',
         'User-Agent': app.config['CTR_USER_AGENT'],
     }
     expected_json = {
@@ -296,13 +367,119 @@ def test_get_events_success(client, gti_api_request):
         json=expected_json,
     )
 
-    assert gti_api_request.call_count == current_app.config['DAY_RANGE']
+    assert gti_api_request.call_count == app.config['DAY_RANGE']
 
     assert events == expected_events
     assert error is None
 
 
-def test_get_dhcp_records_by_ip_failure(client, gti_api_request):
+@freeze_time("2021-01-14T03:21:34.123Z")
+def test_get_events_with_projection_and_excluded_event_types(
+        client, context, integration, gti_api_request
+):
+    app = client.application
+    app.config['GTI_EVENTS_QUERY_PROJECTION'] = True
+
+    gti_api_request.return_value = gti_api_response(
+        ok=True,
+        payload={'events': []},
+    )
+
+    context = context._replace(excluded_event_types=('flow', 'dns'))
+    observable = app.config['GTI_TEST_ENTITY']
+
+    try:
+        integration.get_events(context, observable)
+    finally:
+        app.config['GTI_EVENTS_QUERY_PROJECTION'] = False
+
+    expected_json = {
+        'query': (
+            "ip = '8.8.8.8' AND event_type != 'flow' "
+            "AND event_type != 'dns'"
+        ),
+        'start_date': '2021-01-13T03:21:34.123Z',
+        'end_date': '2021-01-14T03:21:34.123Z',
+        'fields': list(EVENT_FIELDS),
+    }
+
+    assert gti_api_request.call_args_list[0] == mock.call(
+        'POST',
+        mock.ANY,
+        headers=mock.ANY,
+        json=expected_json,
+    )
+
+
+class StreamedResponse:
+    """Mimic a response of either `requests` or `aiohttp` read in chunks."""
+
+    def __init__(self, payload, chunk_size):
+        self.ok = True
+        self.status_code = self.status = 200
+        self.content = self
+
+        self.body = json.dumps(payload).encode()
+        self.chunk_size = chunk_size
+        self.chunks_read = 0
+        self.closed = False
+
+    def chunks(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            self.chunks_read += 1
+            yield self.body[start:start + self.chunk_size]
+
+    def iter_content(self, _):
+        return self.chunks()
+
+    async def iter_chunked(self, _):
+        for chunk in self.chunks():
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+    release = close
+
+
+@fixture(scope='function')
+def gti_api_stream_request():
+    with mock.patch('requests.request') as mock_request:
+        async def open_(_, method, url, **kwargs):
+            return mock_request(method, url, **kwargs)
+
+        with mock.patch('api.integration_async._open', open_):
+            yield mock_request
+
+
+def test_get_events_with_streaming_parse(client, context, integration,
+                                         gti_api_stream_request):
+    app = client.application
+
+    payload = {
+        'events': [
+            {'uuid': str(uuid4()), 'customer_id': 'id'} for _ in range(100)
+        ],
+    }
+    response = StreamedResponse(payload, chunk_size=100)
+    gti_api_stream_request.return_value = response
+
+    observable = app.config['GTI_TEST_ENTITY']
+
+    with mock.patch.dict(app.config, {'GTI_STREAMING_PARSE': True}):
+        events, error = integration.get_events(context, observable, limit=5)
+
+    assert events == payload['events'][:5]
+    assert error is None
+
+    # Only the first day is queried and the rest of its payload is skipped.
+    gti_api_stream_request.assert_called_once()
+    assert response.closed
+    assert response.chunks_read < len(response.body) / response.chunk_size
+
+
+def test_get_dhcp_records_by_ip_failure(client, context, integration,
+                                        gti_api_request):
     app = client.application
 
     expected_error = {
@@ -315,14 +492,15 @@ def test_get_dhcp_records_by_ip_failure(client, gti_api_request):
         payload={'error': expected_error},
     )
 
-    key = 'key'
     event_time_by_ip = {
         'ip_1': 'event_time_1',
         'ip_2': 'event_time_2',
         'ip_3': 'event_time_3',
     }
 
-    dhcp_records_by_ip, error = get_dhcp_records_by_ip(key, event_time_by_ip)
+    dhcp_records_by_ip, error = integration.get_dhcp_records_by_ip(
+        context, event_time_by_ip
+    )
 
     expected_method = 'POST'
     expected_url = urljoin(
@@ -330,7 +508,7 @@ def test_get_dhcp_records_by_ip_failure(client, gti_api_request):
         'entity/tracking/bulk/get/ip',
     )
     expected_headers = {
-        'Authorization': f'IBToken {key}',
+        'Authorization': f'IBToken {context.key}',
         'User-Agent': app.config['CTR_USER_AGENT'],
     }
     expected_json = {
@@ -352,7 +530,8 @@ def test_get_dhcp_records_by_ip_failure(client, gti_api_request):
     assert error == expected_error
 
 
-def test_get_dhcp_records_by_ip_success(client, gti_api_request):
+def test_get_dhcp_records_by_ip_success(client, context, integration,
+                                        gti_api_request):
     app = client.application
 
     expected_dhcp_records = [
@@ -376,14 +555,15 @@ def test_get_dhcp_records_by_ip_success(client, gti_api_request):
         for ip in ['ip_1', 'ip_2', 'ip_3']
     }
 
-    key = 'key'
     event_time_by_ip = {
         'ip_1': 'event_time_1',
         'ip_2': 'event_time_2',
         'ip_3': 'event_time_3',
     }
 
-    dhcp_records_by_ip, error = get_dhcp_records_by_ip(key, event_time_by_ip)
+    dhcp_records_by_ip, error = integration.get_dhcp_records_by_ip(
+        context, event_time_by_ip
+    )
 
     expected_method = 'POST'
     expected_url = urljoin(
@@ -391,7 +571,7 @@ def test_get_dhcp_records_by_ip_success(client, gti_api_request):
         'entity/tracking/bulk/get/ip',
     )
     expected_headers = {
-        'Authorization': f'IBToken {key}',
+        'Authorization': f'IBToken {context.key}',
         'User-Agent': app.config['CTR_USER_AGENT'],
     }
     expected_json = {
@@ -411,3 +591,56 @@ def test_get_dhcp_records_by_ip_success(client, gti_api_request):
 
     assert dhcp_records_by_ip == expected_dhcp_records_by_ip
     assert error is None
+
+
+def test_request_without_key_failure(client, context, integration,
+                                     gti_api_request):
+    detections, error = integration.get_detections_for_entity(
+        context._replace(key=None), 'entity'
+    )
+
+    gti_api_request.assert_not_called()
+
+    assert detections is None
+    assert error == {
+        'code': 'client.invalid_authentication',
+        'message': 'Authentication is invalid.',
+    }
+
+
+def test_request_with_invalid_authorization_header_failure(client,
+                                                           context,
+                                                           integration,
+                                                           gti_api_request):
+    # Mimic `requests` failing to encode the header with Latin-1.
+    gti_api_request.side_effect = UnicodeEncodeError(
+        'latin-1', '✓', 0, 1, 'ordinal not in range(256)'
+    )
+
+    detections, error = integration.get_detections_for_entity(
+        context._replace(key='✓'), 'entity'
+    )
+
+    assert detections is None
+    assert error == {
+        'code': 'client.invalid_authentication',
+        'message': 'Authorization failed: Invalid Authorization header',
+    }
+
+
+def test_event_filter(context):
+    events = [
+        {'uuid': 'seen', 'customer_id': 'cstmr'},
+        {'uuid': 'new', 'customer_id': 'cstmr'},
+        {'uuid': 'test', 'customer_id': 'dmo'},
+    ]
+
+    wanted = _event_filter(context, {'seen'})
+    assert [event['uuid'] for event in filter(wanted, events)] == [
+        'new', 'test',
+    ]
+
+    wanted = _event_filter(context._replace(allow_test_accounts=False), {})
+    assert [event['uuid'] for event in filter(wanted, events)] == [
+        'seen', 'new',
+    ]
@@ -0,0 +1,78 @@
+import json
+from datetime import datetime
+from unittest import mock
+from uuid import UUID
+
+from flask import json as flask_json
+from pytest import fixture, mark
+
+from api import jsonlib
+
+from .utils import load_fixture
+
+VALUES = [
+    load_fixture('sightings'),
+    load_fixture('indicators'),
+    load_fixture('workflow/events_for_observable'),
+    {'b': 1, 'a': [True, False, None], 'c': {'z': -1, 'y': 0.5}},
+    {'text': ''.join(chr(code) for code in range(0x80)) + 'ünï ёж 😀  '},
+    {'ünï': 1, 'a': 2, '😀': 3, 'ё': 4},
+    {'floats': [0.1, 1e-4, 1e-5, 1e15, 1e16, 1.5e300, -0.0, 123.456]},
+    {'hashes': ['9ffc7e4333d3be11b2', '0.00001', '1e5']},
+    {'big': 2 ** 70},
+    {'non-finite': [float('nan'), float('inf'), -float('inf'), None]},
+    [{'nested': (None, [float('nan')])}],
+    {1: 'non-string key'},
+]
+
+
+@fixture(scope='module', params=[True, False], ids=['orjson', 'stdlib'])
+def backend(request):
+    if request.param:
+        yield jsonlib.orjson
+    else:
+        with mock.patch('api.jsonlib.orjson', None):
+            yield None
+
+
+@mark.parametrize('value', VALUES)
+@mark.parametrize('ensure_ascii', [True, False])
+def test_dumps_matches_stdlib(backend, value, ensure_ascii):
+    expected = json.dumps(
+        value, sort_keys=True, ensure_ascii=ensure_ascii,
+        separators=(',', ':'),
+    )
+
+    assert jsonlib.dumps(value, ensure_ascii=ensure_ascii) == expected
+
+
+@mark.parametrize('value', VALUES + [
+    {'date': datetime(2021, 1, 14, 3, 21, 34), 'uuid': UUID(int=1)},
+])
+def test_jsonify_matches_flask(backend, client, value):
+    app = client.application
+
+    def jsonify(function, encoder):
+        with mock.patch.object(app, 'json_encoder', encoder):
+            with app.app_context():
+                return function(value).get_data()
+
+    expected = jsonify(flask_json.jsonify, flask_json.JSONEncoder)
+
+    assert jsonify(flask_json.jsonify, jsonlib.JSONEncoder) == expected
+    assert jsonify(jsonlib.jsonify, jsonlib.JSONEncoder) == expected
+
+
+@mark.parametrize('text', [
+    '{"a": [1, 2.5, "ё", null]}',
+    '{"big": 123456789012345678901234567890}',
+    '{"nan": NaN}',
+])
+def test_loads_matches_stdlib(backend, text):
+    expected = json.loads(text)
+
+    assert repr(jsonlib.loads(text)) == repr(expected)
+    assert repr(jsonlib.loads(text.encode())) == repr(expected)
+    assert repr(
+        flask_json.loads(text, cls=jsonlib.JSONDecoder)
+    ) == repr(expected)
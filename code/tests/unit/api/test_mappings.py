@@ -0,0 +1,230 @@
+import ast
+import inspect
+from unittest import mock
+
+from pytest import fixture
+
+from api import enrich, mappings, workflow
+from api.mappings import EVENT_FIELDS, Sighting, Indicator, Relationship
+
+from .utils import load_fixture
+
+
+@fixture(scope='function')
+def deterministic_ids(app_context):
+    with mock.patch.dict(app_context.config, {'CTIM_DETERMINISTIC_IDS': True}):
+        yield
+
+
+def test_sighting_ids_are_random_by_default(app_context):
+    event = load_fixture('workflow/events_for_observable')[0]
+
+    assert Sighting.map(event)['id'] != Sighting.map(event)['id']
+
+
+def test_sighting_ids_are_deterministic(deterministic_ids):
+    events = load_fixture('workflow/events_for_observable')
+
+    ids = [Sighting.map(event)['id'] for event in events]
+
+    assert ids == [Sighting.map(event)['id'] for event in events]
+    assert len(set(ids)) == len(ids)
+    assert all(id_.startswith('transient:sighting-') for id_ in ids)
+
+
+def test_sighting_ids_depend_on_observable(deterministic_ids):
+    event = load_fixture('workflow/events_for_observable')[0]
+
+    sighting = Sighting.map(event)
+
+    event['observable'] = {'type': 'ip', 'value': event['src']['ip']}
+
+    assert Sighting.map(event)['id'] != sighting['id']
+
+
+def test_relationship_ids_are_deterministic(deterministic_ids):
+    event = next(
+        event
+        for event in load_fixture('workflow/events_for_observable')
+        if 'detection' in event
+    )
+
+    sighting = Sighting.map(event)
+    indicator = Indicator.map(event['detection']['rule'])
+
+    relationship = Relationship.map(sighting, indicator)
+
+    assert relationship == Relationship.map(sighting, indicator)
+    assert relationship['id'].startswith('transient:relationship-')
+
+
+def http_event():
+    return next(
+        event
+        for event in load_fixture('workflow/events_for_observable')
+        if event['event_type'] == 'http'
+    )
+
+
+def test_sighting_relations_are_unique(app_context):
+    event = http_event()
+
+    relations = Sighting.map(event)['relations']
+
+    event['files'] = event['files'] * 3
+
+    assert Sighting.map(event)['relations'] == relations
+
+
+def test_sighting_relations_are_limited(app_context):
+    event = http_event()
+
+    relations = Sighting.map(event)['relations']
+
+    limit = len(relations) - 2
+
+    config = {'CTR_SIGHTING_RELATIONS_LIMIT': limit}
+    with mock.patch.dict(app_context.config, config):
+        sighting = Sighting.map(event)
+
+    assert sighting['relations'] == relations[:limit]
+    assert sighting['description'].endswith('- Omitted Relations: `2`')
+
+
+def test_sighting_aggregates_events(app_context):
+    events = [http_event() for _ in range(3)]
+    for index, event in enumerate(events):
+        event['uuid'] = f'uuid-{index}'
+        event['timestamp'] = f'2020-05-04T21:4{2 - index}:00.000Z'
+
+    config = {'CTR_AGGREGATED_EVENTS_SAMPLE': 2}
+    with mock.patch.dict(app_context.config, config):
+        sighting = Sighting.aggregate(events)
+
+    rule_uuid = events[0]['detection']['rule']['uuid']
+
+    assert sighting['count'] == 3
+    assert sighting['observed_time'] == {
+        'start_time': '2020-05-04T21:40:00.000Z',
+        'end_time': '2020-05-04T21:42:00.000Z',
+    }
+    assert sighting['targets'][0]['observed_time'] == sighting['observed_time']
+    assert sighting['external_ids'] == ['uuid-0', 'uuid-1', rule_uuid]
+    assert [
+        reference['external_id']
+        for reference in sighting['external_references']
+    ] == ['uuid-0', 'uuid-1', rule_uuid]
+    assert sighting['source_uri'] == sighting['external_references'][-1]['url']
+
+
+def test_sighting_aggregates_single_event(app_context):
+    event = http_event()
+
+    sighting = Sighting.aggregate([event])
+
+    assert sighting['count'] == 1
+    assert sighting['external_ids'] == Sighting.map(event)['external_ids']
+
+
+def test_sighting_record_renders_same_sighting(deterministic_ids):
+    events = load_fixture('workflow/events_for_observable')
+
+    records = [Sighting.record([event]) for event in events]
+
+    assert [record.json() for record in records] == [
+        Sighting.map(event) for event in events
+    ]
+    assert not hasattr(records[0], '__dict__')
+    assert records[0]['id'] == records[0].json()['id']
+
+    # Similar events share the same columns of the details.
+    http_records = [
+        record
+        for record, event in zip(records, events)
+        if event['event_type'] == 'http'
+    ]
+    assert http_records[0].columns is http_records[1].columns
+
+
+def test_sighting_record_merges_observables_and_relations(app_context):
+    event = http_event()
+
+    sighting = Sighting.record([event])
+    relations = list(sighting.relations)
+
+    event['observable'] = {'type': 'ip', 'value': event['src']['ip']}
+    event['user_agent'] = 'Another User Agent'
+
+    duplicate = Sighting.record([event])
+    sighting.merge(duplicate)
+
+    assert sighting.observables == [
+        http_event()['observable'],
+        event['observable'],
+    ]
+    assert sighting.relations[:len(relations)] == relations
+    assert set(sighting.relations) == set(relations) | set(
+        duplicate.relations
+    )
+
+
+def test_sighting_record_merges_relations_within_limit(app_context):
+    event = http_event()
+
+    relations = Sighting.record([event]).relations
+    limit = len(relations) - 1
+
+    event['observable'] = {'type': 'ip', 'value': event['src']['ip']}
+    event['user_agent'] = 'Another User Agent'
+
+    duplicate = Sighting.record([event])
+    assert set(duplicate.relations) - set(relations)
+
+    config = {'CTR_SIGHTING_RELATIONS_LIMIT': limit}
+    with mock.patch.dict(app_context.config, config):
+        sighting = Sighting.record([http_event()])
+        sighting.merge(Sighting.record([event]))
+
+    omitted = len(set(relations) | set(duplicate.relations)) - limit
+
+    assert sighting.relations == relations[:limit]
+    assert sighting.json()['description'].endswith(
+        f'- Omitted Relations: `{omitted}`'
+    )
+
+
+def event_fields_read(module):
+    """Collect all the `event['field']` lookups found in a module."""
+    fields = set()
+
+    for node in ast.walk(ast.parse(inspect.getsource(module))):
+        if (
+            isinstance(node, ast.Subscript) and
+            isinstance(node.ctx, ast.Load) and
+            isinstance(node.value, ast.Name) and
+            node.value.id == 'event' and
+            isinstance(node.slice, ast.Constant)
+        ):
+            fields.add(node.slice.value)
+
+        if (
+            isinstance(node, ast.Compare) and
+            isinstance(node.left, ast.Constant) and
+            isinstance(node.ops[0], ast.In) and
+            isinstance(node.comparators[0], ast.Name) and
+            node.comparators[0].id == 'event'
+        ):
+            fields.add(node.left.value)
+
+    return fields
+
+
+def test_event_fields_match_fields_read():
+    fields = set().union(*(
+        event_fields_read(module) for module in (mappings, workflow, enrich)
+    ))
+
+    # These are added to events by the workflow itself.
+    fields -= {'detection', 'observable'}
+
+    assert fields == set(EVENT_FIELDS)
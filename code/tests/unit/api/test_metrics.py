@@ -0,0 +1,77 @@
+import os
+from http import HTTPStatus
+
+from pytest import fixture
+
+from api.metrics import metrics
+
+
+@fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_metrics_call_success(client):
+    metrics.increment('hedging.hedged', endpoint='events')
+    metrics.observe('scheduler.queue_time', 0.5)
+    metrics.observe('scheduler.queue_time', 1.5)
+
+    response = client.get('/metrics')
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.get_json() == {
+        'pid': os.getpid(),
+        'counters': [
+            {
+                'name': 'hedging.hedged',
+                'labels': {'endpoint': 'events'},
+                'value': 1,
+            },
+        ],
+        'observations': [
+            {
+                'name': 'scheduler.queue_time',
+                'labels': {},
+                'count': 2,
+                'sum': 2.0,
+                'max': 1.5,
+            },
+        ],
+    }
+
+
+def test_metrics_call_reports_requests(client):
+    observables = [
+        {'type': 'domain', 'value': f'www.domain{index}.com'}
+        for index in range(20)
+    ]
+
+    client.post('/refer/observables',
+                json=observables,
+                headers={'Accept-Encoding': 'gzip'})
+
+    payload = client.get('/metrics').get_json()
+
+    names = {
+        observation['name'] for observation in payload['observations']
+    } | {counter['name'] for counter in payload['counters']}
+
+    assert {
+        'admission.queue_time',
+        'compression.responses',
+        'compression.ratio',
+        'compression.time',
+    } <= names
+
+
+def test_metrics_label_cardinality_capped():
+    for index in range(metrics.MAX_SERIES + 10):
+        metrics.increment('hedging.hedged', endpoint=f'endpoint-{index}')
+
+    counters = metrics.snapshot()['counters']
+
+    assert len(counters) == metrics.MAX_SERIES + 1
+    assert metrics.get('hedging.hedged', endpoint='endpoint-0') == 1
+    assert metrics.get('hedging.hedged', other=True) == 10
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from pytest import fixture
+
+from api import offload
+from api.bundle import Bundle
+from api.enrich import bundle_events, bundle_events_async
+from api.jsonlib import dumps
+from api.mappings import EncodedSighting, Sighting, SightingRecord
+from api.utils import stream_data
+
+from .test_bundle import events_for_observables
+from .utils import load_fixture
+
+
+@fixture
+def offload_context(app_context):
+    settings = {
+        'CTIM_DETERMINISTIC_IDS': True,
+        'CTR_OFFLOAD_PROCESSES': 1,
+    }
+
+    with mock.patch.dict(app_context.config, settings):
+        yield app_context
+
+    if offload._pool is not None:
+        offload._pool.shutdown()
+        offload._pool = None
+
+
+def test_map_sightings_same_as_in_place(offload_context):
+    events = load_fixture('workflow/events_for_observable')
+    groups = [[event] for event in events]
+
+    sightings = offload.map_sightings(offload_context.config, groups)
+
+    assert all(isinstance(s, EncodedSighting) for s in sightings)
+    assert [sighting.encoded for sighting in sightings] == [
+        dumps(Sighting.record(group).json()) for group in groups
+    ]
+    assert [sighting.json() for sighting in sightings] == [
+        Sighting.record(group).json() for group in groups
+    ]
+
+
+def test_map_sightings_falls_back_if_pool_broken(offload_context):
+    events = load_fixture('workflow/events_for_observable')
+    groups = [[event] for event in events]
+
+    pool = mock.Mock()
+    pool.submit.side_effect = BrokenProcessPool()
+
+    with mock.patch('api.offload.get_pool', return_value=pool):
+        sightings = offload.map_sightings(offload_context.config, groups)
+
+    assert all(isinstance(s, SightingRecord) for s in sightings)
+    assert [sighting.json() for sighting in sightings] == [
+        Sighting.record(group).json() for group in groups
+    ]
+
+
+def test_bundle_merges_encoded_sightings(offload_context):
+    observables = [
+        {'type': 'sha256', 'value': 'sha256'},
+        {'type': 'md5', 'value': 'md5'},
+    ]
+    events = list(events_for_observables(*observables))
+
+    def encoded(group):
+        record = Sighting.record(group)
+        return EncodedSighting(
+            record.id,
+            record.end_time,
+            record.external_ids,
+            record.severity,
+            dumps(record.json()),
+            events=group,
+        )
+
+    expected, bundle = Bundle(), Bundle()
+    for event in events:
+        expected.add(Sighting.record([event]))
+        bundle.add(encoded([event]))
+
+    assert bundle.json() == expected.json()
+    assert stream_data(bundle, streamed=False).get_data() == stream_data(
+        expected, streamed=False
+    ).get_data()
+
+
+def test_bundle_events_offloaded(offload_context, context):
+    events = load_fixture('workflow/events_for_observable')
+
+    expected, bundle = Bundle(), Bundle()
+
+    bundle_events(expected, context, events, {})
+
+    with mock.patch.dict(offload_context.config, {'CTR_OFFLOAD_THRESHOLD': 0}):
+        bundle_events(bundle, context, events, {})
+
+    assert bundle.json() == expected.json()
+
+
+def test_bundle_events_async_offloaded_off_event_loop(offload_context,
+                                                      context):
+    events = load_fixture('workflow/events_for_observable')
+
+    expected, bundle = Bundle(), Bundle()
+
+    bundle_events(expected, context, events, {})
+
+    threads = []
+
+    def map_sightings(config, groups):
+        threads.append(threading.current_thread())
+        return [Sighting.record(group) for group in groups]
+
+    with mock.patch.dict(offload_context.config,
+                         {'CTR_OFFLOAD_THRESHOLD': 0}), \
+            mock.patch('api.offload.map_sightings',
+                       side_effect=map_sightings):
+        asyncio.run(bundle_events_async(bundle, context, events, {}))
+
+    # The event loop doesn't wait for the pool.
+    assert threads and threads[0] is not threading.main_thread()
+    assert bundle.json() == expected.json()
+
+
+def test_pool_started_with_python_interpreter(offload_context):
+    config = offload_context.config
+
+    assert offload.get_executable(config) == sys.executable
+
+    # The current executable is the uWSGI binary when running within uWSGI.
+    with mock.patch.dict(sys.modules, {'uwsgi': mock.Mock()}):
+        executable = offload.get_executable(config)
+
+    assert os.path.dirname(executable) == os.path.join(sys.exec_prefix, 'bin')
+    assert os.path.samefile(executable, sys.executable)
+
+    with mock.patch.dict(config, {'CTR_OFFLOAD_EXECUTABLE': '/bin/python'}):
+        assert offload.get_executable(config) == '/bin/python'
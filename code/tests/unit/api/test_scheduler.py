@@ -0,0 +1,176 @@
+import asyncio
+from threading import Event
+
+from pytest import fixture, raises
+
+from api.metrics import metrics
+from api.scheduler import (
+    AsyncScheduler,
+    Scheduler,
+    close_async_scheduler,
+    get_async_scheduler,
+)
+
+
+@fixture(scope='function', autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def dispatch(scheduler):
+    # Dispatch the queued calls without actually running any of them.
+    order = []
+    while scheduler._queues:
+        _, (_, _, function, _, _) = scheduler._next()
+        order.append(function)
+    return order
+
+
+def make_scheduler(**kwargs):
+    scheduler = Scheduler(workers=0, **kwargs)
+    # Don't start any workers, so the order of dispatching can be checked.
+    scheduler._start = lambda: None
+    return scheduler
+
+
+def test_scheduler_takes_turns_between_tenants():
+    scheduler = make_scheduler()
+
+    for name in ['a1', 'a2', 'a3', 'a4']:
+        scheduler.submit('a', 1, name)
+    for name in ['b1', 'b2']:
+        scheduler.submit('b', 2, name)
+
+    assert dispatch(scheduler) == ['a1', 'b1', 'a2', 'b2', 'a3', 'a4']
+
+
+def test_scheduler_takes_turns_between_requests_of_tenant():
+    scheduler = make_scheduler()
+
+    for name in ['x1', 'x2', 'x3']:
+        scheduler.submit('a', 1, name)
+    for name in ['y1']:
+        scheduler.submit('a', 2, name)
+
+    assert dispatch(scheduler) == ['x1', 'y1', 'x2', 'x3']
+
+
+def test_scheduler_respects_tenant_weights():
+    scheduler = make_scheduler(weights={'a': 2})
+
+    for name in ['a1', 'a2', 'a3', 'a4']:
+        scheduler.submit('a', 1, name)
+    for name in ['b1', 'b2']:
+        scheduler.submit('b', 2, name)
+
+    assert dispatch(scheduler) == ['a1', 'a2', 'b1', 'a3', 'a4', 'b2']
+
+
+def test_scheduler_runs_calls():
+    scheduler = Scheduler(workers=2)
+    started = Event()
+
+    def call(value):
+        started.wait(timeout=5)
+        return value * 2
+
+    futures = [scheduler.submit('a', 1, call, value) for value in range(3)]
+    failure = scheduler.submit('b', 2, lambda: 1 / 0)
+    started.set()
+
+    assert [future.result(timeout=5) for future in futures] == [0, 2, 4]
+    with raises(ZeroDivisionError):
+        failure.result(timeout=5)
+
+    assert metrics.get('scheduler.queue_time')['count'] == 4
+
+
+def test_async_scheduler_takes_turns_between_tenants():
+    async def main():
+        scheduler = AsyncScheduler(workers=0)
+
+        for name in ['a1', 'a2', 'a3', 'a4']:
+            scheduler.submit('a', 1, name)
+        for name in ['b1', 'b2']:
+            scheduler.submit('b', 2, name)
+
+        return dispatch(scheduler)
+
+    assert asyncio.run(main()) == ['a1', 'b1', 'a2', 'b2', 'a3', 'a4']
+
+
+def test_async_scheduler_runs_calls():
+    async def call(value):
+        await asyncio.sleep(0)
+        return value * 2
+
+    async def fail():
+        return 1 / 0
+
+    async def main():
+        scheduler = AsyncScheduler(workers=2)
+
+        futures = [scheduler.submit('a', 1, call, value) for value in range(3)]
+        failure = scheduler.submit('b', 2, fail)
+
+        assert await asyncio.gather(*futures) == [0, 2, 4]
+        with raises(ZeroDivisionError):
+            await failure
+
+    asyncio.run(main())
+
+    assert metrics.get('scheduler.queue_time')['count'] == 4
+
+
+def test_async_scheduler_serves_small_lookups_first():
+    finished = []
+
+    async def call(name):
+        await asyncio.sleep(0.001)
+        finished.append(name)
+
+    async def main():
+        scheduler = AsyncScheduler(workers=1)
+
+        # A large lookup of one tenant followed by a small one of another.
+        large = [scheduler.submit('a', 1, call, f'a{index}')
+                 for index in range(20)]
+        small = scheduler.submit('b', 2, call, 'b0')
+
+        await small
+        await asyncio.gather(*large)
+
+    asyncio.run(main())
+
+    assert finished.index('b0') <= 1
+
+
+def test_async_scheduler_per_event_loop(client):
+    config = client.application.config
+
+    async def main():
+        return get_async_scheduler(config), get_async_scheduler(config)
+
+    first, same = asyncio.run(main())
+    second, _ = asyncio.run(main())
+
+    assert first is same
+    assert first is not second
+    assert first.workers == config['GTI_ASYNC_CONNECTIONS_LIMIT']
+
+
+def test_async_scheduler_closed(client):
+    config = client.application.config
+
+    async def main():
+        scheduler = get_async_scheduler(config)
+        scheduler._start()
+
+        await close_async_scheduler()
+
+        assert all(task.cancelled() for task in scheduler._tasks)
+        assert get_async_scheduler(config) is not scheduler
+
+    asyncio.run(main())
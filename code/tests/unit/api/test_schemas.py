@@ -0,0 +1,44 @@
+from pytest import mark
+
+from api.schemas import ObservableSchema, parse_observables
+
+
+@mark.parametrize('data', [
+    None,
+    'observables',
+    {'type': 'ip', 'value': '1.1.1.1'},
+    [1],
+    [{}],
+    [{'type': 'ip'}],
+    [{'type': '', 'value': 1}],
+    [{'type': 'ip', 'value': '1.1.1.1', 'extra': True}],
+    [{'type': 'ip', 'value': '1.1.1.1'}, {'type': 'unknown', 'value': ''}],
+], ids=repr)
+def test_parse_observables_errors_same_as_schema(data):
+    expected = ObservableSchema(many=True).validate(data)
+
+    assert parse_observables(data) == (None, expected)
+
+
+def test_parse_observables_canonicalized_unique_of_given_types():
+    data = [
+        {'type': 'domain', 'value': 'Example.COM'},
+        {'type': 'ip', 'value': '1.1.1.1'},
+        {'type': 'domain', 'value': 'example.com'},
+        {'type': 'md5', 'value': 'D41D8CD98F00B204E9800998ECF8427E'},
+        {'type': 'url', 'value': 'https://Example.COM'},
+        {'type': 'ip', 'value': '1.1.1.1'},
+    ]
+
+    observables, error = parse_observables(data, {'domain', 'ip', 'md5'})
+
+    assert error is None
+    assert observables == [
+        {'type': 'domain', 'value': 'example.com'},
+        {'type': 'ip', 'value': '1.1.1.1'},
+        {'type': 'md5', 'value': 'd41d8cd98f00b204e9800998ecf8427e'},
+    ]
+
+    # The types aren't filtered out unless given.
+    observables, _ = parse_observables(data)
+    assert {'type': 'url', 'value': 'https://Example.COM'} in observables
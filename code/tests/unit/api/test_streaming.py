@@ -0,0 +1,61 @@
+import json
+
+from pytest import mark, raises
+
+from api.streaming import ArrayItemsParser
+
+
+def parse(payload, key, chunk_size):
+    parser = ArrayItemsParser(key)
+
+    items = []
+    for start in range(0, len(payload), chunk_size):
+        items.extend(parser.feed(payload[start:start + chunk_size]))
+    items.extend(parser.close())
+
+    return items
+
+
+PAYLOAD = {
+    'total': 12345,
+    'meta': {'events': ['not', 'these'], 'note': 'ünïcödé ]}'},
+    'events': [
+        {'uuid': str(index), 'value': [index, 1.5, None, True, 'ё']}
+        for index in range(10)
+    ],
+    'more': [1, 2, 3],
+    'flag': False,
+}
+
+
+@mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 10 ** 6])
+def test_parser_yields_items_across_any_chunks(chunk_size):
+    payload = json.dumps(PAYLOAD, ensure_ascii=False, indent=1).encode()
+
+    assert parse(payload, 'events', chunk_size) == PAYLOAD['events']
+
+
+def test_parser_yields_items_as_soon_as_parsed():
+    parser = ArrayItemsParser('events')
+
+    assert list(parser.feed(b'{"events": [{"a": 1}, {"a": 2')) == [{'a': 1}]
+    assert list(parser.feed(b'}, 3')) == [{'a': 2}]
+    assert list(parser.feed(b']}')) == [3]
+    assert list(parser.close()) == []
+    assert parser.done
+
+
+@mark.parametrize('payload', [b'{}', b'{"events": null}', b'{"events": ""}'])
+def test_parser_handles_missing_items(payload):
+    assert parse(payload, 'events', 1) == []
+
+
+@mark.parametrize('payload', [b'{"events": [{"a": 1}', b'{"events": [1,'])
+def test_parser_fails_on_incomplete_object(payload):
+    with raises(ValueError):
+        parse(payload, 'events', 1)
+
+
+def test_parser_fails_on_invalid_object():
+    with raises(ValueError):
+        parse(b'["events"]', 'events', 1)
@@ -1,16 +1,24 @@
 from contextlib import ExitStack
 from unittest import mock
 
-from api.workflow import get_events_for_observable
+from api.budget import Allocation
+from api.metrics import metrics
+from api.workflow import (
+    QueryPlan,
+    explain_query,
+    get_events_for_observable,
+    plan_query,
+    _compile_field,
+)
 
 from .utils import load_fixture
 
 
-def test_get_events_for_observable(client):
+def test_get_events_for_observable(client, context):
     def success(data):
         return data, None
 
-    def submit(func, *args, **kwargs):
+    def submit(tenant, request, func, *args, **kwargs):
         future = mock.MagicMock()
         future.result = lambda: func(*args, **kwargs)
         return future
@@ -30,8 +38,8 @@ def test_get_events_for_observable(client):
         get_detections_for_entity_mock.return_value = success(detections)
 
         stack.enter_context(
-            mock.patch('api.workflow.ThreadPoolExecutor.submit')
-        ).side_effect = submit
+            mock.patch('api.workflow.get_scheduler')
+        ).return_value.submit.side_effect = submit
 
         stack.enter_context(
             mock.patch('api.workflow.as_completed')
@@ -65,30 +73,236 @@ def test_get_events_for_observable(client):
 
         # 2. Act.
 
-        key = 'Chop Suey!'
         observable = load_fixture('observable')
         event_uuids = frozenset({'33798826-53fc-4a32-ad9d-825dc0c08749',
                                 'fd1d7b35-1df4-4a3a-b436-dda9179c9a79'})
 
-        events, error = get_events_for_observable(key, observable)
+        events, error = get_events_for_observable(context, observable)
 
         # 3. Assert.
 
         entity = observable['value']
 
-        get_detections_for_entity_mock.assert_called_once_with(key, entity)
+        get_detections_for_entity_mock.assert_called_once_with(context, entity)
 
         get_events_for_detection_mock.assert_has_calls([
-            mock.call(key, detection['uuid'])
+            mock.call(
+                context, detection['uuid'], entity,
+                limit=context.entities_limit,
+            )
             for detection in detections
         ])
 
-        get_events_mock.assert_called_once_with(key, observable, event_uuids)
+        limit = context.entities_limit
+
+        get_events_mock.assert_called_once_with(
+            context, observable, event_uuids,
+            limit=limit - len(event_uuids),
+            day_range=client.application.config['DAY_RANGE'],
+        )
 
         # The actual algorithm for building the `event_time_by_ip` argument is
         # quite unwieldy but straightforward at the same time, so let's just
         # ignore it and don't repeat the same code one more time again.
-        get_dhcp_records_by_ip_mock.assert_called_once_with(key, mock.ANY)
+        get_dhcp_records_by_ip_mock.assert_called_once_with(context, mock.ANY)
+
+        assert events == expected_events
+        assert error is None
+
+
+def test_get_events_for_observable_async(client, context):
+    def success(data):
+        return data, None
+
+    app = client.application
+
+    with ExitStack() as stack:
+        # 1. Arrange.
+
+        stack.enter_context(
+            mock.patch.dict(app.config, {'GTI_ASYNC_CLIENT': True})
+        )
+
+        get_detections_for_entity_mock = stack.enter_context(
+            mock.patch('api.integration_async.get_detections_for_entity',
+                       new_callable=mock.AsyncMock)
+        )
+
+        detections = load_fixture('integration/detections_for_entity')
+
+        get_detections_for_entity_mock.return_value = success(detections)
+
+        get_events_for_detection_mock = stack.enter_context(
+            mock.patch('api.integration_async.get_events_for_detection',
+                       new_callable=mock.AsyncMock)
+        )
+
+        get_events_for_detection_mock.return_value = success(
+            load_fixture('integration/events_for_detection')
+        )
+
+        get_events_mock = stack.enter_context(
+            mock.patch('api.integration_async.get_events',
+                       new_callable=mock.AsyncMock)
+        )
+
+        get_events_mock.return_value = success(
+            load_fixture('integration/events')
+        )
+
+        expected_events = load_fixture('workflow/events_for_observable')
+
+        get_dhcp_records_by_ip_mock = stack.enter_context(
+            mock.patch('api.integration_async.get_dhcp_records_by_ip',
+                       new_callable=mock.AsyncMock)
+        )
+
+        get_dhcp_records_by_ip_mock.return_value = success(
+            load_fixture('integration/dhcp_records_by_ip')
+        )
+
+        # 2. Act.
+
+        observable = load_fixture('observable')
+        event_uuids = frozenset({'33798826-53fc-4a32-ad9d-825dc0c08749',
+                                'fd1d7b35-1df4-4a3a-b436-dda9179c9a79'})
+
+        metrics.reset()
+
+        events, error = get_events_for_observable(context, observable)
+
+        # 3. Assert.
+
+        entity = observable['value']
+
+        get_detections_for_entity_mock.assert_awaited_once_with(
+            context, entity
+        )
+
+        # The calls take turns with the other requests.
+        assert metrics.get('scheduler.queue_time')['count'] == len(
+            detections
+        )
+
+        get_events_for_detection_mock.assert_has_awaits([
+            mock.call(
+                context, detection['uuid'], entity,
+                limit=context.entities_limit,
+            )
+            for detection in detections
+        ], any_order=True)
+
+        limit = context.entities_limit
+
+        get_events_mock.assert_awaited_once_with(
+            context, observable, event_uuids,
+            limit=limit - len(event_uuids),
+            day_range=client.application.config['DAY_RANGE'],
+        )
+
+        get_dhcp_records_by_ip_mock.assert_awaited_once_with(
+            context, mock.ANY
+        )
 
         assert events == expected_events
         assert error is None
+
+
+def test_plan_query(client, context):
+    plans = {'sha256': {'dhcp': False, 'day_range': 3}}
+
+    with mock.patch.dict(client.application.config,
+                         {'GTI_QUERY_PLANS': plans}):
+        ip_plan = plan_query(context, {'type': 'ip', 'value': '1.1.1.1'})
+        sha256_plan = plan_query(context, {'type': 'sha256', 'value': 'x'})
+
+    assert ip_plan == QueryPlan(
+        detections=True,
+        events=True,
+        day_range=client.application.config['DAY_RANGE'],
+        events_limit=None,
+        dhcp=True,
+    )
+    assert sha256_plan == ip_plan._replace(dhcp=False, day_range=3)
+
+
+def test_explain_query(client, context):
+    plans = {'ip': {'detections': False, 'events_limit': 10}}
+
+    with mock.patch.dict(client.application.config,
+                         {'GTI_QUERY_PLANS': plans}):
+        explanation = explain_query(
+            context, {'type': 'ip', 'value': '1.1.1.1'}, Allocation(20, 30)
+        )
+
+    assert [call['step'] for call in explanation['calls']] == [
+        'events', 'dhcp_records',
+    ]
+    assert explanation['calls'][0]['limit'] == 10
+    assert explanation['estimated_calls'] == (
+        client.application.config['DAY_RANGE'] + 1
+    )
+
+
+def test_get_events_for_observable_follows_plan(client, context):
+    plans = {'sha256': {'detections': False, 'dhcp': False}}
+
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(client.application.config,
+                                            {'GTI_QUERY_PLANS': plans}))
+
+        get_detections_for_entity_mock = stack.enter_context(
+            mock.patch('api.workflow.get_detections_for_entity')
+        )
+        get_dhcp_records_by_ip_mock = stack.enter_context(
+            mock.patch('api.workflow.get_dhcp_records_by_ip')
+        )
+        get_events_mock = stack.enter_context(
+            mock.patch('api.workflow.get_events')
+        )
+        get_events_mock.return_value = load_fixture('integration/events'), None
+
+        observable = load_fixture('observable')
+
+        events, error = get_events_for_observable(context, observable)
+
+        get_detections_for_entity_mock.assert_not_called()
+        get_dhcp_records_by_ip_mock.assert_not_called()
+
+    assert len(events) == len(load_fixture('integration/events'))
+    assert all('dhcp' not in event['src'] for event in events)
+    assert error is None
+
+
+def test_compile_field():
+    event = {
+        'src': {'ip': '1.1.1.1'},
+        'host': None,
+        'answers': [{'ip': '2.2.2.2'}, {'name': 'x'}, 'y', {'ip': '3.3.3.3'}],
+        'files': [
+            {'sha256': ['a', 'b']},
+            {'sha256': 'c'},
+        ],
+    }
+
+    def matches(field, value):
+        _, match = _compile_field(field)
+        return match(event, value)
+
+    assert _compile_field('http:files.sha256')[0] == 'sha256'
+    assert _compile_field('files.sha256') is not _compile_field(
+        'http:files.sha256'
+    )
+    assert _compile_field('files.sha256')[1] is _compile_field(
+        'http:files.sha256'
+    )[1]
+
+    assert matches('src.ip', '1.1.1.1')
+    assert not matches('dst.ip', '1.1.1.1')
+    assert not matches('src.ip.ip', '1.1.1.1')
+    assert not matches('host.domain', None)
+    assert matches('dns:answers.ip', '3.3.3.3')
+    assert not matches('dns:answers.ip', 'y')
+    assert matches('http:files.sha256', 'b')
+    assert matches('http:files.sha256', 'c')
+    assert not matches('http:files.sha256', 'd')
@@ -3,6 +3,7 @@ from unittest import mock
 import jwt
 from pytest import fixture
 
+from api.context import Context
 from app import app
 from tests.unit.api.mock_keys_for_tests import PRIVATE_KEY
 
@@ -13,14 +14,30 @@ GTI_KEY = 'In Gigamon ThreatINSIGHT we trust!'
 def client():
     app.rsa_private_key = PRIVATE_KEY
 
-    app.config['GTI_ALLOW_TEST_ACCOUNTS'] = 1
-
     app.testing = True
 
     with app.test_client() as client:
         yield client
 
 
+@fixture(scope='function')
+def app_context(client):
+    app = client.application
+
+    with app.app_context():
+        yield app
+
+
+@fixture(scope='function')
+def context(client):
+    return Context(
+        key=GTI_KEY,
+        config=client.application.config,
+        entities_limit=100,
+        allow_test_accounts=True,
+    )
+
+
 @fixture(scope='function')
 def rsa_api_request():
     with mock.patch('requests.get') as mock_request:
@@ -0,0 +1,163 @@
+import asyncio
+import json
+from collections import namedtuple
+from http import HTTPStatus
+from unittest import mock
+
+from pytest import fixture
+
+from asgi import application
+from tests.unit.api.mock_keys_for_tests import \
+    EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+from tests.unit.api.utils import headers, load_fixture
+
+Response = namedtuple('Response', ('status_code', 'headers', 'data'))
+
+
+def asgi_open(route, method='POST', payload=None, headers=None, body=None):
+    if body is None:
+        body = b'' if payload is None else json.dumps(payload).encode()
+
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': route,
+        'root_path': '',
+        'query_string': b'',
+        'headers': [
+            (name.lower().encode(), value.encode())
+            for name, value in {
+                'Host': 'localhost',
+                'Content-Type': 'application/json',
+                **(headers or {}),
+            }.items()
+        ],
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 12345),
+    }
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(application(scope, receive, send))
+
+    start, *chunks = messages
+
+    return Response(
+        start['status'],
+        {
+            name.decode(): value.decode()
+            for name, value in start['headers']
+        },
+        b''.join(chunk.get('body', b'') for chunk in chunks),
+    )
+
+
+Call = namedtuple('Call', ('method', 'route', 'headers'))
+
+
+def calls():
+    yield Call('POST', '/post', None)
+    yield Call('GET', '/health', None)
+    yield Call('POST', '/health', None)
+    yield Call('POST', '/version', None)
+    yield Call('GET', '/metrics', None)
+    yield Call('GET', '/watchdog', {'Health-Check': 'test'})
+    yield Call('GET', '/watchdog', None)
+    yield Call('POST', '/observe/observables', None)
+    yield Call('POST', '/refer/observables', None)
+    yield Call('POST', '/observe/observables/bulk', None)
+
+
+@fixture(scope='module',
+         params=calls(),
+         ids=lambda call: f'{call.method} {call.route}')
+def call(request):
+    return request.param
+
+
+def test_asgi_call_matches_wsgi_call(call, client, valid_json):
+    payload = valid_json if call.method == 'POST' else None
+
+    expected = client.open(
+        call.route, method=call.method, json=payload, headers=call.headers
+    )
+
+    response = asgi_open(
+        call.route, method=call.method, payload=payload, headers=call.headers
+    )
+
+    assert response.status_code == expected.status_code
+    assert response.headers['content-type'] == expected.content_type
+    assert response.data == expected.data
+
+
+def test_asgi_health_call_success(client,
+                                  context,
+                                  valid_jwt,
+                                  rsa_api_request,
+                                  rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    target = 'api.integration_async.get_events'
+
+    with mock.patch(target, new_callable=mock.AsyncMock) as get_events_mock:
+        get_events_mock.return_value = (..., None)
+
+        response = asgi_open('/health', headers=headers(valid_jwt()))
+
+        get_events_mock.assert_awaited_once_with(
+            context, app.config['GTI_TEST_ENTITY']
+        )
+
+    assert response.status_code == HTTPStatus.OK
+    assert json.loads(response.data) == {'data': {'status': 'ok'}}
+
+
+def test_asgi_observe_call_matches_wsgi_call(client,
+                                             valid_json,
+                                             valid_jwt,
+                                             rsa_api_request,
+                                             rsa_api_response):
+    app = client.application
+
+    rsa_api_request.return_value = rsa_api_response(
+        EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    def get_events_for_observable(_, observable, allocation):
+        data = (
+            load_fixture('workflow/events_for_observable')
+            if observable['type'] == 'sha256' else
+            []
+        )
+        return data, None
+
+    with mock.patch.dict(app.config, {'CTIM_DETERMINISTIC_IDS': True}), \
+            mock.patch('api.enrich.get_events_for_observable',
+                       side_effect=get_events_for_observable), \
+            mock.patch('api.enrich.get_events_for_observable_async',
+                       side_effect=get_events_for_observable,
+                       new_callable=mock.AsyncMock):
+        expected = client.post('/observe/observables',
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
+        response = asgi_open('/observe/observables',
+                             payload=valid_json,
+                             headers=headers(valid_jwt()))
+
+    assert json.loads(expected.data)['data']['sightings']['count']
+    assert response.status_code == expected.status_code
+    assert response.data == expected.data
@@ -10,4 +10,11 @@ else
 	echo "[start.sh] ............." >> /var/log/messages
 fi
 set -e
+if [ "${SERVER_MODE}" = "asgi" ]; then
+	echo "[start.sh] Serving the ASGI app with uvicorn" >> /var/log/messages
+	# Lots of concurrent slow lookups are fine, unlike with a thread each.
+	export ADMISSION_TENANT_LIMIT="${ADMISSION_TENANT_LIMIT:-100}"
+	export ADMISSION_TOTAL_LIMIT="${ADMISSION_TOTAL_LIMIT:-400}"
+	exec /usr/bin/supervisord -c /supervisord-asgi.ini
+fi
 exec /usr/bin/supervisord -c /supervisord.ini